@@ -0,0 +1,76 @@
+"""
+Benchmark the extraction of the alternative sequences of SNVs.
+
+Compares the previous extraction, which applies every variant to the union of the shifted windows with
+VariantSeqExtractor, with the patching of the encoded reference window (see patch_substitution), from the FASTA
+file and, if a genome_dir is given, from the encoded genome. The patched extraction is measured in the order of
+the matcher and grouped by the TSS window (see VCFTSSDataloader.group_by_tss), in which consecutive variants reuse
+the reference of their window. Run from the repository root, the records are taken from the chr22 example files.
+
+Usage: python benchmarks/benchmark_alt_sequences.py [num_records] [repeats] [genome_dir]
+"""
+import sys
+import time
+import numpy as np
+from kipoiseq import Interval, Variant
+from kipoiseq.transforms.functional import one_hot_dna
+from kipoi_enformer.dataloader import VCFTSSDataloader
+from kipoi_enformer.dataloader.dataloader import construct_interval, extract_shifted_sequence
+
+SHIFTS = (-43, 0, 43)
+
+
+def extract_variant_extractor(dl: VCFTSSDataloader, input_key: tuple) -> np.ndarray:
+    """
+    The previous extraction, which applies the variant to the union window with VariantSeqExtractor.
+    """
+    chromosome, strand, tss, *variant = input_key
+    chrom_len = len(dl._reference_sequence.fasta.records[chromosome])
+    interval = construct_interval(chromosome, strand, tss, dl._seq_length)
+    shifted_intervals = [interval.shift(shift, use_strand=True) for shift in SHIFTS]
+    union_start = min(x.start for x in shifted_intervals)
+    union_end = max(x.end for x in shifted_intervals)
+    union_interval = Interval(chromosome, union_start, union_end, strand=strand)
+    union_seq = one_hot_dna(extract_shifted_sequence(union_interval, tss, chrom_len, dl._reference_sequence,
+                                                     variant_extractor=dl._variant_seq_extractor,
+                                                     variant=Variant(*variant)))
+    offsets = [union_end - x.end if strand == '-' else x.start - union_start for x in shifted_intervals]
+    return np.stack([union_seq[offset:offset + dl._seq_length] for offset in offsets])
+
+
+def extract_patched(dl: VCFTSSDataloader, input_key: tuple) -> np.ndarray:
+    return dl.extract_sequences(input_key)
+
+
+def benchmark(extract_fn, dl: VCFTSSDataloader, input_keys: list[tuple], repeats: int):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for input_key in input_keys:
+            extract_fn(dl, input_key)
+    elapsed = time.perf_counter() - start
+    return len(input_keys) * repeats / elapsed
+
+
+def main(num_records: int = 20, repeats: int = 3, genome_dir: str | None = None):
+    dataloaders = [('fasta', None)]
+    if genome_dir is not None:
+        dataloaders.append(('encoded', genome_dir))
+    for name, dl_genome_dir in dataloaders:
+        dl = VCFTSSDataloader(fasta_file='example_files/seq.fa', gtf='example_files/annot.gtf.gz',
+                              vcf_file='example_files/vcf/chr22_var.vcf.gz', shifts=SHIFTS, size=num_records,
+                              variant_upstream_tss=5_000, variant_downstream_tss=5_000, genome_dir=dl_genome_dir)
+        # only the substitutions are patched
+        input_keys = [input_key for _, input_key in dl.iter_records() if len(input_key[5]) == len(input_key[6])]
+        for input_key in input_keys:
+            assert np.array_equal(extract_variant_extractor(dl, input_key), extract_patched(dl, input_key))
+        print(f'{name}: num_records={len(input_keys)}, repeats={repeats}')
+        # the order of group_by_tss
+        grouped_input_keys = sorted(input_keys, key=lambda x: (x[0], x[2], x[1], x[4]))
+        for fn_name, extract_fn, keys in [('variant-extractor', extract_variant_extractor, input_keys),
+                                          ('patched', extract_patched, input_keys),
+                                          ('patched (grouped)', extract_patched, grouped_input_keys)]:
+            print(f'{fn_name:>20}: {benchmark(extract_fn, dl, keys, repeats):10.2f} records/s')
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:3]], *sys.argv[3:])
@@ -0,0 +1,70 @@
+"""
+Benchmark the assembly of the sequence batches.
+
+Compares the previous assembly, which stacks the shifts of every record and then the records of a batch,
+with the preallocated sequence buffers of TSSDataloader.iter_batches, which Enformer.predict runs, in float32 and
+in uint8, which is converted to float32 once as before the model. Reports the throughput and the peak memory of the
+numpy arrays, which are traced by tracemalloc. Run from the repository root, the records are taken from the chr22 example files.
+
+Usage: python benchmarks/benchmark_batch_assembly.py [num_records] [batch_size] [genome_dir]
+"""
+import itertools
+import sys
+import time
+import tracemalloc
+import numpy as np
+from kipoi_utils.data_utils import numpy_collate
+from kipoi_enformer.dataloader import RefTSSDataloader
+from kipoi_enformer.dataloader.dataloader import to_float_sequences
+
+
+def iter_stacked_batches(dl: RefTSSDataloader, batch_size: int):
+    """
+    The previous assembly, which allocates the sequences of every record and every batch.
+    """
+    records = dl.iter_records()
+    while len(batch_records := list(itertools.islice(records, batch_size))) > 0:
+        yield {
+            'metadata': numpy_collate([metadata for metadata, _ in batch_records]),
+            'sequences': np.stack([dl.extract_sequences(input_key) for _, input_key in batch_records]),
+        }
+
+
+def iter_buffered_batches(dl: RefTSSDataloader, batch_size: int, dtype: str):
+    for batch in dl.iter_batches(batch_size, dtype=dtype):
+        # the conversion at the model boundary
+        batch['sequences'] = to_float_sequences(batch['sequences'])
+        yield batch
+
+
+def benchmark(iter_batches, dl: RefTSSDataloader, batch_size: int, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    num_records = 0
+    for batch in iter_batches(dl, batch_size, *args):
+        num_records += len(batch['sequences'])
+        # the prediction loop releases the converted sequences after running the model
+        del batch
+    elapsed = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return num_records / elapsed, peak_memory
+
+
+def main(num_records: int = 64, batch_size: int = 8, genome_dir: str | None = None):
+    dl = RefTSSDataloader(fasta_file='example_files/seq.fa', gtf='example_files/annot.gtf.gz',
+                          chromosome='chr22', size=num_records, genome_dir=genome_dir)
+    for batch, *buffered in zip(iter_stacked_batches(dl, batch_size), iter_buffered_batches(dl, batch_size, 'float32'),
+                                iter_buffered_batches(dl, batch_size, 'uint8')):
+        assert all(np.array_equal(batch['sequences'], x['sequences']) for x in buffered)
+
+    print(f'num_records={num_records}, batch_size={batch_size}, genome_dir={genome_dir}')
+    iter_fns = [('stacked', iter_stacked_batches), ('float32', iter_buffered_batches, 'float32'),
+                ('uint8', iter_buffered_batches, 'uint8')]
+    for name, iter_fn, *args in iter_fns:
+        records_per_second, peak_memory = benchmark(iter_fn, dl, batch_size, *args)
+        print(f'{name:>10}: {records_per_second:10.2f} records/s, {peak_memory / 2 ** 20:8.1f} MiB peak memory')
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:3]], *sys.argv[3:])
@@ -0,0 +1,71 @@
+"""
+Benchmark the extraction of the shifted input sequences.
+
+Compares the previous extraction, which fetches and one-hot encodes every shifted window separately,
+with extract_sequences_around_anchor, which extracts the union of the windows once and slices the shifts,
+from the FASTA file and, if a genome_dir is given, from the encoded genome (see kipoi_enformer.genome).
+Run from the repository root, the records are taken from the chr22 example files.
+
+Usage: python benchmarks/benchmark_extract_sequences.py [num_records] [repeats] [genome_dir]
+"""
+import sys
+import time
+import numpy as np
+from kipoiseq.transforms.functional import one_hot_dna
+from kipoi_enformer.dataloader import RefTSSDataloader
+from kipoi_enformer.dataloader.dataloader import construct_interval, extract_sequences_around_anchor, \
+    extract_shifted_sequence
+
+SHIFTS = (-43, 0, 43)
+
+
+def extract_per_shift(dl: RefTSSDataloader, input_key: tuple) -> np.ndarray:
+    """
+    The previous extraction, which fetches and encodes every shift separately.
+    """
+    chromosome, strand, tss = input_key
+    chrom_len = len(dl._reference_sequence.fasta.records[chromosome])
+    interval = construct_interval(chromosome, strand, tss, dl._seq_length)
+    return np.stack([one_hot_dna(extract_shifted_sequence(interval.shift(shift, use_strand=True), tss, chrom_len,
+                                                          dl._reference_sequence))
+                     for shift in SHIFTS])
+
+
+def extract_union(dl: RefTSSDataloader, input_key: tuple) -> np.ndarray:
+    chromosome, strand, tss = input_key
+    sequences, _ = extract_sequences_around_anchor(SHIFTS, chromosome, strand, tss, dl._seq_length,
+                                                   ref_seq_extractor=dl._reference_sequence)
+    return np.stack(sequences)
+
+
+def extract_encoded(dl: RefTSSDataloader, input_key: tuple) -> np.ndarray:
+    return dl.extract_sequences(input_key)
+
+
+def benchmark(extract_fn, dl: RefTSSDataloader, input_keys: list[tuple], repeats: int):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for input_key in input_keys:
+            extract_fn(dl, input_key)
+    elapsed = time.perf_counter() - start
+    return len(input_keys) * repeats / elapsed
+
+
+def main(num_records: int = 20, repeats: int = 3, genome_dir: str | None = None):
+    dl = RefTSSDataloader(fasta_file='example_files/seq.fa', gtf='example_files/annot.gtf.gz',
+                          chromosome='chr22', shifts=SHIFTS, size=num_records, genome_dir=genome_dir)
+    input_keys = [input_key for _, input_key in dl.iter_records()]
+    for input_key in input_keys:
+        assert np.array_equal(extract_per_shift(dl, input_key), extract_union(dl, input_key))
+        assert np.array_equal(extract_per_shift(dl, input_key), extract_encoded(dl, input_key))
+
+    extract_fns = [('per-shift', extract_per_shift), ('union', extract_union)]
+    if genome_dir is not None:
+        extract_fns.append(('encoded', extract_encoded))
+    print(f'num_records={len(input_keys)}, repeats={repeats}')
+    for name, extract_fn in extract_fns:
+        print(f'{name:>10}: {benchmark(extract_fn, dl, input_keys, repeats):10.2f} records/s')
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:3]], *sys.argv[3:])
@@ -0,0 +1,69 @@
+"""
+Benchmark the preparation of the TSS from the genome annotation.
+
+Compares the previous row-wise implementation of get_tss_from_genome_annotation with the vectorized one.
+The example annotation is repeated to the size of a full GENCODE annotation (~250k transcripts),
+or a full-size GTF file can be passed instead. Run from the repository root.
+
+Usage: python benchmarks/benchmark_genome_annotation.py [gtf] [scale] [repeats]
+"""
+import sys
+import time
+import pandas as pd
+from kipoi_enformer.dataloader.dataloader import get_tss_from_genome_annotation
+from kipoi_enformer.utils import gtf_to_pandas
+
+
+def get_tss_rowwise(gtf: pd.DataFrame, canonical_only: bool = False):
+    """
+    The previous implementation, which applies python functions to every row.
+    """
+    roi = gtf.query("`Feature` == 'transcript'")
+    if canonical_only:
+        roi = roi[roi['tag'].apply(lambda x: False if pd.isna(x) else ('Ensembl_canonical' in x.split(',')))]
+    roi = roi.assign(transcript_start=roi["Start"], transcript_end=roi["End"])
+
+    def adjust_row(row):
+        if row.Strand == '-':
+            tss = row.End - 1
+        else:
+            tss = row.Start
+        row.Start = tss
+        row.End = tss + 1
+        return row
+
+    roi = roi.apply(adjust_row, axis=1)
+    roi['tss'] = roi["Start"]
+    return roi
+
+
+def get_tss_vectorized(gtf: pd.DataFrame, canonical_only: bool = False):
+    return get_tss_from_genome_annotation(gtf, canonical_only=canonical_only)
+
+
+def benchmark(get_tss_fn, gtf: pd.DataFrame, canonical_only: bool, repeats: int):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        get_tss_fn(gtf, canonical_only=canonical_only)
+    return (time.perf_counter() - start) / repeats
+
+
+def main(gtf: str = 'example_files/annot.gtf.gz', scale: int = 30, repeats: int = 1):
+    gtf = gtf_to_pandas(gtf)
+    gtf = pd.concat([gtf] * scale, ignore_index=True)
+    num_transcripts = (gtf['Feature'] == 'transcript').sum()
+    print(f'num_transcripts={num_transcripts}, repeats={repeats}')
+    for canonical_only in [False, True]:
+        rowwise = get_tss_rowwise(gtf, canonical_only)
+        vectorized = get_tss_vectorized(gtf, canonical_only)
+        # the columns that are not rewritten keep their types, e.g. categorical columns of the GTF file
+        pd.testing.assert_frame_equal(rowwise, vectorized, check_dtype=False, check_categorical=False)
+        pd.testing.assert_series_equal(rowwise.dtypes[['Start', 'End', 'Strand', 'tss']],
+                                       vectorized.dtypes[['Start', 'End', 'Strand', 'tss']])
+        for name, get_tss_fn in [('row-wise', get_tss_rowwise), ('vectorized', get_tss_vectorized)]:
+            elapsed = benchmark(get_tss_fn, gtf, canonical_only, repeats)
+            print(f'{name:>10} (canonical_only={canonical_only}): {elapsed:8.3f}s')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2], *[int(x) for x in sys.argv[2:]])
@@ -0,0 +1,55 @@
+"""
+Benchmark the import time of the post-processing stages.
+
+Imports the stages in fresh interpreters and reports the wall time, the peak RSS and the heavy modules
+that were loaded. Exits with a non-zero status if a stage loads one of the heavy modules, which should
+only be imported by the stages that use them.
+
+Usage: python benchmarks/benchmark_import_time.py [repeats]
+"""
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ['tensorflow', 'tensorflow_hub', 'sklearn', 'xarray', 'scipy', 'pyranges', 'kipoi', 'kipoiseq']
+
+STAGES = {
+    'aggregator': 'from kipoi_enformer.enformer import EnformerAggregator',
+    'veff': 'from kipoi_enformer.enformer import EnformerVeff',
+    'tissue_mapper': 'from kipoi_enformer.enformer import EnformerTissueMapper',
+}
+
+SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'time': elapsed, 'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'modules': [x for x in {heavy_modules!r} if x in sys.modules]}}))
+"""
+
+
+def measure(statement: str) -> dict:
+    script = SCRIPT.format(statement=statement, heavy_modules=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main(repeats: int = 3):
+    print(f'repeats={repeats}')
+    failed = []
+    for name, statement in STAGES.items():
+        results = [measure(statement) for _ in range(repeats)]
+        elapsed = min(x['time'] for x in results)
+        max_rss = min(x['max_rss'] for x in results)
+        modules = results[0]['modules']
+        print(f'{name:>14}: {elapsed:8.3f}s, {max_rss / 2 ** 10:8.1f} MiB max RSS, heavy modules: {modules}')
+        if len(modules) > 0:
+            failed.append(name)
+    if len(failed) > 0:
+        print(f'Heavy modules are imported by: {failed}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,45 @@
+"""
+Benchmark the execution of the model.
+
+Compares the eager execution, which copies the full model output to the host before extracting the output bins
+and tracks, with the compiled tf.function of Enformer._run_model, optionally compiled with XLA.
+Reports the compile time, the steady-state latency and the memory copied to the host per record.
+The RandomModel cannot be compiled with XLA and falls back to the graph without XLA.
+
+Usage: python benchmarks/benchmark_model_execution.py [batch_size] [num_output_bins] [num_tracks] [repeats]
+"""
+import sys
+import time
+import numpy as np
+from kipoi_enformer.enformer import Enformer
+
+
+def benchmark(enformer: Enformer, sequences: np.ndarray, num_output_bins: int, tracks: list[int], repeats: int):
+    # the first call traces and compiles the function
+    start = time.perf_counter()
+    enformer._run_model(sequences, num_output_bins, tracks)
+    first_call = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        enformer._run_model(sequences, num_output_bins, tracks)
+    latency = (time.perf_counter() - start) / repeats
+    host_bytes = enformer.model_stats['host_bytes'] / enformer.model_stats['num_records']
+    return first_call, latency, host_bytes
+
+
+def main(batch_size: int = 2, num_output_bins: int = 21, num_tracks: int = 100, repeats: int = 3):
+    sequences = np.zeros((batch_size, 3, Enformer.INPUT_SEQUENCE_LENGTH, 4), dtype=np.float32)
+    tracks = list(range(num_tracks))
+
+    print(f'batch_size={batch_size}, num_output_bins={num_output_bins}, num_tracks={num_tracks}, repeats={repeats}')
+    for name, kwargs in [('eager', dict(compiled=False)), ('compiled', dict(compiled=True)),
+                         ('xla', dict(jit_compile=True))]:
+        enformer = Enformer(is_random=True, **kwargs)
+        first_call, latency, host_bytes = benchmark(enformer, sequences, num_output_bins, tracks, repeats)
+        print(f'{name:>10}: first call {first_call:8.3f}s, {latency:8.3f}s per batch, '
+              f'{batch_size / latency:8.2f} records/s, {host_bytes / 2 ** 20:8.2f} MiB per record to host')
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,58 @@
+"""
+Benchmark the conversion of raw enformer predictions to pyarrow.
+
+Compares the previous conversion through nested python lists with the zero-copy conversion
+of Enformer._to_pyarrow on predictions of the RandomModel.
+
+Usage: python benchmarks/benchmark_to_pyarrow.py [batch_size] [num_output_bins] [repeats]
+"""
+import sys
+import time
+import numpy as np
+import pyarrow as pa
+from kipoi_enformer.enformer import Enformer
+
+
+def to_pyarrow_pylist(results: dict):
+    """
+    The previous conversion, which goes through nested python lists.
+    """
+    metadata = {k: pa.array(v.tolist()) for k, v in results['metadata'].items()}
+    formatted_results = {
+        'tracks': pa.array(results['tracks'].tolist(), type=pa.list_(pa.list_(pa.list_(pa.float32())))),
+        **metadata
+    }
+    return pa.RecordBatch.from_arrays(list(formatted_results.values()), names=list(formatted_results.keys()))
+
+
+def make_batch(batch_size: int, num_shifts: int = 3):
+    sequences = np.zeros((batch_size, num_shifts, 393_216, 4), dtype=np.float32)
+    metadata = {
+        'tss': np.arange(batch_size, dtype=np.int64),
+        'strand': np.array(['+'] * batch_size),
+        'transcript_id': np.array([f'ENST{i:011d}' for i in range(batch_size)]),
+    }
+    return {'sequences': sequences, 'metadata': metadata}
+
+
+def benchmark(convert_fn, results: dict, repeats: int):
+    batch_size = len(results['metadata']['tss'])
+    start = time.perf_counter()
+    for _ in range(repeats):
+        convert_fn(results)
+    elapsed = time.perf_counter() - start
+    return batch_size * repeats / elapsed
+
+
+def main(batch_size: int = 2, num_output_bins: int = 21, repeats: int = 3):
+    enformer = Enformer(is_random=True)
+    results = enformer._process_batch(make_batch(batch_size), num_output_bins=num_output_bins)
+    assert to_pyarrow_pylist(results).equals(Enformer._to_pyarrow(results))
+
+    print(f'batch_size={batch_size}, num_output_bins={num_output_bins}, repeats={repeats}')
+    for name, convert_fn in [('pylist', to_pyarrow_pylist), ('zero-copy', Enformer._to_pyarrow)]:
+        print(f'{name:>10}: {benchmark(convert_fn, results, repeats):10.2f} records/s')
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
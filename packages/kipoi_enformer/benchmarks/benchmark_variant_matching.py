@@ -0,0 +1,64 @@
+"""
+Benchmark the matching of variants and TSS windows in VCFTSSDataloader.
+
+Compares kipoiseq's SingleVariantMatcher with the sorted sweep of match_variants on synthetic VCF files
+with increasing numbers of random SNVs on chr22. Run from the repository root.
+
+Usage: python benchmarks/benchmark_variant_matching.py [max_variants] [upstream_tss] [downstream_tss]
+"""
+import sys
+import tempfile
+import time
+import pathlib
+import numpy as np
+from kipoi_enformer.dataloader import VCFTSSDataloader
+
+CHR22_LENGTH = 50_818_468
+
+
+def write_vcf(path: pathlib.Path, num_variants: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    positions = np.sort(rng.integers(10_000_000, CHR22_LENGTH, num_variants))
+    bases = np.array(list('ACGT'))
+    refs = bases[rng.integers(0, 4, num_variants)]
+    alts = bases[(np.searchsorted(bases, refs) + rng.integers(1, 4, num_variants)) % 4]
+    with open(path, 'w') as f:
+        f.write('##fileformat=VCFv4.2\n')
+        f.write(f'##contig=<ID=chr22,length={CHR22_LENGTH}>\n')
+        f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for pos, ref, alt in zip(positions, refs, alts):
+            f.write(f'chr22\t{pos}\t.\t{ref}\t{alt}\t.\t.\t.\n')
+
+
+def benchmark(vcf_file: pathlib.Path, matcher: str, upstream_tss: int, downstream_tss: int):
+    dl = VCFTSSDataloader(fasta_file='example_files/seq.fa', gtf='example_files/annot.gtf.gz', vcf_file=vcf_file,
+                          variant_upstream_tss=upstream_tss, variant_downstream_tss=downstream_tss, matcher=matcher)
+    start = time.perf_counter()
+    matches = dl._get_matches()
+    return time.perf_counter() - start, matches
+
+
+def main(max_variants: int = 100_000, upstream_tss: int = 5_000, downstream_tss: int = 5_000):
+    print(f'upstream_tss={upstream_tss}, downstream_tss={downstream_tss}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        num_variants = 1_000
+        while num_variants <= max_variants:
+            vcf_file = pathlib.Path(tmp_dir) / f'{num_variants}.vcf'
+            write_vcf(vcf_file, num_variants)
+            results = {}
+            for matcher in ['kipoiseq', 'sweep']:
+                elapsed, matches = benchmark(vcf_file, matcher, upstream_tss, downstream_tss)
+                results[matcher] = elapsed
+                # the matchers order the matches differently
+                matches = matches.sort_by([(x, 'ascending') for x in VCFTSSDataloader.MATCH_COLUMNS])
+                if matcher == 'kipoiseq':
+                    expected_matches = matches
+                else:
+                    assert matches.equals(expected_matches)
+            print(f'{num_variants:>10} variants, {len(matches):>10} matches: '
+                  f'kipoiseq {results["kipoiseq"]:8.3f}s, sweep {results["sweep"]:8.3f}s')
+            num_variants *= 10
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
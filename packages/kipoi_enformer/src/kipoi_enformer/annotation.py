@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import pathlib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from kipoi_enformer.logger import logger
+from kipoi_enformer.utils import gtf_to_pandas, file_content_hash
+
+__all__ = ['ANNOTATION_CACHE_ENV', 'ANNOTATION_COLUMNS', 'get_annotation_cache_dir', 'load_annotation']
+
+# environment variable of the annotation cache directory
+ANNOTATION_CACHE_ENV = 'KIPOI_ENFORMER_ANNOTATION_CACHE_DIR'
+# the columns of the transcripts that are cached
+ANNOTATION_COLUMNS = ['Chromosome', 'Feature', 'Start', 'End', 'Strand', 'gene_id', 'transcript_id', 'gene_type',
+                      'tag']
+
+
+def get_annotation_cache_dir(cache_dir: str | pathlib.Path | None = None) -> pathlib.Path:
+    """
+    Get the directory of the annotation cache.
+    :param cache_dir: The cache directory. If None, the directory in the environment variable
+    KIPOI_ENFORMER_ANNOTATION_CACHE_DIR or ~/.cache/kipoi_enformer/annotation is used.
+    :return: The directory
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get(ANNOTATION_CACHE_ENV) or (pathlib.Path.home() / '.cache/kipoi_enformer/annotation')
+    return pathlib.Path(cache_dir)
+
+
+def load_annotation(gtf: str | pathlib.Path, cache_dir: str | pathlib.Path | None = None,
+                    use_cache: bool = True) -> pd.DataFrame:
+    """
+    Load the transcripts of a GTF file with the columns in ANNOTATION_COLUMNS.
+    The GTF file is parsed once and the transcripts are cached as an Arrow file, keyed by the hash of the
+    content of the GTF file. Later calls read the cached file instead of parsing the GTF file.
+    If the cache directory is not writable, the transcripts are parsed without caching them.
+    :param gtf: Path to GTF file
+    :param cache_dir: The cache directory, see get_annotation_cache_dir
+    :param use_cache: If False, the GTF file is parsed without reading or writing the cache
+    :return: pandas DataFrame with one row per transcript
+    """
+    if not use_cache:
+        return _to_pandas(_parse_annotation(gtf))
+    key = json.dumps([file_content_hash(gtf), ANNOTATION_COLUMNS])
+    path = get_annotation_cache_dir(cache_dir) / f'{hashlib.sha256(key.encode()).hexdigest()}.arrow'
+    if path.exists():
+        return _to_pandas(pa.ipc.open_file(pa.memory_map(str(path))).read_all())
+    table = _parse_annotation(gtf)
+    # write to a temporary file first so that concurrent readers never see partial files
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        logger.debug(f'Caching the transcripts of {gtf} in {path}')
+        with pa.OSFile(str(tmp_path), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f'Could not cache the transcripts of {gtf} in {path.parent}: {e}')
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return _to_pandas(table)
+
+
+def _parse_annotation(gtf: str | pathlib.Path) -> pa.Table:
+    annotation = gtf_to_pandas(gtf)
+    annotation = annotation.query("`Feature` == 'transcript'")
+    annotation = annotation[[x for x in ANNOTATION_COLUMNS if x in annotation.columns]]
+    return pa.Table.from_pandas(annotation, preserve_index=False)
+
+
+def _to_pandas(table: pa.Table) -> pd.DataFrame:
+    # missing attributes are NaN as in the parsed GTF file
+    return table.to_pandas().fillna(np.nan)
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import pathlib
+from collections import Counter
+import numpy as np
+from kipoi_enformer.logger import logger
+
+__all__ = ['PredictionCache', 'InputDeduplicator']
+
+
+class PredictionCache:
+    """
+    Content-addressed on-disk cache of the enformer predictions of single records.
+    The predictions are stored as numpy files named after the hash of the record's input key
+    and a namespace, which contains everything else that determines the predictions
+    (e.g. the model, the FASTA file, the shifts and the number of output bins).
+    """
+
+    def __init__(self, path: str | pathlib.Path):
+        """
+        :param path: The cache directory
+        """
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(namespace: dict, input_key: tuple) -> str:
+        """
+        Get the cache key of a record.
+        :param namespace: JSON-serializable dictionary of the settings that determine the predictions
+        :param input_key: The input key of the record, see Dataloader.extract_sequences
+        :return: hex digest
+        """
+        content = json.dumps([namespace, list(input_key)], sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get(self, key: str) -> np.ndarray | None:
+        """
+        Load the predictions of a record.
+        :param key: The cache key of the record
+        :return: The predictions or None if the record is not cached
+        """
+        path = self._path(key)
+        if not path.exists():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.load(path)
+
+    def put(self, key: str, predictions: np.ndarray):
+        """
+        Store the predictions of a record.
+        :param key: The cache key of the record
+        :param predictions: The predictions of the record
+        """
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        # write to a temporary file first so that concurrent readers never see partial files
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, predictions)
+        os.replace(tmp_path, path)
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        if total > 0:
+            logger.info(f'Prediction cache {self.path}: {self.hits}/{total} hits ({self.hits / total:.1%})')
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.path / key[:2] / f'{key}.npy'
+
+
+class InputDeduplicator:
+    """
+    Reuse the predictions of records with the same input key, e.g. transcripts sharing a TSS.
+    The predictions of an input are kept in memory from its first until its last occurrence,
+    so the records must be processed in the order in which they were counted. At most max_pending
+    inputs are kept at once, the later occurrences of other duplicated inputs are predicted again.
+    The batches are assembled ahead of their predictions (see plan), the planning replays the decisions of put.
+    """
+
+    def __init__(self, input_counts: Counter, max_pending: int | None = None):
+        """
+        :param input_counts: The number of records per input key, see Dataloader.count_inputs
+        :param max_pending: The maximum number of inputs whose predictions are kept at once. If None, unbounded.
+        """
+        assert max_pending is None or max_pending >= 0
+        self.num_records = sum(input_counts.values())
+        self.num_unique = len(input_counts)
+        self.max_pending = max_pending
+        # only inputs that occur more than once need to be kept
+        self.duplicates = frozenset(k for k, v in input_counts.items() if v > 1)
+        self._remaining = Counter({k: input_counts[k] for k in self.duplicates})
+        self._predictions = {}
+        # the same bookkeeping for the planned records
+        self._planned_remaining = Counter(self._remaining)
+        self._planned = set()
+
+    @property
+    def ratio(self) -> float:
+        """
+        The number of records per unique input.
+        """
+        return self.num_records / self.num_unique if self.num_unique > 0 else 1.
+
+    def _register(self, remaining: Counter, kept, input_key: tuple) -> tuple[bool, bool]:
+        """
+        Register an occurrence of an input.
+        :param remaining: The number of remaining occurrences per duplicated input
+        :param kept: The inputs whose predictions are kept
+        :param input_key: The input key of the record
+        :return: Whether the predictions of the input are kept before and after this occurrence
+        """
+        if input_key not in remaining:
+            return False, False
+        was_kept = input_key in kept
+        remaining[input_key] -= 1
+        if remaining[input_key] == 0:
+            del remaining[input_key]
+            return was_kept, False
+        return was_kept, was_kept or self.max_pending is None or len(kept) < self.max_pending
+
+    def plan(self, input_key: tuple) -> bool:
+        """
+        Register an occurrence of an input when its batch is assembled. Must be called once for every record,
+        in the same order as put.
+        :param input_key: The input key of the record
+        :return: True if the predictions of the input are provided by get, i.e. it does not have to be predicted
+        """
+        was_kept, is_kept = self._register(self._planned_remaining, self._planned, input_key)
+        if is_kept:
+            self._planned.add(input_key)
+        else:
+            self._planned.discard(input_key)
+        return was_kept
+
+    def get(self, input_key: tuple) -> np.ndarray | None:
+        """
+        Get the predictions of an input that occurred before.
+        :param input_key: The input key of the record
+        :return: The predictions or None if the predictions of the input are not kept
+        """
+        return self._predictions.get(input_key)
+
+    def put(self, input_key: tuple, predictions: np.ndarray):
+        """
+        Register an occurrence of an input. Must be called once for every record.
+        :param input_key: The input key of the record
+        :param predictions: The predictions of the record
+        """
+        was_kept, is_kept = self._register(self._remaining, self._predictions, input_key)
+        if is_kept and not was_kept:
+            # copy to not keep the whole batch alive
+            self._predictions[input_key] = predictions.copy()
+        elif was_kept and not is_kept:
+            del self._predictions[input_key]
+
+    def log_stats(self):
+        logger.info(f'{self.num_records} records with {self.num_unique} unique inputs '
+                    f'(dedup ratio {self.ratio:.2f})')
@@ -0,0 +1,132 @@
+import json
+import os
+import pathlib
+import pyarrow as pa
+import pyarrow.parquet as pq
+from kipoi_enformer.logger import logger
+
+__all__ = ['PredictionCheckpoint']
+
+
+class PredictionCheckpoint:
+    """
+    Checkpoint of a prediction run.
+    Every batch is committed as one part file per output, followed by a line in the manifest with the
+    record range [start, end) of the batch. A restarted run continues after the last committed record.
+    """
+    CONFIG_FILE = 'config.json'
+    MANIFEST_FILE = 'manifest.jsonl'
+
+    def __init__(self, path: str | pathlib.Path, config: dict, output_names: list[str]):
+        """
+        :param path: The checkpoint directory
+        :param config: JSON-serializable configuration of the run. Resuming requires the same configuration.
+        :param output_names: The names of the outputs written for every batch
+        """
+        self.path = pathlib.Path(path)
+        self.output_names = output_names
+        self.config = json.loads(json.dumps({**config, 'outputs': output_names}))
+        self.completed = []
+
+        config_path = self.path / self.CONFIG_FILE
+        if config_path.exists():
+            with open(config_path) as f:
+                checkpoint_config = json.load(f)
+            if checkpoint_config != self.config:
+                mismatch = sorted(k for k in set(checkpoint_config) | set(self.config)
+                                  if checkpoint_config.get(k) != self.config.get(k))
+                raise ValueError(f'The configuration does not match the checkpoint in {self.path}: {mismatch}')
+            self.completed = self._read_manifest()
+            # drop a partially written line of an interrupted commit
+            self._write_atomic(self.path / self.MANIFEST_FILE,
+                               ''.join(json.dumps({'start': start, 'end': end}) + '\n'
+                                       for start, end in self.completed))
+            logger.info(f'Resuming from checkpoint {self.path} after {self.num_completed} records')
+        else:
+            for name in output_names:
+                (self.path / name).mkdir(parents=True, exist_ok=True)
+            self._write_atomic(config_path, json.dumps(self.config, indent=2))
+            self._write_atomic(self.path / self.MANIFEST_FILE, '')
+
+    @property
+    def num_completed(self) -> int:
+        """
+        The number of consecutive records from the start of the dataloader that have been committed.
+        """
+        return self.completed[-1][1] if len(self.completed) > 0 else 0
+
+    def commit(self, tables: list[pa.Table | pa.RecordBatch], start: int, end: int):
+        """
+        Commit the outputs of the records [start, end).
+        :param tables: The tables of the batch, in the order of output_names
+        :param start: The index of the first record of the batch
+        :param end: The index after the last record of the batch
+        """
+        assert start == self.num_completed, f'batches must be committed in order, expected start {self.num_completed}'
+        for name, table in zip(self.output_names, tables):
+            if isinstance(table, pa.RecordBatch):
+                table = pa.Table.from_batches([table])
+            part_path = self._part_path(name, start)
+            tmp_path = part_path.with_suffix('.tmp')
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, part_path)
+
+        with open(self.path / self.MANIFEST_FILE, 'a') as f:
+            f.write(json.dumps({'start': start, 'end': end}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.completed.append((start, end))
+
+    def merge(self, name: str, output_path: str | pathlib.Path, schema: pa.Schema):
+        """
+        Merge the committed part files of an output into a single parquet file.
+        :param name: The name of the output
+        :param output_path: The parquet file to write
+        :param schema: The schema of the output
+        """
+        logger.debug(f'Merging the checkpoint parts of {name} into {output_path}')
+        with pq.ParquetWriter(output_path, schema) as writer:
+            for start, _ in self.completed:
+                part = pq.ParquetFile(self._part_path(name, start))
+                for i in range(part.num_row_groups):
+                    writer.write_table(part.read_row_group(i))
+
+    def remove(self):
+        """
+        Remove the files of the checkpoint. The directory is only removed if it is empty afterwards.
+        """
+        for name in self.output_names:
+            for part_path in (self.path / name).glob('part-*'):
+                part_path.unlink()
+            _rmdir_if_empty(self.path / name)
+        (self.path / self.MANIFEST_FILE).unlink()
+        (self.path / self.CONFIG_FILE).unlink()
+        _rmdir_if_empty(self.path)
+
+    def _part_path(self, name: str, start: int) -> pathlib.Path:
+        return self.path / name / f'part-{start:012d}.parquet'
+
+    def _read_manifest(self):
+        completed = []
+        with open(self.path / self.MANIFEST_FILE) as f:
+            for line in f:
+                # a partially written last line belongs to a batch that was not committed
+                if not line.endswith('\n'):
+                    break
+                entry = json.loads(line)
+                assert entry['start'] == (completed[-1][1] if len(completed) > 0 else 0), \
+                    f'the manifest of {self.path} is not contiguous'
+                completed.append((entry['start'], entry['end']))
+        return completed
+
+    @staticmethod
+    def _write_atomic(path: pathlib.Path, content: str):
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+
+def _rmdir_if_empty(path: pathlib.Path):
+    if path.exists() and not any(path.iterdir()):
+        path.rmdir()
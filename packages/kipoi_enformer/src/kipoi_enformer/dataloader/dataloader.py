@@ -1,17 +1,30 @@
 from abc import ABC, abstractmethod
 
 from kipoi.data import SampleGenerator
+from kipoi_utils.data_utils import batch_gen
 import pyarrow as pa
 import math
+import copy
 import pandas as pd
+import numpy as np
+from collections import Counter
 from kipoiseq.extractors import VariantSeqExtractor, FastaStringExtractor
 from kipoiseq import Interval, Variant
 from kipoiseq.transforms.functional import one_hot_dna
-from kipoi_enformer.utils import gtf_to_pandas
+from pyfaidx import complement
+from kipoi_enformer.utils import has_tag
+from kipoi_enformer.annotation import load_annotation
+from kipoi_enformer.genome import EncodedGenome, N_CODE
+from kipoi_enformer.logger import logger
+
+# the dtypes of the sequence buffers, see SequenceBuffers
+SEQUENCE_DTYPES = ('float32', 'uint8')
+# the scale of the one-hot encoding in integer buffers, N is encoded as 1
+ONE_HOT_SCALE = 4
 
 
 class Dataloader(SampleGenerator, ABC):
-    def __init__(self, fasta_file, size: int = None, *args, **kwargs):
+    def __init__(self, fasta_file, size: int = None, *args, genome_dir: str | None = None, **kwargs):
         """
 
         :param fasta_file: Fasta file with the reference genome
@@ -20,29 +33,65 @@ class Dataloader(SampleGenerator, ABC):
         :param seq_length: The length of the sequence to return. This should be the length of the Enformer input sequence.
         :param shift: For each sequence, we have 3 shifts, -shift, 0, shift, in relation to a reference point.
         :param size: The number of samples to return. If None, all samples are returned.
+        :param genome_dir: The directory of the encoded fasta_file, see kipoi_enformer.genome.encode_genome.
+        If provided, the reference sequences are extracted from the encoded genome.
         :param canonical_only: If True, only Ensembl canonical transcripts are extracted from the genome annotation
         :param protein_coding_only: If True, only protein coding transcripts are extracted from the genome annotation
         :param gene_ids: If provided, only the gene with this ID is extracted from the genome annotation
         """
 
         super().__init__(*args, **kwargs)
+        self._fasta_file = fasta_file
         self._reference_sequence = FastaStringExtractor(fasta_file, use_strand=True)
         if not self._reference_sequence.use_strand:
             raise ValueError(
                 "Reference sequence fetcher does not use strand but this is needed to obtain correct sequences!")
+        self._encoded_genome = None if genome_dir is None else EncodedGenome(genome_dir, fasta_file=fasta_file)
         self._size = size
+        # index of the first record, see select_records
+        self._offset = 0
 
     @abstractmethod
     def __len__(self):
         raise NotImplementedError("The length of the dataset is not known.")
 
     @abstractmethod
-    def _sample_gen(self):
+    def _record_gen(self, start: int = 0):
         """
-        Generate samples for the dataset. The generator should return a tuple of metadata and sequences.
+        Generate the records of the dataset without extracting their sequences.
+        The generator should return a tuple of metadata and input key. The input key is a hashable and
+        JSON-serializable tuple that determines the sequences of the record, see extract_sequences.
+        :param start: The index of the first record
         :return:
         """
-        raise NotImplementedError("The sample generator is not implemented.")
+        raise NotImplementedError("The record generator is not implemented.")
+
+    @abstractmethod
+    def extract_sequences(self, input_key: tuple, out: np.ndarray | None = None) -> np.ndarray:
+        """
+        Extract the one-hot encoded sequences of a record.
+        :param input_key: The input key of the record
+        :param out: If provided, the sequences are written into this array instead of a new one, see stack_sequences
+        :return: numpy array of shape (shifts, seq_length, 4)
+        """
+        raise NotImplementedError("The sequence extraction is not implemented.")
+
+    def _sample_gen(self, start: int = 0):
+        """
+        Generate samples for the dataset. The generator returns a tuple of metadata and sequences.
+        :param start: The index of the first sample. The sequences of the skipped samples are not extracted.
+        :return:
+        """
+        for metadata, input_key in self.iter_records(start=start):
+            yield metadata, self.extract_sequences(input_key)
+
+    @property
+    def config(self) -> dict:
+        """
+        Get the configuration of the dataloader, which determines the generated samples.
+        :return: JSON-serializable dictionary
+        """
+        return {'fasta_file': str(self._fasta_file), 'size': self._size, 'offset': self._offset}
 
     @property
     @abstractmethod
@@ -62,20 +111,194 @@ class Dataloader(SampleGenerator, ABC):
             - sequences:
             - metadata:
         """
-        counter = 0
-        for metadata, sequences in self._sample_gen():
+        return self.iter_samples()
+
+    def batch_iter(self, batch_size=32, start: int = 0, **kwargs):
+        """
+        Iterate over batches of the dataset.
+        :param batch_size: The number of samples per batch
+        :param start: The index of the first sample
+        :return: Iterator over the batches
+        """
+        return batch_gen(self.iter_samples(start=start), batch_size=batch_size)
+
+    def iter_samples(self, start: int = 0):
+        """
+        Iterate over the dataset starting at a given sample. The skipped samples are not extracted.
+        :param start: The index of the first sample
+        :return: Iterator over the dataset
+        """
+        for metadata, input_key in self.iter_records(start=start):
+            yield {
+                "sequences": self.extract_sequences(input_key),
+                "metadata": metadata
+            }
+
+    def iter_records(self, start: int = 0):
+        """
+        Iterate over the records of the dataset without extracting their sequences.
+        :param start: The index of the first record
+        :return: Iterator over tuples of metadata and input key
+        """
+        counter = start
+        for metadata, input_key in self._record_gen(start=self._offset + start):
             # check if we reached the end of the dataset
             if self._size is not None and counter == self._size:
                 break
             counter += 1
+            yield metadata, input_key
 
-            yield {
-                "sequences": sequences,
-                "metadata": metadata
-            }
+    def count_inputs(self, start: int = 0) -> Counter:
+        """
+        Count the records of the dataset by their input key. Records with the same input key have identical
+        sequences, e.g. transcripts sharing a TSS.
+        :param start: The index of the first record
+        :return: Counter of the input keys
+        """
+        return Counter(input_key for _, input_key in self.iter_records(start=start))
+
+    def select_records(self, start: int, end: int):
+        """
+        Get a copy of the dataloader that only returns the records [start, end) of this dataloader.
+        :param start: The index of the first record
+        :param end: The index after the last record
+        :return: Dataloader
+        """
+        dataloader = copy.copy(self)
+        dataloader._select_records(start, end)
+        return dataloader
 
+    def _select_records(self, start: int, end: int):
+        """
+        Restrict this dataloader to the records [start, end), see select_records.
+        """
+        assert 0 <= start <= end <= len(self), f'invalid record range [{start}, {end}) for {len(self)} records'
+        self._offset = self._offset + start
+        self._size = end - start
+
+    def shard_bounds(self, num_shards: int) -> list[int]:
+        """
+        Split the records into contiguous shards whose numbers of records differ by at most one.
+        The split only depends on the number of records, so every process computes the same shards.
+        The records are not iterated, but the number of records of VCFTSSDataloader requires the variant matches,
+        see VCFTSSDataloader.persist_matches.
+        :param num_shards: The number of shards
+        :return: The num_shards + 1 record indices that bound the shards
+        """
+        assert num_shards > 0
+        num_records = len(self)
+        return [i * num_records // num_shards for i in range(num_shards + 1)]
+
+    def shard_sizes(self, num_shards: int) -> list[int]:
+        """
+        Get the number of records of every shard, see shard_bounds.
+        :param num_shards: The number of shards
+        :return: The number of records of each shard
+        """
+        bounds = self.shard_bounds(num_shards)
+        return [end - start for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def select_shard(self, shard_index: int, num_shards: int):
+        """
+        Get a copy of the dataloader that only returns the records of a shard, see shard_bounds.
+        :param shard_index: The index of the shard, e.g. the index of a task of a job array
+        :param num_shards: The number of shards
+        :return: Dataloader
+        """
+        dataloader = copy.copy(self)
+        dataloader._select_shard(shard_index, num_shards)
+        return dataloader
 
-def get_tss_from_genome_annotation(gtf: pd.DataFrame | str, chromosome: str | None = None,
+    def _select_shard(self, shard_index: int, num_shards: int):
+        """
+        Restrict this dataloader to the records of a shard, see select_shard.
+        """
+        assert 0 <= shard_index < num_shards, f'shard_index must be in [0, {num_shards}) but got {shard_index}'
+        if num_shards == 1:
+            # the records are not counted, e.g. the variants of VCFTSSDataloader are matched lazily
+            return
+        bounds = self.shard_bounds(num_shards)
+        self._select_records(bounds[shard_index], bounds[shard_index + 1])
+
+    def __getstate__(self):
+        # the FASTA file handle cannot be pickled, it is reopened after unpickling
+        state = self.__dict__.copy()
+        del state['_reference_sequence']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reference_sequence = FastaStringExtractor(self._fasta_file, use_strand=True)
+
+
+class SequenceBuffers:
+    """
+    Preallocated buffers of shape (batch_size, shifts, seq_length, 4) into which the sequences of the batches are
+    extracted directly. The buffers are reused round-robin, so the sequences of a batch stay valid until
+    num_buffers further batches are filled.
+    """
+
+    def __init__(self, batch_size: int, num_shifts: int, seq_length: int, dtype: str = 'float32',
+                 num_buffers: int = 1):
+        """
+        :param batch_size: The maximum number of records per batch
+        :param num_shifts: The number of shifted sequences per record
+        :param seq_length: The length of the sequences
+        :param dtype: The dtype of the buffers, one of SEQUENCE_DTYPES. uint8 buffers hold the one-hot encoding
+        scaled by ONE_HOT_SCALE and take a quarter of the memory, see to_float_sequences.
+        :param num_buffers: The number of batches that are used at the same time
+        """
+        assert dtype in SEQUENCE_DTYPES, f'dtype must be one of {SEQUENCE_DTYPES}'
+        assert num_buffers > 0
+        self.shape = (batch_size, num_shifts, seq_length, 4)
+        self.dtype = np.dtype(dtype)
+        self._buffers = [None] * num_buffers
+        self._next = 0
+
+    def fill(self, dataloader: Dataloader, input_keys: list[tuple]) -> np.ndarray:
+        """
+        Extract the sequences of the inputs into the next buffer.
+        :param dataloader: The dataloader extracting the sequences
+        :param input_keys: The input keys, at most batch_size
+        :return: view of the buffer of shape (len(input_keys), shifts, seq_length, 4)
+        """
+        assert len(input_keys) <= self.shape[0]
+        # allocate lazily, e.g. no buffers are needed if all predictions are cached
+        if self._buffers[self._next] is None:
+            self._buffers[self._next] = np.empty(self.shape, dtype=self.dtype)
+        buffer = self._buffers[self._next]
+        self._next = (self._next + 1) % len(self._buffers)
+        for out, input_key in zip(buffer, input_keys):
+            dataloader.extract_sequences(input_key, out=out)
+        return buffer[:len(input_keys)]
+
+
+def stack_sequences(sequences: list[np.ndarray], out: np.ndarray | None = None) -> np.ndarray:
+    """
+    Stack the one-hot encoded sequences of the shifts of a record.
+    :param sequences: list of float numpy arrays of shape (seq_length, 4)
+    :param out: If provided, the sequences are written into this array of shape (shifts, seq_length, 4).
+    An integer array holds the one-hot encoding scaled by ONE_HOT_SCALE, so that N (0.25) stays exact.
+    :return: numpy array of shape (shifts, seq_length, 4)
+    """
+    if out is None or not np.issubdtype(out.dtype, np.integer):
+        return np.stack(sequences, out=out)
+    for x, seq in zip(out, sequences, strict=True):
+        np.multiply(seq, ONE_HOT_SCALE, out=x, casting='unsafe')
+    return out
+
+
+def to_float_sequences(sequences: np.ndarray) -> np.ndarray:
+    """
+    Convert sequences extracted into an integer buffer (see stack_sequences) to the float32 one-hot encoding.
+    Float32 sequences are returned as they are.
+    """
+    if np.issubdtype(sequences.dtype, np.integer):
+        return np.multiply(sequences, np.float32(1 / ONE_HOT_SCALE), dtype=np.float32)
+    return sequences
+
+
+def get_tss_from_genome_annotation(gtf: pd.DataFrame | str, chromosome: str | list[str] | None = None,
                                    protein_coding_only: bool = False, canonical_only: bool = False,
                                    gene_ids: list | None = None):
     """
@@ -84,43 +307,39 @@ def get_tss_from_genome_annotation(gtf: pd.DataFrame | str, chromosome: str | No
     """
     roi = get_roi_from_genome_annotation(gtf, chromosome, protein_coding_only, canonical_only, gene_ids)
 
-    def adjust_row(row):
-        if row.Strand == '-':
-            # convert 1-based to 0-based
-            tss = row.End - 1
-        else:
-            tss = row.Start
-
-        row.Start = tss
-        row.End = tss + 1
-        return row
     if len(roi) > 0:
-        roi = roi.apply(adjust_row, axis=1)
-        roi['tss'] = roi["Start"]
+        # convert 1-based to 0-based on the negative strand
+        tss = np.where(roi['Strand'] == '-', roi['End'] - 1, roi['Start']).astype(np.int64)
+        # the rewritten columns keep the types of the previous row-wise implementation, e.g. Strand is not categorical
+        roi = roi.assign(Start=tss, End=tss + 1, tss=tss, Strand=roi['Strand'].astype(object))
     return roi
 
 
-def get_roi_from_genome_annotation(gtf: pd.DataFrame | str, chromosome: str | None = None,
+def get_roi_from_genome_annotation(gtf: pd.DataFrame | str, chromosome: str | list[str] | None = None,
                                    protein_coding_only: bool = False, canonical_only: bool = False,
                                    gene_ids: list | None = None):
     """
     Get ROI from genome annotation
+    :param gtf: GTF file, whose transcripts are loaded through the annotation cache, or DataFrame with genome
+    annotation
+    :param chromosome: The chromosome or the list of chromosomes to filter for. If None, all chromosomes are kept.
     :return: filtered genome_annotation
     """
     if not isinstance(gtf, pd.DataFrame):
-        genome_annotation = gtf_to_pandas(gtf)
-    else:
-        genome_annotation = gtf.copy()
+        gtf = load_annotation(gtf)
+    # the filters return new data frames, gtf is not modified
+    roi = gtf.query("`Feature` == 'transcript'")
     if gene_ids is not None:
-        genome_annotation = genome_annotation[genome_annotation['gene_id'].str.contains('|'.join(gene_ids))]
-    if chromosome is not None:
-        genome_annotation = genome_annotation.query("`Chromosome` == @chromosome")
-    roi = genome_annotation.query("`Feature` == 'transcript'")
+        roi = roi[roi['gene_id'].str.contains('|'.join(gene_ids))]
+    if isinstance(chromosome, str):
+        roi = roi.query("`Chromosome` == @chromosome")
+    elif chromosome is not None:
+        roi = roi[roi['Chromosome'].isin(chromosome)]
     if protein_coding_only:
         roi = roi.query("`gene_type` == 'protein_coding'")
     if canonical_only:
         # check if Ensembl_canonical is in the set of tags
-        roi = roi[roi['tag'].apply(lambda x: False if pd.isna(x) else ('Ensembl_canonical' in x.split(',')))]
+        roi = roi[has_tag(roi['tag'], 'Ensembl_canonical')]
     if len(roi) > 0:
         roi = roi.assign(
             transcript_start=roi["Start"],
@@ -130,6 +349,80 @@ def get_roi_from_genome_annotation(gtf: pd.DataFrame | str, chromosome: str | No
     return roi
 
 
+def get_tss_windows(genome_annotation: pd.DataFrame, upstream_tss: int, downstream_tss: int):
+    """
+    Get the windows around the TSS in which variants are matched, like pyranges' extend of the TSS.
+    :param genome_annotation: The TSS, see get_tss_from_genome_annotation
+    :param upstream_tss: The number of bases upstream the TSS
+    :param downstream_tss: The number of bases downstream the TSS
+    :return: numpy arrays of the 0-based start and the end of each window
+    """
+    strand = genome_annotation['Strand'].to_numpy()
+    start = genome_annotation['Start'].to_numpy(dtype=np.int64)
+    end = genome_annotation['End'].to_numpy(dtype=np.int64)
+    start = start - np.where(strand == '+', upstream_tss, np.where(strand == '-', downstream_tss, 0))
+    end = end + np.where(strand == '+', downstream_tss, np.where(strand == '-', upstream_tss, 0))
+    return start, end
+
+
+def read_vcf_variants(vcf_file) -> pd.DataFrame:
+    """
+    Read the variants of a VCF file like kipoiseq's MultiSampleVCF. Every ALT allele is a variant,
+    alleles with N or * are skipped.
+    :return: DataFrame with the columns chrom, pos (1-based), ref and alt in the order of the VCF file
+    """
+    from cyvcf2 import VCF
+
+    columns = {'chrom': [], 'pos': [], 'ref': [], 'alt': []}
+    for record in VCF(str(vcf_file)):
+        for alt in record.ALT or ['']:
+            if 'N' in alt or '*' in alt:
+                logger.warning(f'Undefined variant {record.CHROM}:{record.POS}:{record.REF}>{alt} is not supported: '
+                               f'Skip')
+                continue
+            columns['chrom'].append(record.CHROM)
+            columns['pos'].append(record.POS)
+            columns['ref'].append(record.REF)
+            columns['alt'].append(alt)
+    return pd.DataFrame(columns).astype({'pos': np.int64})
+
+
+def match_variants(variant_chroms: np.ndarray, variant_starts: np.ndarray, variant_ends: np.ndarray,
+                   window_chroms: np.ndarray, window_starts: np.ndarray, window_ends: np.ndarray):
+    """
+    Find the overlapping variants and windows with a sorted sweep over each chromosome.
+    The intervals are 0-based and half-open.
+    :return: numpy arrays of the indices of the variant and the window of each match, sorted by the variant,
+    the window start and the window
+    """
+    variant_index = []
+    window_index = []
+    for chrom in pd.unique(variant_chroms):
+        chrom_windows = np.flatnonzero(window_chroms == chrom)
+        if len(chrom_windows) == 0:
+            continue
+        chrom_windows = chrom_windows[np.argsort(window_starts[chrom_windows], kind='stable')]
+        starts = window_starts[chrom_windows]
+        max_width = (window_ends[chrom_windows] - starts).max()
+        chrom_variants = np.flatnonzero(variant_chroms == chrom)
+        # the windows that start in (variant start - max_width, variant end) can overlap the variant
+        first = np.searchsorted(starts, variant_starts[chrom_variants] - max_width, side='right')
+        last = np.searchsorted(starts, variant_ends[chrom_variants], side='left')
+        counts = np.maximum(last - first, 0)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidate_variants = np.repeat(chrom_variants, counts)
+        candidate_windows = chrom_windows[np.repeat(first, counts) + offsets]
+        overlaps = window_ends[candidate_windows] > variant_starts[candidate_variants]
+        variant_index.append(candidate_variants[overlaps])
+        window_index.append(candidate_windows[overlaps])
+    if len(variant_index) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    variant_index = np.concatenate(variant_index)
+    window_index = np.concatenate(window_index)
+    order = np.argsort(variant_index, kind='stable')
+    return variant_index[order], window_index[order]
+
+
 def construct_interval(chrom, strand, anchor, seq_length):
     # input interval without shift
     # if the sequence length is even, the tss is closer to the end of the sequence
@@ -153,45 +446,156 @@ def construct_interval(chrom, strand, anchor, seq_length):
 def extract_sequences_around_anchor(shifts, chromosome, strand, anchor, seq_length,
                                     ref_seq_extractor: FastaStringExtractor,
                                     variant_extractor: VariantSeqExtractor | None = None,
-                                    variant: Variant | None = None):
+                                    variant: Variant | None = None,
+                                    encoded_genome: EncodedGenome | None = None,
+                                    reference_cache: dict | None = None):
+    """
+    Extract the one-hot encoded sequences of the shifted windows around an anchor.
+    The union of the shifted windows is extracted and encoded once and each shift is a view into it.
+    Windows that need padding at the chromosome ends, or that do not all contain the anchor and the variant,
+    are extracted one by one. Substitutions (SNVs and MNVs) are patched into the encoded reference of the union,
+    see patch_substitution.
+    :param encoded_genome: If provided, the reference sequences are extracted from the encoded genome
+    :param reference_cache: If provided, holds the encoded reference of the last union window, which is reused
+    by the following substitutions with the same window
+    :return: list of numpy arrays of shape (seq_length, 4) for each shift and the interval without shift
+    """
     assert variant_extractor is None or (variant is not None and variant_extractor is not None), \
         "variant_extractor must be provided if variant is not None"
-    chrom_len = len(ref_seq_extractor.fasta.records[chromosome])
+    if encoded_genome is not None:
+        chrom_len = encoded_genome.chrom_len(chromosome)
+    else:
+        chrom_len = len(ref_seq_extractor.fasta.records[chromosome])
 
     # WARNING: kipoiseq.Interval has a 0-based end!
     interval = construct_interval(chromosome, strand, anchor, seq_length)
+    shifted_intervals = [interval.shift(shift, use_strand=True) for shift in shifts]
+    union_start = min(x.start for x in shifted_intervals)
+    union_end = max(x.end for x in shifted_intervals)
+    is_sliceable = union_start >= 0 and union_end < chrom_len and \
+        all(x.start < anchor < x.end for x in shifted_intervals)
+    if variant is not None:
+        is_sliceable = is_sliceable and max(x.start for x in shifted_intervals) <= variant.start and \
+            variant.end <= min(x.end for x in shifted_intervals)
+
+    def extract(shifted_interval, variant=None):
+        if variant is None and encoded_genome is not None:
+            return encoded_genome.one_hot(extract_encoded_sequence(shifted_interval, chrom_len, encoded_genome))
+        return one_hot_dna(extract_shifted_sequence(shifted_interval, anchor, chrom_len, ref_seq_extractor,
+                                                    variant_extractor=variant_extractor, variant=variant))
+
+    if not is_sliceable:
+        return [extract(shifted_interval, variant) for shifted_interval in shifted_intervals], interval
+
+    union_interval = Interval(chrom=chromosome, start=union_start, end=union_end, strand=strand)
+    if variant is not None and len(variant.ref) == len(variant.alt):
+        key = (chromosome, strand, union_start, union_end)
+        if reference_cache is not None and key in reference_cache:
+            union_seq = reference_cache[key]
+        else:
+            union_seq = extract(union_interval)
+            if reference_cache is not None:
+                reference_cache.clear()
+                reference_cache[key] = union_seq
+        union_seq = patch_substitution(union_seq, union_interval, variant)
+    else:
+        union_seq = extract(union_interval, variant)
     sequences = []
-    # shift intervals and extract sequences
-    for shift in shifts:
-        shifted_interval = interval.shift(shift, use_strand=True)
-        five_end_pad = 0
-        three_end_pad = 0
-        if shifted_interval.start < 0:
-            five_end_pad = abs(shifted_interval.start)
-        if shifted_interval.end >= chrom_len:
-            three_end_pad = shifted_interval.end - chrom_len + 1
-        if five_end_pad > 0 or three_end_pad > 0:
-            shifted_interval = shifted_interval.truncate(chrom_len)
-
-        if variant is not None:
-            seq = variant_extractor.extract(shifted_interval,
-                                            [variant],
-                                            anchor=anchor,
-                                            fixed_length=True,
-                                            is_padding=True,
-                                            chrom_len=chrom_len,
-                                            )
+    for shifted_interval in shifted_intervals:
+        # the sequences of the negative strand are reverse complemented
+        if union_interval.neg_strand:
+            offset = union_end - shifted_interval.end
         else:
-            seq = ref_seq_extractor.extract(shifted_interval)
+            offset = shifted_interval.start - union_start
+        sequences.append(union_seq[offset:offset + seq_length])
+    return sequences, interval
+
 
-        if five_end_pad > 0:
-            seq = 'N' * five_end_pad + seq
+def patch_substitution(sequence: np.ndarray, interval: Interval, variant: Variant) -> np.ndarray:
+    """
+    Apply a substitution to the one-hot encoded reference sequence of an interval. Since the substitution does not
+    change the length of the sequence, the result equals the one-hot encoded sequence of VariantSeqExtractor.
+    :param sequence: float numpy array of shape (width, 4), reverse complemented on the negative strand
+    :param interval: The interval of the sequence, which must contain the variant
+    :param variant: A variant whose ref and alt have the same length
+    :return: The patched copy of the sequence
+    """
+    assert len(variant.ref) == len(variant.alt), f'{variant} is not a substitution'
+    assert interval.start <= variant.start and variant.end <= interval.end, f'{variant} is outside of {interval}'
+    sequence = sequence.copy()
+    if interval.neg_strand:
+        offset = interval.end - variant.end
+        alt = complement(variant.alt)[::-1]
+    else:
+        offset = variant.start - interval.start
+        alt = variant.alt
+    sequence[offset:offset + len(alt)] = one_hot_dna(alt)
+    return sequence
 
-        if three_end_pad > 0:
-            seq = seq + 'N' * three_end_pad
 
-        assert len(seq) == seq_length, \
-            f"interval width must be {seq_length} but got {len(seq)}"
+def extract_shifted_sequence(shifted_interval: Interval, anchor, chrom_len,
+                             ref_seq_extractor: FastaStringExtractor,
+                             variant_extractor: VariantSeqExtractor | None = None,
+                             variant: Variant | None = None) -> str:
+    """
+    Extract the sequence of a single window. The window is padded with N at the chromosome ends.
+    :return: The sequence of the window
+    """
+    seq_length = shifted_interval.width()
+    shifted_interval, five_end_pad, three_end_pad = _truncate_interval(shifted_interval, chrom_len)
 
-        sequences.append(one_hot_dna(seq))
-    return sequences, interval
+    if variant is not None:
+        seq = variant_extractor.extract(shifted_interval,
+                                        [variant],
+                                        anchor=anchor,
+                                        fixed_length=True,
+                                        is_padding=True,
+                                        chrom_len=chrom_len,
+                                        )
+    else:
+        seq = ref_seq_extractor.extract(shifted_interval)
+
+    if five_end_pad > 0:
+        seq = 'N' * five_end_pad + seq
+
+    if three_end_pad > 0:
+        seq = seq + 'N' * three_end_pad
+
+    assert len(seq) == seq_length, \
+        f"interval width must be {seq_length} but got {len(seq)}"
+
+    return seq
+
+
+def extract_encoded_sequence(shifted_interval: Interval, chrom_len, encoded_genome: EncodedGenome) -> np.ndarray:
+    """
+    Extract the encoded reference sequence of a single window, see extract_shifted_sequence.
+    :return: uint8 numpy array of shape (width,)
+    """
+    seq_length = shifted_interval.width()
+    shifted_interval, five_end_pad, three_end_pad = _truncate_interval(shifted_interval, chrom_len)
+    seq = encoded_genome.extract(shifted_interval)
+    if five_end_pad > 0 or three_end_pad > 0:
+        seq = np.concatenate([np.full(five_end_pad, N_CODE, dtype=seq.dtype), seq,
+                              np.full(three_end_pad, N_CODE, dtype=seq.dtype)])
+
+    assert len(seq) == seq_length, \
+        f"interval width must be {seq_length} but got {len(seq)}"
+
+    return seq
+
+
+def _truncate_interval(shifted_interval: Interval, chrom_len):
+    """
+    Truncate a window to the chromosome.
+    :return: The truncated window and the number of bases to pad at its 5' and 3' end
+    """
+    five_end_pad = 0
+    three_end_pad = 0
+    if shifted_interval.start < 0:
+        five_end_pad = abs(shifted_interval.start)
+    if shifted_interval.end >= chrom_len:
+        three_end_pad = shifted_interval.end - chrom_len + 1
+    if five_end_pad > 0 or three_end_pad > 0:
+        shifted_interval = shifted_interval.truncate(chrom_len)
+    return shifted_interval, five_end_pad, three_end_pad
@@ -4,11 +4,22 @@ import pandas as pd
 from kipoiseq.extractors import VariantSeqExtractor, SingleVariantMatcher, FastaStringExtractor
 import pyranges as pr
 from kipoiseq.extractors import MultiSampleVCF
+from kipoiseq import Variant
 import pyarrow as pa
+import pyarrow.parquet as pq
 import numpy as np
-from .dataloader import Dataloader, get_tss_from_genome_annotation, extract_sequences_around_anchor
+import hashlib
+import itertools
+import os
+import pathlib
+from typing import Callable
+from kipoi_utils.data_utils import numpy_collate
+from .dataloader import Dataloader, SequenceBuffers, get_tss_from_genome_annotation, \
+    extract_sequences_around_anchor, stack_sequences, construct_interval, get_tss_windows, read_vcf_variants, \
+    match_variants
 from kipoi_enformer.constants import AlleleType
 from kipoi_enformer.logger import logger
+from kipoi_enformer.utils import file_content_hash
 
 __all__ = ['TSSDataloader', 'RefTSSDataloader', 'VCFTSSDataloader']
 
@@ -18,7 +29,8 @@ ENFORMER_SEQUENCE_LENGTH = 393_216
 
 
 class TSSDataloader(Dataloader):
-    def __init__(self, allele_type: AlleleType, fasta_file, gtf: pd.DataFrame | str, chromosome: str | None = None,
+    def __init__(self, allele_type: AlleleType, fasta_file, gtf: pd.DataFrame | str,
+                 chromosome: str | list[str] | None = None,
                  seq_length: int = ENFORMER_SEQUENCE_LENGTH, shifts: list[int] = (-43, 0, 43), size: int = None,
                  canonical_only: bool = False,
                  protein_coding_only: bool = False, gene_ids: list | None = None,
@@ -27,7 +39,7 @@ class TSSDataloader(Dataloader):
 
         :param fasta_file: Fasta file with the reference genome
         :param gtf: GTF file with genome annotation or DataFrame with genome annotation
-        :param chromosome: The chromosome to filter for. If None, all chromosomes are used.
+        :param chromosome: The chromosome or the list of chromosomes to filter for. If None, all chromosomes are used.
         :param seq_length: The length of the sequence to return.
         :param shifts: The shifts in relation to the TSS.
         :param size: The number of samples to return. If None, all samples are returned.
@@ -40,10 +52,12 @@ class TSSDataloader(Dataloader):
         for shift in shifts:
             assert abs(shift) < seq_length, f"shift must be smaller than seq_length but got {shift} >= {seq_length}"
 
+        self._gtf = gtf
+        self._gene_ids = gene_ids
         self._canonical_only = canonical_only
         self._protein_coding_only = protein_coding_only
         self._seq_length = seq_length
-        self.chromosome = chromosome
+        self.chromosome = chromosome if chromosome is None or isinstance(chromosome, str) else list(chromosome)
         logger.debug(f"Loading genome annotation")
         self._genome_annotation = get_tss_from_genome_annotation(gtf, chromosome=self.chromosome,
                                                                  canonical_only=canonical_only,
@@ -53,6 +67,58 @@ class TSSDataloader(Dataloader):
         self.metadata = {'shifts': ';'.join([str(x) for x in self._shifts]), 'allele_type': allele_type.value,
                          'seq_length': str(self._seq_length)}
 
+    @property
+    def config(self) -> dict:
+        """
+        Get the configuration of the dataloader, which determines the generated samples.
+        :return: JSON-serializable dictionary
+        """
+        return {
+            **super().config,
+            **self.metadata,
+            'gtf': str(self._gtf) if not isinstance(self._gtf, pd.DataFrame) else 'pandas.DataFrame',
+            'chromosome': self.chromosome,
+            'canonical_only': self._canonical_only,
+            'protein_coding_only': self._protein_coding_only,
+            'gene_ids': None if self._gene_ids is None else list(self._gene_ids),
+        }
+
+    def sequence_buffers(self, batch_size: int, dtype: str = 'float32', num_buffers: int = 1) -> SequenceBuffers:
+        """
+        Get preallocated buffers for the sequences of batches of this dataloader, see SequenceBuffers.
+        """
+        return SequenceBuffers(batch_size, len(self._shifts), self._seq_length, dtype=dtype, num_buffers=num_buffers)
+
+    def iter_batches(self, batch_size: int, start: int = 0, dtype: str = 'float32', num_buffers: int = 1,
+                     buffers: SequenceBuffers | None = None, plan: Callable[[dict], list[tuple]] | None = None):
+        """
+        Iterate over batches of the dataset. Unlike batch_iter, the sequences are extracted directly into
+        preallocated buffers that are reused for the following batches, see SequenceBuffers.
+        :param batch_size: The number of samples per batch
+        :param start: The index of the first sample
+        :param dtype: The dtype of the sequences, see SequenceBuffers
+        :param num_buffers: The number of buffers. The sequences of a batch are overwritten num_buffers batches later.
+        :param buffers: The buffers the sequences are extracted into. If provided, dtype and num_buffers are ignored.
+        :param plan: If provided, called with the batch dict before the sequences are extracted. It returns the
+        input keys whose sequences are extracted and may add fields to the batch, see Enformer._iter_batches.
+        If None, the sequences of all records are extracted.
+        :return: Iterator over batch dicts. Structure: {'metadata': {field: array of values},
+        'input_keys': [input key per record], 'sequences': array of shape (inputs, shifts, seq_length, 4)}.
+        'sequences' is missing if no sequences are extracted.
+        """
+        if buffers is None:
+            buffers = self.sequence_buffers(batch_size, dtype=dtype, num_buffers=num_buffers)
+        records = self.iter_records(start=start)
+        while len(batch_records := list(itertools.islice(records, batch_size))) > 0:
+            batch = {
+                'metadata': numpy_collate([metadata for metadata, _ in batch_records]),
+                'input_keys': [input_key for _, input_key in batch_records],
+            }
+            input_keys = batch['input_keys'] if plan is None else plan(batch)
+            if len(input_keys) > 0:
+                batch['sequences'] = buffers.fill(self, input_keys)
+            yield batch
+
     @classmethod
     def from_allele_type(cls, allele_type: AlleleType, *args, **kwargs):
         if allele_type == AlleleType.REF:
@@ -64,58 +130,76 @@ class TSSDataloader(Dataloader):
 
 
 class RefTSSDataloader(TSSDataloader):
-    def __init__(self, fasta_file, gtf: pd.DataFrame | str, chromosome: str,
+    def __init__(self, fasta_file, gtf: pd.DataFrame | str, chromosome: str | list[str] | None,
                  seq_length: int = ENFORMER_SEQUENCE_LENGTH, shifts: list[int] = (-43, 0, 43), size: int = None,
                  canonical_only: bool = False,
-                 protein_coding_only: bool = False, gene_ids: list | None = None, *args, **kwargs):
+                 protein_coding_only: bool = False, gene_ids: list | None = None, *args,
+                 genome_dir: str | None = None, num_shards: int = 1, shard_index: int = 0, **kwargs):
         """
         :param fasta_file: Fasta file with the reference genome
         :param gtf: GTF file with genome annotation or DataFrame with genome annotation
-        :param chromosome: The chromosome to filter for
+        :param chromosome: The chromosome to filter for. A list of chromosomes or None (all chromosomes) covers
+        several chromosomes in one dataloader: the transcripts are sorted by chromosome and TSS, and the metadata
+        contains the chromosome in the chrom column, see kipoi_enformer.utils.partition_by_chromosome.
         :param seq_length: The length of the sequence to return.
         :param shifts: The shifts in relation to the TSS.
         :param size: The number of samples to return. If None, all samples are returned.
         :param canonical_only: If True, only Ensembl canonical transcripts are extracted from the genome annotation
         :param protein_coding_only: If True, only protein coding transcripts are extracted from the genome annotation
         :param gene_id: If provided, only the gene with this ID is extracted from the genome annotation
+        :param genome_dir: The directory of the encoded fasta_file, see kipoi_enformer.genome.encode_genome.
+        If provided, the sequences are extracted from the encoded genome.
+        :param num_shards: The number of shards the records are split into, see Dataloader.shard_bounds
+        :param shard_index: The index of the shard of this dataloader, e.g. the index of a task of a job array
         """
-        assert chromosome is not None, 'A chromosome should be provided'
         super().__init__(AlleleType.REF, chromosome=chromosome, fasta_file=fasta_file, gtf=gtf,
                          seq_length=seq_length, shifts=shifts, size=size, canonical_only=canonical_only,
-                         protein_coding_only=protein_coding_only, gene_ids=gene_ids, *args, **kwargs)
+                         protein_coding_only=protein_coding_only, gene_ids=gene_ids, genome_dir=genome_dir,
+                         *args, **kwargs)
+        self.multi_chromosome = not isinstance(chromosome, str)
+        if self.multi_chromosome and len(self._genome_annotation) > 0:
+            # traverse every chromosome in the order of the TSS for the locality of the sequence reads
+            self._genome_annotation = self._genome_annotation.sort_values(['Chromosome', 'tss'], kind='stable')
+        self._select_shard(shard_index, num_shards)
         logger.debug(f"Dataloader is ready for chromosome {chromosome}")
 
-    def _sample_gen(self):
-        for _, row in self._genome_annotation.iterrows():
-            try:
-                chromosome = row['Chromosome']
-                strand = row.get('Strand', '.')
-                tss = row['tss']
-
-                sequences, interval = extract_sequences_around_anchor(self._shifts, chromosome, strand, tss,
-                                                                      self._seq_length,
-                                                                      ref_seq_extractor=self._reference_sequence)
-
-                metadata = {
-                    "seq_start": interval.start,  # 0-based start of the input sequence
-                    "seq_end": interval.end + 1,  # 1-based stop of the input sequence
-                    "tss": tss,  # 0-based position of the TSS
-                    "strand": strand,
-                    "gene_id": row['gene_id'],
-                    "transcript_id": row['transcript_id'],
-                    "transcript_start": row['transcript_start'],  # 0-based
-                    "transcript_end": row['transcript_end'],  # 1-based
-                }
-
-                yield metadata, np.stack(sequences)
-            except Exception as e:
-                logger.error(f"Error processing row: {row}")
-                raise e
+    def _record_gen(self, start: int = 0):
+        for _, row in self._genome_annotation.iloc[start:].iterrows():
+            chromosome = row['Chromosome']
+            strand = row.get('Strand', '.')
+            tss = row['tss']
+            interval = construct_interval(chromosome, strand, tss, self._seq_length)
+
+            metadata = {
+                "seq_start": interval.start,  # 0-based start of the input sequence
+                "seq_end": interval.end + 1,  # 1-based stop of the input sequence
+                "tss": tss,  # 0-based position of the TSS
+                "strand": strand,
+                "gene_id": row['gene_id'],
+                "transcript_id": row['transcript_id'],
+                "transcript_start": row['transcript_start'],  # 0-based
+                "transcript_end": row['transcript_end'],  # 1-based
+            }
+            if self.multi_chromosome:
+                metadata['chrom'] = chromosome
+            yield metadata, (chromosome, strand, int(tss))
+
+    def extract_sequences(self, input_key: tuple, out: np.ndarray | None = None) -> np.ndarray:
+        chromosome, strand, tss = input_key
+        try:
+            sequences, _ = extract_sequences_around_anchor(self._shifts, chromosome, strand, tss, self._seq_length,
+                                                           ref_seq_extractor=self._reference_sequence,
+                                                           encoded_genome=self._encoded_genome)
+            return stack_sequences(sequences, out=out)
+        except Exception as e:
+            logger.error(f"Error processing record: {input_key}")
+            raise e
 
     def __len__(self):
         if self._genome_annotation is None:
             return 0
-        return len(self._genome_annotation) if self._size is None else min(self._size, len(self._genome_annotation))
+        total = len(self._genome_annotation) - self._offset
+        return total if self._size is None else min(self._size, total)
 
     @property
     def pyarrow_metadata_schema(self):
@@ -132,16 +216,24 @@ class RefTSSDataloader(TSSDataloader):
             ('transcript_id', pa.string()),
             ('transcript_start', pa.int64()),
             ('transcript_end', pa.int64()), ]
+        if self.multi_chromosome:
+            columns.append(('chrom', pa.string()))
 
         return pa.schema(columns, metadata=self.metadata)
 
 
 class VCFTSSDataloader(TSSDataloader):
+    # the columns of the variant matches, see _get_matches
+    MATCH_COLUMNS = ['annotation_index', 'variant_chrom', 'variant_pos', 'ref', 'alt']
+    MATCH_SCHEMA = pa.schema([('annotation_index', pa.int64()), ('variant_chrom', pa.string()),
+                              ('variant_pos', pa.int64()), ('ref', pa.string()), ('alt', pa.string())])
+
     def __init__(self, fasta_file, gtf: pd.DataFrame | str, vcf_file, vcf_lazy=True,
                  variant_upstream_tss: int = 10, variant_downstream_tss: int = 10,
                  seq_length: int = ENFORMER_SEQUENCE_LENGTH, shifts: list[int] = (-43, 0, 43),
                  size: int = None, canonical_only: bool = False, protein_coding_only: bool = False,
-                 gene_ids: list | None = None, *args, **kwargs):
+                 gene_ids: list | None = None, *args, persist_matches: bool = False, matcher: str = 'kipoiseq',
+                 group_by_tss: bool = False, num_shards: int = 1, shard_index: int = 0, **kwargs):
         """
 
         :param fasta_file: Fasta file with the reference genome
@@ -156,7 +248,28 @@ class VCFTSSDataloader(TSSDataloader):
         :param canonical_only: If True, only Ensembl canonical transcripts are extracted from the genome annotation
         :param protein_coding_only: If True, only protein coding transcripts are extracted from the genome annotation
         :param gene_id: If provided, only the gene with this ID is extracted from the genome annotation
+        :param persist_matches: If True, the matches of the variants and the TSS are stored next to the VCF file
+        and reused by later dataloaders with the same settings. If the directory of the VCF file is not writable,
+        the matches are not stored.
+        :param matcher: One of ['kipoiseq', 'sweep']. 'kipoiseq' matches the variants with kipoiseq's
+        SingleVariantMatcher. 'sweep' reads the VCF file once and matches the sorted variants and TSS windows
+        per chromosome, which scales to whole-genome VCF files. Both find the same matches, 'sweep' orders them
+        by the variants in the order of the VCF file.
+        :param group_by_tss: If True, the records are ordered by chromosome, TSS and strand and then by the position
+        of the variant instead of the order of the matcher. All variants of a TSS window are consecutive records,
+        which share the reference sequence of the window: the sequences of consecutive substitutions are patched
+        into the reference that was extracted for the first one. Since Enformer.predict extracts the records in
+        order, see iter_batches, the reference of every window is extracted and encoded once.
+        :param num_shards: The number of shards the records are split into, see Dataloader.shard_bounds.
+        If larger than 1, persist_matches must be True since the shards are computed from the number of matches:
+        it is read from the persisted matches, or the variants are matched and persisted when the dataloader is
+        created. Create the dataloader once before starting the shards so that they do not all match the variants.
+        :param shard_index: The index of the shard of this dataloader, e.g. the index of a task of a job array
         """
+        if matcher not in ['kipoiseq', 'sweep']:
+            raise ValueError(f'Unknown matcher: {matcher}')
+        if num_shards > 1 and not persist_matches:
+            raise ValueError('persist_matches must be True to shard the records of a VCF file')
 
         super().__init__(AlleleType.ALT, fasta_file=fasta_file, gtf=gtf, chromosome=None,
                          seq_length=seq_length, shifts=shifts, size=size, canonical_only=canonical_only,
@@ -167,66 +280,205 @@ class VCFTSSDataloader(TSSDataloader):
                  f"{shift} >= {variant_downstream_tss + variant_upstream_tss + 1}")
 
         self._variant_seq_extractor = VariantSeqExtractor(reference_sequence=self._reference_sequence)
+        # the encoded reference of the last window, which is patched with the following substitutions.
+        # Every copy has its own, see __getstate__.
+        self._reference_cache = {}
         self.vcf_file = vcf_file
         self.vcf_lazy = vcf_lazy
         self.variant_upstream_tss = variant_upstream_tss
         self.variant_downstream_tss = variant_downstream_tss
+        self.persist_matches = persist_matches
+        self.matcher = matcher
+        self.group_by_tss = group_by_tss
+        # the matches of the variants and the TSS, see _get_matches
+        self._matches = None
+        self._select_shard(shard_index, num_shards)
         logger.debug(f"Dataloader is ready")
 
-    def _sample_gen(self):
-        for interval, variant in self._get_single_variant_matcher(self.vcf_lazy):
-            try:
-                attrs = interval.attrs
-                tss = attrs['tss']
-                chromosome = interval.chrom
-                strand = interval.strand
-
-                sequences, interval = extract_sequences_around_anchor(self._shifts, chromosome, strand, tss,
-                                                                      self._seq_length,
-                                                                      ref_seq_extractor=self._reference_sequence,
-                                                                      variant_extractor=self._variant_seq_extractor,
-                                                                      variant=variant)
-                metadata = {
-                    "seq_start": interval.start,  # 0-based start of the input sequence
-                    "seq_end": interval.end + 1,  # 1-based stop of the input sequence
-                    "tss": tss,  # 0-based position of the TSS
-                    "chrom": interval.chrom,
-                    "strand": interval.strand,
-                    "gene_id": attrs['gene_id'],
-                    "transcript_id": attrs['transcript_id'],
-                    "transcript_start": attrs['transcript_start'],  # 0-based
-                    "transcript_end": attrs['transcript_end'],  # 1-based
-                    "variant_start": variant.start,  # 0-based
-                    "variant_end": variant.end,  # 1-based
-                    "ref": variant.ref,
-                    "alt": variant.alt,
-                }
-                yield metadata, np.stack(sequences)
-            except Exception as e:
-                logger.error(f"Error processing variant-interval")
-                logger.error(f"Interval: {interval}")
-                logger.error(f"Variant: {variant}")
-                raise e
+    def _record_gen(self, start: int = 0):
+        matches = self._get_matches().slice(start)
+        annotation = {x: self._genome_annotation[x].tolist() for x in
+                      ['Chromosome', 'Strand', 'tss', 'gene_id', 'transcript_id', 'transcript_start', 'transcript_end']}
+        for index, variant_chrom, pos, ref, alt in zip(*[matches[x].to_pylist() for x in self.MATCH_COLUMNS]):
+            row = {k: v[index] for k, v in annotation.items()}
+            variant = Variant(variant_chrom, pos, ref, alt)
+            tss = row['tss']
+            chromosome = row['Chromosome']
+            strand = row['Strand']
+            seq_interval = construct_interval(chromosome, strand, tss, self._seq_length)
+            metadata = {
+                "seq_start": seq_interval.start,  # 0-based start of the input sequence
+                "seq_end": seq_interval.end + 1,  # 1-based stop of the input sequence
+                "tss": tss,  # 0-based position of the TSS
+                "chrom": chromosome,
+                "strand": strand,
+                "gene_id": row['gene_id'],
+                "transcript_id": row['transcript_id'],
+                "transcript_start": row['transcript_start'],  # 0-based
+                "transcript_end": row['transcript_end'],  # 1-based
+                "variant_start": variant.start,  # 0-based
+                "variant_end": variant.end,  # 1-based
+                "ref": variant.ref,
+                "alt": variant.alt,
+            }
+            yield metadata, (chromosome, strand, int(tss), variant.chrom, variant.pos, variant.ref, variant.alt)
+
+    def _get_matches(self) -> pa.Table:
+        """
+        Get the matches of the variants and the TSS in the order of the variant matcher or grouped by the TSS.
+        The matches are computed once and shared by the copies of the dataloader, see select_records.
+        :return: pyarrow Table with the row of the match in the genome annotation and the variant fields
+        """
+        if self._matches is not None:
+            return self._matches
+        path = self._matches_path() if self.persist_matches else None
+        if path is not None and path.exists():
+            logger.debug(f'Loading the variant matches from {path}')
+            matches = pq.read_table(path)
+        else:
+            if self.matcher == 'sweep':
+                matches = self._sweep_matches()
+            else:
+                columns = {x: [] for x in self.MATCH_COLUMNS}
+                for interval, variant in self._get_single_variant_matcher(self.vcf_lazy):
+                    for name, value in zip(self.MATCH_COLUMNS, (interval.attrs['annotation_index'], variant.chrom,
+                                                                variant.pos, variant.ref, variant.alt)):
+                        columns[name].append(value)
+                matches = pa.table(columns, schema=self.MATCH_SCHEMA)
+            if path is not None:
+                # write to a temporary file first so that concurrent readers never see partial files
+                tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+                try:
+                    pq.write_table(matches, tmp_path)
+                    os.replace(tmp_path, path)
+                    logger.debug(f'Stored the variant matches in {path}')
+                except OSError as e:
+                    logger.warning(f'Could not store the variant matches of {self.vcf_file} in {path.parent}: {e}')
+                    if tmp_path.exists():
+                        tmp_path.unlink()
+        if self.group_by_tss:
+            matches = self._group_matches(matches)
+        self._matches = matches
+        return self._matches
+
+    def _group_matches(self, matches: pa.Table) -> pa.Table:
+        """
+        Sort the matches by chromosome, TSS and strand of the transcript and then by the position of the variant.
+        The sort is stable, so matches with the same key keep the order of the matcher.
+        """
+        index = matches['annotation_index'].to_numpy()
+        keys = {f'_{x}': self._genome_annotation[x].to_numpy()[index] for x in ['Chromosome', 'tss', 'Strand']}
+        for name, values in keys.items():
+            matches = matches.append_column(name, pa.array(values))
+        matches = matches.sort_by([(x, 'ascending') for x in [*keys, 'variant_pos']])
+        return matches.drop_columns(list(keys))
+
+    def _sweep_matches(self) -> pa.Table:
+        """
+        Match the variants of the VCF file and the windows around the TSS with a sorted sweep, see match_variants.
+        """
+        variants = read_vcf_variants(self.vcf_file)
+        variant_starts = variants['pos'].to_numpy() - 1
+        variant_ends = variant_starts + variants['ref'].str.len().to_numpy()
+        window_starts, window_ends = get_tss_windows(self._genome_annotation, self.variant_upstream_tss,
+                                                     self.variant_downstream_tss)
+        variant_index, annotation_index = match_variants(
+            variants['chrom'].to_numpy(), variant_starts, variant_ends,
+            self._genome_annotation['Chromosome'].to_numpy(), window_starts, window_ends)
+        variants = variants.iloc[variant_index]
+        return pa.table({
+            'annotation_index': annotation_index,
+            'variant_chrom': variants['chrom'].to_numpy(),
+            'variant_pos': variants['pos'].to_numpy(),
+            'ref': variants['ref'].to_numpy(),
+            'alt': variants['alt'].to_numpy(),
+        }, schema=self.MATCH_SCHEMA)
+
+    def _matches_path(self) -> pathlib.Path:
+        """
+        Get the path of the persisted matches next to the VCF file. The path is keyed by the content of the VCF file,
+        the genome annotation, the window around the TSS and the matcher.
+        """
+        annotation = self._genome_annotation[['Chromosome', 'Strand', 'tss', 'transcript_id']]
+        digest = hashlib.sha256(file_content_hash(self.vcf_file).encode())
+        digest.update(pd.util.hash_pandas_object(annotation, index=False).values.tobytes())
+        digest.update(f'{self.variant_upstream_tss}:{self.variant_downstream_tss}:{self.matcher}'.encode())
+        return pathlib.Path(f'{self.vcf_file}.matches.{digest.hexdigest()[:16]}.parquet')
+
+    def extract_sequences(self, input_key: tuple, out: np.ndarray | None = None) -> np.ndarray:
+        chromosome, strand, tss, *variant = input_key
+        variant = Variant(*variant)
+        try:
+            sequences, _ = extract_sequences_around_anchor(self._shifts, chromosome, strand, tss, self._seq_length,
+                                                           ref_seq_extractor=self._reference_sequence,
+                                                           variant_extractor=self._variant_seq_extractor,
+                                                           variant=variant,
+                                                           encoded_genome=self._encoded_genome,
+                                                           reference_cache=self._reference_cache)
+            return stack_sequences(sequences, out=out)
+        except Exception as e:
+            logger.error(f"Error processing variant-interval")
+            logger.error(f"Interval: {chromosome}:{tss}:{strand}")
+            logger.error(f"Variant: {variant}")
+            raise e
+
+    @property
+    def config(self) -> dict:
+        """
+        Get the configuration of the dataloader, which determines the generated samples.
+        :return: JSON-serializable dictionary
+        """
+        return {
+            **super().config,
+            'vcf_file': str(self.vcf_file),
+            'variant_upstream_tss': self.variant_upstream_tss,
+            'variant_downstream_tss': self.variant_downstream_tss,
+            # the matcher and the grouping determine the order of the records
+            'matcher': self.matcher,
+            'group_by_tss': self.group_by_tss,
+        }
+
+    def _num_matches(self) -> int:
+        """
+        Get the number of matches. The persisted matches are counted from their file metadata without reading them.
+        """
+        if self._matches is None and self.persist_matches:
+            path = self._matches_path()
+            if path.exists():
+                return pq.read_metadata(path).num_rows
+        return len(self._get_matches())
 
     def __len__(self):
         if self._genome_annotation is None or len(self._genome_annotation) == 0:
             return 0
-        tmp_matcher = self._get_single_variant_matcher(vcf_lazy=False)
-        total = sum(1 for _, _ in tmp_matcher)
-        if self._size:
+        total = self._num_matches() - self._offset
+        if self._size is not None:
             return min(self._size, total)
         return total
 
+    def __getstate__(self):
+        state = super().__getstate__()
+        del state['_variant_seq_extractor']
+        # copy.copy goes through __getstate__ as well, so copies and unpickled dataloaders do not share the cache
+        state['_reference_cache'] = {}
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._variant_seq_extractor = VariantSeqExtractor(reference_sequence=self._reference_sequence)
+
     def _get_single_variant_matcher(self, vcf_lazy=True):
         if self._genome_annotation is None or len(self._genome_annotation) == 0:
             return iter([])
         # reads the genome annotation
         # start and end are transformed to 0-based and 1-based respectively
-        roi = pr.PyRanges(self._genome_annotation)
+        # the row of each interval in the genome annotation
+        roi = pr.PyRanges(self._genome_annotation.assign(annotation_index=np.arange(len(self._genome_annotation))))
         roi = roi.extend(ext={"5": self.variant_upstream_tss, "3": self.variant_downstream_tss})
         # todo do assert length of roi
 
-        interval_attrs = ['gene_id', 'transcript_id', 'tss', 'transcript_start', 'transcript_end']
+        interval_attrs = ['gene_id', 'transcript_id', 'tss', 'transcript_start', 'transcript_end',
+                          'annotation_index']
         for attr in interval_attrs:
             assert attr in roi.columns, f"attr must be in {roi.columns}"
         variants = MultiSampleVCF(self.vcf_file, lazy=vcf_lazy)
@@ -1,28 +1,38 @@
 import pathlib
 import numpy as np
-import tensorflow_hub as hub
-import tensorflow as tf
-from kipoi_enformer.dataloader import TSSDataloader
-from kipoi_enformer.utils import RandomModel, gtf_to_pandas
+from typing import TYPE_CHECKING
+from kipoi_enformer.utils import RandomModel, numpy_to_nested_list_array, \
+    nested_list_array_to_numpy, get_tracks_shape, get_track_indices, get_track_positions, load_tracks, \
+    file_content_hash, get_parquet_files, has_tag, get_tracks_dtype, get_tracks_value_type, encode_tracks, decode_tracks
 from kipoi_enformer.logger import logger
+from kipoi_enformer.annotation import load_annotation
+from kipoi_enformer.checkpoint import PredictionCheckpoint
+from kipoi_enformer.cache import PredictionCache, InputDeduplicator
+from kipoi_enformer.model_store import MODEL_PATH, get_model_dir, load_model
 import pyarrow as pa
 import pyarrow.parquet as pq
 from tqdm.autonotebook import tqdm
 import math
+import time
+import os
+import multiprocessing
+import resource
+from contextlib import ExitStack
+from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import yaml
 import pickle
 import polars as pl
-from scipy.special import logsumexp
-import xarray as xr
-from sklearn import linear_model, pipeline, preprocessing
 import pandas as pd
-import sklearn as sk
 
-__all__ = ['Enformer', 'EnformerAggregator', 'EnformerTissueMapper', 'EnformerVeff']
-
-# Enformer model URI
-MODEL_PATH = 'https://tfhub.dev/deepmind/enformer/1'
+# tensorflow, sklearn, xarray, scipy and the dataloaders are imported where they are used, so that the
+# post-processing stages can be imported without them
+if TYPE_CHECKING:
+    from kipoi_enformer.dataloader import TSSDataloader
+    from kipoi_enformer.dataloader.dataloader import SequenceBuffers
 
+__all__ = ['Enformer', 'EnformerAggregator', 'EnformerTissueMapper', 'EnformerVeff']
 
 class Enformer:
     NUM_HUMAN_TRACKS = 5313
@@ -36,82 +46,410 @@ class Enformer:
     # length of central sequence which enformer actually sees (1536 bins)
     # ─────┆═════┆════════════════════════┆═════┆─────
     SEEN_SEQUENCE_LENGTH = NUM_SEEN_BINS * BIN_SIZE
-
-    def __init__(self, is_random: bool = False, **random_kwargs):
+    # length of the input sequence of the model
+    INPUT_SEQUENCE_LENGTH = 393_216
+    # rough estimate of the memory needed for the intermediate activations per input sequence:
+    # the stem convolution outputs 768 float32 channels for every position of the input sequence
+    ACTIVATION_BYTES_PER_SEQUENCE = INPUT_SEQUENCE_LENGTH * 768 * 4
+
+    def __init__(self, is_random: bool = False, model_dir: str | pathlib.Path | None = None, compiled: bool = False,
+                 jit_compile: bool = False, **random_kwargs):
         """
+        The model is loaded on the first prediction and shared by all instances in the process.
         :param is_random: If True, load a random model for testing purposes.
+        :param model_dir: The local model store, see kipoi_enformer.model_store.export_model. If None, the directory
+        in the environment variable KIPOI_ENFORMER_MODEL_DIR is used or the model is loaded from TF-Hub.
+        :param compiled: If True, run the model in a tf.function that also extracts the output bins and tracks,
+        so only these are copied to host memory. Otherwise, the model runs eagerly and the full output is copied.
+        :param jit_compile: If True, compile the tf.function with XLA. The batches are padded to a fixed size to
+        avoid recompilation.
         """
-        if not is_random:
-            logger.debug(f'Loading model from {MODEL_PATH}')
-            self._model = hub.load(MODEL_PATH).model
-        else:
-            self._model = RandomModel(**random_kwargs)
-
-    def predict(self, dataloader: TSSDataloader, batch_size: int, filepath: str | pathlib.Path,
-                num_output_bins=NUM_PREDICTION_BINS):
+        self.is_random = is_random
+        self.model_dir = None if is_random else get_model_dir(model_dir)
+        self._random_kwargs = random_kwargs
+        # the local model store holds an export of the TF-Hub model
+        self.model_id = f'random:{random_kwargs}' if is_random else MODEL_PATH
+        self._loaded_model = None
+        # the arguments to load the model again in other processes
+        self._init_args = dict(is_random=is_random, model_dir=self.model_dir, compiled=compiled,
+                               jit_compile=jit_compile, **random_kwargs)
+        self.compiled = compiled or jit_compile
+        self.jit_compile = jit_compile
+        # compiled prediction functions by number of output bins and tracks
+        self._predict_fns = {}
+        # the number of records of the compiled batches if jit_compile is True
+        self._jit_batch_size = None
+        self.model_stats = {'compile_time': 0., 'num_calls': 0, 'num_records': 0, 'model_time': 0., 'host_bytes': 0}
+        # the maximum number of records run through the model at once, lowered on allocation failures
+        self.max_model_batch_size = None
+
+    @property
+    def _model(self):
+        """
+        The model, loaded on first use.
+        """
+        if self._loaded_model is None:
+            if self.is_random:
+                self._loaded_model = RandomModel(**self._random_kwargs)
+            else:
+                self._loaded_model = load_model(self.model_dir)
+        return self._loaded_model
+
+    def predict(self, dataloader: 'TSSDataloader', batch_size: int | None, filepath: str | pathlib.Path,
+                num_output_bins=NUM_PREDICTION_BINS, fixed_shape: bool = False, aggregate: bool = False,
+                num_bins: int = 3, raw_filepath: str | pathlib.Path | None = None,
+                tracks: str | pathlib.Path | list[int] | None = None, queue_depth: int = 0, num_workers: int = 1,
+                checkpoint_dir: str | pathlib.Path | None = None,
+                cache: str | pathlib.Path | PredictionCache | None = None, deduplicate: bool = False,
+                max_pending_inputs: int | None = 256, memory_budget: int | None = None,
+                tracks_dtype: str = 'float32', sequences_dtype: str = 'float32'):
         """
         Predict on a dataloader and save the results in a parquet file
         :param num_output_bins: The number of bins to extract from enformer's output
         :param filepath:
         :param dataloader:
-        :param batch_size:
+        :param batch_size: The number of records per batch. Can be None if memory_budget is given, otherwise it is
+        the upper bound of the batch size.
+        :param fixed_shape: If True, store the tracks as fixed-size lists of shape
+        (shifts, num_output_bins, NUM_HUMAN_TRACKS). The shape is recorded in the schema metadata in any case.
+        :param aggregate: If True, aggregate the predictions of each batch in memory like EnformerAggregator does
+        and write the aggregated predictions to filepath. The raw predictions are never materialized.
+        :param num_bins: The number of bins around the TSS to aggregate over. Only used if aggregate is True.
+        :param raw_filepath: If aggregate is True, the raw predictions are additionally written to this file.
+        :param tracks: A yaml file mapping track names to enformer track indices or a list of track indices.
+        If given, only these tracks are stored and their indices are recorded in the schema metadata.
+        :param queue_depth: If larger than 0, run a pipeline in which the extraction of the next batches and the
+        conversion and writing of the previous batches overlap with the model execution. At most queue_depth batches
+        are queued at each stage. If 0, all steps run serially.
+        :param num_workers: The number of threads converting the predictions to pyarrow in the pipelined mode.
+        The batches are extracted by a single thread since the dataloader is a generator.
+        :param checkpoint_dir: If given, every batch is committed to a part file in this directory and recorded in
+        a manifest. A restarted run with the same configuration, input file contents and model resumes after the last
+        committed batch.
+        The part files are merged into filepath (and raw_filepath) at the end and the checkpoint is removed.
+        :param cache: A prediction cache or the path of its directory. The model only runs on the records whose
+        predictions are not cached yet; their predictions are added to the cache.
+        :param deduplicate: If True, the model runs once per unique input (e.g. once for all transcripts sharing a
+        TSS) and the predictions are written for every record. This requires an additional pass over the records
+        of the dataloader without extracting their sequences.
+        :param max_pending_inputs: The maximum number of inputs whose predictions are kept in memory until their
+        next occurrence if deduplicate is True. Once reached, further duplicated inputs are predicted again.
+        If None, the predictions of all duplicated inputs are kept.
+        :param memory_budget: The memory in bytes available to the prediction. The batch size is derived from
+        the estimated memory per record (see estimate_record_memory) and of the kept duplicated inputs
+        (see estimate_deduplicator_memory). If the model nevertheless fails to allocate
+        memory, the records of a batch are run through the model in smaller chunks.
+        :param tracks_dtype: The storage encoding of the tracks column, one of TRACKS_DTYPES (see encode_tracks).
+        It is recorded in the schema metadata and decoded by EnformerAggregator and EnformerTissueMapper.
+        :param sequences_dtype: The dtype of the preallocated sequence buffers of the batches, see SequenceBuffers.
+        With uint8, the buffers take a quarter of the memory and are converted to float32 right before the model.
         :return: filepath to the parquet dataset
         """
         logger.debug('Predicting on dataloader')
-        assert batch_size > 0
-
-        # Hint: order matters
-        schema = dataloader.pyarrow_metadata_schema
-        schema = schema.insert(0, pa.field(f'tracks', pa.list_(pa.list_(pa.list_(pa.float32())))))
+        assert batch_size is not None or memory_budget is not None, 'batch_size or memory_budget must be given'
+        assert queue_depth >= 0 and num_workers > 0
+        assert raw_filepath is None or aggregate, 'raw_filepath can only be given if aggregate is True'
 
-        shifts = [int(x) for x in schema.metadata[b'shifts'].split(b';')]
+        metadata_schema = dataloader.pyarrow_metadata_schema
+        shifts = [int(x) for x in metadata_schema.metadata[b'shifts'].split(b';')]
         max_abs_shift = max([abs(shift) for shift in shifts])
         assert math.ceil(max_abs_shift / self.BIN_SIZE) < num_output_bins <= self.NUM_PREDICTION_BINS, \
             f'num_output_bins must be fit the maximum shift and be at most {self.NUM_PREDICTION_BINS}'
 
-        batch_counter = 0
-        total_batches = math.ceil(len(dataloader) / batch_size)
-        if total_batches == 0:
-            logger.info('The dataloader is empty. No predictions to make.')
-            writer = pq.ParquetWriter(filepath, schema)
-            writer.close()
-            return
+        assert not deduplicate or memory_budget is None or max_pending_inputs is not None, \
+            'max_pending_inputs must be given to deduplicate within a memory budget'
+
+        tracks = load_tracks(tracks)
+        if memory_budget is not None:
+            batch_size = self._budget_batch_size(memory_budget, batch_size, len(shifts), num_output_bins,
+                                                 len(tracks) if tracks is not None else self.NUM_HUMAN_TRACKS,
+                                                 queue_depth, max_pending_inputs if deduplicate else 0)
+        assert batch_size > 0
+        schema = self._get_schema(metadata_schema, num_output_bins, fixed_shape, tracks, tracks_dtype)
+        # list of (name, filepath, schema, function converting the results dict to pyarrow)
+        outputs = []
+        if aggregate:
+            agg_schema = EnformerAggregator.get_output_schema(schema, num_bins)
+            outputs.append(('aggregated', filepath, agg_schema,
+                            partial(EnformerAggregator._to_pyarrow, output_schema=agg_schema, num_bins=num_bins,
+                                    shifts=shifts)))
+        if not aggregate or raw_filepath is not None:
+            outputs.append(('raw', filepath if not aggregate else raw_filepath, schema,
+                            partial(self._to_pyarrow, fixed_shape=fixed_shape, tracks_dtype=tracks_dtype)))
+
+        checkpoint = None
+        start = 0
+        if checkpoint_dir is not None:
+            config = {**dataloader.config, 'num_output_bins': num_output_bins, 'fixed_shape': fixed_shape,
+                      'tracks_dtype': tracks_dtype,
+                      'num_bins': num_bins if aggregate else None, 'tracks': tracks,
+                      # a regenerated input file or another model invalidates the committed batches
+                      'model_id': self.model_id,
+                      'model_dir': None if self.model_dir is None else str(self.model_dir.resolve()),
+                      'file_hashes': {key: file_content_hash(dataloader.config[key])
+                                      for key in ['fasta_file', 'gtf', 'vcf_file']
+                                      if key in dataloader.config and pathlib.Path(dataloader.config[key]).is_file()}}
+            checkpoint = PredictionCheckpoint(checkpoint_dir, config, [name for name, _, _, _ in outputs])
+            start = checkpoint.num_completed
+
+        cache_namespace = None
+        if cache is not None:
+            if not isinstance(cache, PredictionCache):
+                cache = PredictionCache(cache)
+            cache_namespace = {'model_id': self.model_id, 'fasta': file_content_hash(dataloader.config['fasta_file']),
+                               'shifts': shifts, 'seq_length': dataloader.config['seq_length'],
+                               'num_output_bins': num_output_bins, 'tracks': tracks}
+
+        deduplicator = None
+        if deduplicate:
+            deduplicator = InputDeduplicator(dataloader.count_inputs(start=start), max_pending_inputs)
+            deduplicator.log_stats()
+
+        def write(tables, batch_start, batch_end):
+            if checkpoint is None:
+                for writer, table in zip(writers, tables):
+                    writer.write(table)
+            else:
+                checkpoint.commit(tables, batch_start, batch_end)
 
-        with pq.ParquetWriter(filepath, schema) as writer:
-            for batch in tqdm(dataloader.batch_iter(batch_size=batch_size), total=total_batches):
-                batch_counter += 1
-                batch = self._to_pyarrow(self._process_batch(batch, num_output_bins=num_output_bins))
-                writer.write_batch(batch)
+        batch_counter = 0
+        total_batches = math.ceil((len(dataloader) - start) / batch_size)
+        with ExitStack() as stack:
+            if checkpoint is None:
+                writers = [stack.enter_context(pq.ParquetWriter(path, output_schema))
+                           for _, path, output_schema, _ in outputs]
+            # the consumed batch and the queued batches are extracted into separate buffers
+            buffers = dataloader.sequence_buffers(batch_size, dtype=sequences_dtype, num_buffers=queue_depth + 1)
+            batches = self._iter_batches(dataloader, batch_size, start, cache, cache_namespace, deduplicator,
+                                         buffers)
+            if total_batches == 0:
+                if start == 0:
+                    logger.info('The dataloader is empty. No predictions to make.')
+                else:
+                    logger.info('All records have been predicted already.')
+            elif queue_depth == 0:
+                for batch in tqdm(batches, total=total_batches):
+                    batch_counter += 1
+                    results = self._process_batch(batch, num_output_bins=num_output_bins, tracks=tracks,
+                                                  deduplicator=deduplicator)
+                    end = start + len(results['tracks'])
+                    write([to_pyarrow(results) for _, _, _, to_pyarrow in outputs], start, end)
+                    self._update_cache(cache, batch, results)
+                    start = end
+            else:
+                # single-threaded executors run their tasks in submission order
+                loader = stack.enter_context(ThreadPoolExecutor(1, thread_name_prefix='enformer-loader'))
+                converter = stack.enter_context(ThreadPoolExecutor(num_workers, thread_name_prefix='enformer-arrow'))
+                writer_executor = stack.enter_context(ThreadPoolExecutor(1, thread_name_prefix='enformer-writer'))
+
+                def write_futures(tables, batch_start, batch_end):
+                    write([table.result() for table in tables], batch_start, batch_end)
+
+                pending_writes = deque()
+                for batch in tqdm(_prefetch(batches, queue_depth, loader), total=total_batches):
+                    batch_counter += 1
+                    results = self._process_batch(batch, num_output_bins=num_output_bins, tracks=tracks,
+                                                  deduplicator=deduplicator)
+                    tables = [converter.submit(to_pyarrow, results) for _, _, _, to_pyarrow in outputs]
+                    end = start + len(results['tracks'])
+                    pending_writes.append(writer_executor.submit(write_futures, tables, start, end))
+                    self._update_cache(cache, batch, results)
+                    start = end
+                    # wait for the oldest batch to be written to bound the memory usage
+                    while len(pending_writes) > queue_depth:
+                        pending_writes.popleft().result()
+                while len(pending_writes) > 0:
+                    pending_writes.popleft().result()
 
         # sanity check for the dataloader
         assert batch_counter == total_batches
 
-    def _process_batch(self, batch, num_output_bins=11):
+        self.log_model_stats()
+        if cache is not None:
+            cache.log_stats()
+        if memory_budget is not None:
+            # ru_maxrss is given in KiB on linux
+            peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 2 ** 10
+            logger.info(f'Peak memory usage: {peak_memory / 2 ** 30:.2f} GiB '
+                        f'(budget {memory_budget / 2 ** 30:.2f} GiB)')
+        if checkpoint is not None:
+            for name, path, output_schema, _ in outputs:
+                checkpoint.merge(name, path, output_schema)
+            checkpoint.remove()
+
+    @staticmethod
+    def _iter_batches(dataloader: 'TSSDataloader', batch_size: int, start: int = 0,
+                      cache: PredictionCache | None = None, cache_namespace: dict | None = None,
+                      deduplicator: InputDeduplicator | None = None, buffers: 'SequenceBuffers | None' = None):
+        """
+        Iterate over the batches of a dataloader, see TSSDataloader.iter_batches.
+        The sequences of every input are extracted at most once. Inputs whose predictions are cached or kept by
+        the deduplicator are not extracted at all.
+        :param dataloader: The dataloader
+        :param batch_size: The number of records per batch
+        :param start: The index of the first record
+        :param cache: The prediction cache
+        :param cache_namespace: The cache namespace of the predictions, see PredictionCache.key
+        :param deduplicator: Keeps the predictions of inputs that occur again, see InputDeduplicator.plan
+        :param buffers: The buffers the sequences are extracted into. If None, a single buffer is used, i.e. the
+        sequences of a batch are only valid until the next batch is generated.
+        :return: Generator of batch dicts. Structure: {'metadata': {field: [values]}, 'input_keys': [input keys],
+        'sequences': array of the unique inputs to predict}. With a cache or deduplicator, the batch additionally
+        contains 'cached' (cached predictions or None per record), 'predict_index' (index into 'sequences' per
+        record or -1) and, with a cache, 'cache_keys'.
+        """
+        if cache is None and deduplicator is None:
+            return dataloader.iter_batches(batch_size, start=start, buffers=buffers)
+
+        def plan(batch: dict) -> list[tuple]:
+            input_keys = batch['input_keys']
+            # the records whose predictions are taken from the deduplicator
+            kept = [False] * len(input_keys)
+            if deduplicator is not None:
+                kept = [deduplicator.plan(input_key) for input_key in input_keys]
+            batch['cached'] = [None] * len(input_keys)
+            if cache is not None:
+                batch['cache_keys'] = [cache.key(cache_namespace, input_key) for input_key in input_keys]
+                batch['cached'] = [cache.get(key) if not is_kept else None
+                                   for key, is_kept in zip(batch['cache_keys'], kept)]
+
+            # map the records to the unique inputs that have to be predicted
+            predict_keys = {}
+            batch['predict_index'] = [
+                predict_keys.setdefault(input_key, len(predict_keys)) if cached is None and not is_kept else -1
+                for input_key, cached, is_kept in zip(input_keys, batch['cached'], kept)
+            ]
+            return list(predict_keys)
+
+        return dataloader.iter_batches(batch_size, start=start, buffers=buffers, plan=plan)
+
+    @staticmethod
+    def _update_cache(cache: PredictionCache | None, batch: dict, results: dict):
+        """
+        Store the predictions of the inputs of a batch that were run through the model.
+        """
+        if cache is None:
+            return
+        stored = set()
+        for i, (key, index) in enumerate(zip(batch['cache_keys'], batch['predict_index'])):
+            if index >= 0 and index not in stored:
+                stored.add(index)
+                cache.put(key, results['tracks'][i])
+
+    def predict_sharded(self, dataloader: 'TSSDataloader', output_dir: str | pathlib.Path, num_workers: int,
+                        threads_per_worker: int | None = None, **kwargs):
+        """
+        Predict on a dataloader with several worker processes.
+        The records of the dataloader are split into num_workers contiguous shards. Every worker loads the model,
+        predicts one shard and writes it to the hive partition output_dir/shard={shard}/data.parquet, like the
+        chrom={chromosome}/data.parquet layout of the reference predictions. The concatenation of the shard files
+        in the order of their paths equals the output of predict. The directory can be passed to
+        EnformerAggregator, EnformerTissueMapper and EnformerVeff like a single parquet file.
+        :param dataloader: The dataloader. It is pickled to the workers.
+        :param output_dir: The directory of the shard partitions
+        :param num_workers: The number of worker processes and shards
+        :param threads_per_worker: The number of tensorflow threads of every worker. Defaults to the number of
+        available cores divided by num_workers. The workers are pinned to disjoint sets of cores if possible.
+        :param kwargs: Arguments of predict. raw_filepath and checkpoint_dir are directories with one partition
+        or checkpoint per shard. The memory_budget applies to every worker.
+        """
+        assert num_workers > 0
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        if threads_per_worker is None:
+            threads_per_worker = max(1, len(cores) // num_workers)
+        output_dir = pathlib.Path(output_dir)
+        for path in [output_dir, kwargs.get('raw_filepath')]:
+            if path is not None:
+                for shard in range(num_workers):
+                    (pathlib.Path(path) / f'shard={shard:05d}').mkdir(parents=True, exist_ok=True)
+        if kwargs.get('checkpoint_dir') is not None:
+            pathlib.Path(kwargs['checkpoint_dir']).mkdir(parents=True, exist_ok=True)
+
+        num_records = len(dataloader)
+        logger.info(f'Predicting {num_records} records in {num_workers} shards with {threads_per_worker} threads each')
+        # spawn the workers since tensorflow is not fork-safe, every worker predicts a single shard
+        with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                 max_tasks_per_child=1) as executor:
+            futures = []
+            for shard in range(num_workers):
+                partition = f'shard={shard:05d}'
+                shard_kwargs = dict(kwargs)
+                if kwargs.get('raw_filepath') is not None:
+                    shard_kwargs['raw_filepath'] = pathlib.Path(kwargs['raw_filepath']) / partition / 'data.parquet'
+                if kwargs.get('checkpoint_dir') is not None:
+                    shard_kwargs['checkpoint_dir'] = pathlib.Path(kwargs['checkpoint_dir']) / partition
+                # pin the worker to its own cores if there are enough of them
+                worker_cores = cores[shard * threads_per_worker:(shard + 1) * threads_per_worker]
+                if len(worker_cores) < threads_per_worker:
+                    worker_cores = None
+                futures.append(executor.submit(
+                    _predict_shard, self._init_args, dataloader.select_shard(shard, num_workers),
+                    output_dir / partition / 'data.parquet', threads_per_worker, worker_cores, shard_kwargs))
+            for future in futures:
+                future.result()
+
+    def _get_schema(self, metadata_schema: pa.Schema, num_output_bins: int, fixed_shape: bool = False,
+                    tracks: list[int] | None = None, tracks_dtype: str = 'float32'):
+        """
+        Get the pyarrow schema of the raw predictions.
+        :param metadata_schema: The metadata schema of the dataloader
+        :param num_output_bins: The number of bins to extract from enformer's output
+        :param fixed_shape: If True, the tracks are stored as fixed-size lists
+        :param tracks: The indices of the stored tracks. If None, all tracks are stored.
+        :param tracks_dtype: The storage encoding of the tracks
+        :return: PyArrow schema with the tracks column and the metadata columns
+        """
+        num_shifts = len(metadata_schema.metadata[b'shifts'].split(b';'))
+        num_tracks = self.NUM_HUMAN_TRACKS if tracks is None else len(tracks)
+        # Hint: order matters
+        tracks_shape = (num_shifts, num_output_bins, num_tracks)
+        value_type = get_tracks_value_type(tracks_dtype)
+        if fixed_shape:
+            tracks_type = pa.list_(pa.list_(pa.list_(value_type, tracks_shape[2]), tracks_shape[1]),
+                                   tracks_shape[0])
+        else:
+            tracks_type = pa.list_(pa.list_(pa.list_(value_type)))
+        schema = metadata_schema.insert(0, pa.field(f'tracks', tracks_type))
+        metadata = {**metadata_schema.metadata, 'tracks_shape': ';'.join([str(x) for x in tracks_shape]),
+                    'tracks_dtype': tracks_dtype}
+        if tracks is not None:
+            metadata['track_indices'] = ';'.join([str(x) for x in tracks])
+        return schema.with_metadata(metadata)
+
+    def _process_batch(self, batch, num_output_bins=11, tracks: list[int] | None = None,
+                       deduplicator: InputDeduplicator | None = None):
         """
         Process a batch of data. Run the model and prepare the results dict.
         :param batch: list of data dicts
-        :return: Results dict. Structure: {'metadata': {field: [values]}, 'predictions': {sequence_key: [values]}}
+        :param tracks: The indices of the tracks to keep. If None, all tracks are kept.
+        :param deduplicator: Provides the predictions of inputs that occurred before
+        :return: Results dict. Structure: {'metadata': {field: [values]}, 'tracks': array of predictions}
         """
-        batch_size = batch['sequences'].shape[0]
-        seqs_per_record = batch['sequences'].shape[1]
-        sequences = np.reshape(batch['sequences'], (batch_size * seqs_per_record, 393_216, 4))
-
-        # create input tensor
-        input_tensor = tf.convert_to_tensor(sequences)
-        assert input_tensor.shape == (batch_size * seqs_per_record, 393_216, 4)
-
-        # run model
-        predictions = self._model.predict_on_batch(input_tensor)['human'].numpy()
-        assert predictions.shape == (batch_size * seqs_per_record, self.NUM_PREDICTION_BINS, self.NUM_HUMAN_TRACKS)
-        predictions = predictions.reshape(batch_size, seqs_per_record, self.NUM_PREDICTION_BINS, self.NUM_HUMAN_TRACKS)
-
-        # extract central bins if the number of output bins is different from the number of prediction bins
-        if num_output_bins != self.NUM_PREDICTION_BINS:
-            # calculate TSS bin
-            tss_bin = (self.PRED_SEQUENCE_LENGTH // 2 + 1) // self.BIN_SIZE
-            bins = [tss_bin + i for i in range(-math.floor(num_output_bins / 2), math.ceil(num_output_bins / 2))]
-            assert len(bins) == num_output_bins
-            predictions = predictions[:, :, bins, :]
+        if 'predict_index' not in batch:
+            predictions = self._predict_sequences(batch['sequences'], num_output_bins, tracks)
+        else:
+            # only the unique inputs that are neither cached nor predicted before are run through the model
+            predicted = None
+            if 'sequences' in batch:
+                predicted = self._predict_sequences(batch['sequences'], num_output_bins, tracks)
+            num_records = len(batch['input_keys'])
+            # if every record is a different predicted input, the predictions of the model are used as they are
+            gather = predicted is None or batch['predict_index'] != list(range(num_records))
+            predictions = predicted
+            for i, (input_key, cached, index) in enumerate(zip(batch['input_keys'], batch['cached'],
+                                                               batch['predict_index'])):
+                if cached is not None:
+                    record_predictions = cached
+                elif index >= 0:
+                    record_predictions = predicted[index]
+                else:
+                    record_predictions = deduplicator.get(input_key)
+                if deduplicator is not None:
+                    deduplicator.put(input_key, record_predictions)
+                if gather:
+                    if i == 0:
+                        predictions = np.empty((num_records, *record_predictions.shape), record_predictions.dtype)
+                    predictions[i] = record_predictions
 
         results = {
             'metadata': batch['metadata'],
@@ -119,25 +457,239 @@ class Enformer:
         }
         return results
 
+    def _predict_sequences(self, sequences: np.ndarray, num_output_bins=11, tracks: list[int] | None = None):
+        """
+        Run the model on the sequences of a batch of records.
+        If the model fails to allocate memory, the records are run through the model in smaller chunks.
+        The reduced chunk size is kept for the following batches.
+        :param sequences: numpy array of shape (records, shifts, seq_length, 4)
+        :param num_output_bins: The number of central bins to keep
+        :param tracks: The indices of the tracks to keep. If None, all tracks are kept.
+        :return: numpy array of shape (records, shifts, num_output_bins, tracks)
+        """
+        import tensorflow as tf
+
+        chunk_size = len(sequences)
+        if self.max_model_batch_size is not None:
+            chunk_size = min(chunk_size, self.max_model_batch_size)
+        predictions = []
+        i = 0
+        while i < len(sequences):
+            try:
+                predictions.append(self._run_model(sequences[i:i + chunk_size], num_output_bins, tracks))
+                i += chunk_size
+            except (tf.errors.ResourceExhaustedError, MemoryError):
+                if chunk_size == 1:
+                    raise
+                chunk_size = self._reduce_model_batch_size(chunk_size)
+        return predictions[0] if len(predictions) == 1 else np.concatenate(predictions)
+
+    def _reduce_model_batch_size(self, chunk_size: int) -> int:
+        self.max_model_batch_size = chunk_size // 2
+        if self.jit_compile:
+            # recompile for the smaller batches instead of padding them to the failed size
+            self._predict_fns.clear()
+            self._jit_batch_size = None
+        logger.warning(f'Out of memory while running the model on {chunk_size} records, '
+                       f'reducing the model batch size to {self.max_model_batch_size} records')
+        return self.max_model_batch_size
+
+    @classmethod
+    def estimate_record_memory(cls, num_shifts: int, num_output_bins: int, num_tracks: int = NUM_HUMAN_TRACKS,
+                               queue_depth: int = 0) -> int:
+        """
+        Estimate the peak memory needed per record of a batch.
+        :param num_shifts: The number of shifted sequences per record
+        :param num_output_bins: The number of central bins kept from the predictions
+        :param num_tracks: The number of kept tracks
+        :param queue_depth: The queue depth of the pipelined mode. Every queued batch holds its sequences and
+        its predictions.
+        :return: memory in bytes
+        """
+        itemsize = np.dtype(np.float32).itemsize
+        # one-hot encoded sequences, copied to the input tensor
+        sequences = num_shifts * cls.INPUT_SEQUENCE_LENGTH * 4 * itemsize
+        # the full model output and the extracted bins and tracks
+        predictions = num_shifts * cls.NUM_PREDICTION_BINS * cls.NUM_HUMAN_TRACKS * itemsize
+        output = num_shifts * num_output_bins * num_tracks * itemsize
+        model = 2 * sequences + num_shifts * cls.ACTIVATION_BYTES_PER_SEQUENCE + predictions + output
+        # the output is copied again when converting to pyarrow
+        return model + output + queue_depth * (sequences + 2 * output)
+
+    @classmethod
+    def estimate_deduplicator_memory(cls, num_shifts: int, num_output_bins: int, num_tracks: int = NUM_HUMAN_TRACKS,
+                                     max_pending_inputs: int = 0) -> int:
+        """
+        Estimate the memory of the predictions kept by the deduplicator, see InputDeduplicator.
+        :param num_shifts: The number of shifted sequences per record
+        :param num_output_bins: The number of central bins kept from the predictions
+        :param num_tracks: The number of kept tracks
+        :param max_pending_inputs: The maximum number of inputs whose predictions are kept
+        :return: memory in bytes
+        """
+        return max_pending_inputs * num_shifts * num_output_bins * num_tracks * np.dtype(np.float32).itemsize
+
+    def _budget_batch_size(self, memory_budget: int, batch_size: int | None, num_shifts: int, num_output_bins: int,
+                           num_tracks: int, queue_depth: int, max_pending_inputs: int = 0) -> int:
+        """
+        Get the largest batch size whose estimated memory fits the memory budget.
+        The predictions kept by the deduplicator are deducted from the budget first.
+        """
+        record_memory = self.estimate_record_memory(num_shifts, num_output_bins, num_tracks, queue_depth)
+        deduplicator_memory = self.estimate_deduplicator_memory(num_shifts, num_output_bins, num_tracks,
+                                                                max_pending_inputs)
+        budget_batch_size = max(memory_budget - deduplicator_memory, 0) // record_memory
+        if budget_batch_size == 0:
+            logger.warning(f'The memory budget of {memory_budget / 2 ** 30:.2f} GiB is smaller than the estimated '
+                           f'memory of a single record ({record_memory / 2 ** 30:.2f} GiB) and of the predictions '
+                           f'kept by the deduplicator ({deduplicator_memory / 2 ** 30:.2f} GiB)')
+            budget_batch_size = 1
+        if batch_size is not None:
+            budget_batch_size = min(batch_size, budget_batch_size)
+        logger.info(f'Using a batch size of {budget_batch_size} records for a memory budget of '
+                    f'{memory_budget / 2 ** 30:.2f} GiB ({record_memory / 2 ** 20:.1f} MiB per record)')
+        return budget_batch_size
+
+    def _run_model(self, sequences: np.ndarray, num_output_bins=11, tracks: list[int] | None = None):
+        """
+        Run the model on the sequences of a batch of records at once.
+        :param sequences: numpy array of shape (records, shifts, seq_length, 4), see to_float_sequences
+        :param num_output_bins: The number of central bins to keep
+        :param tracks: The indices of the tracks to keep. If None, all tracks are kept.
+        :return: numpy array of shape (records, shifts, num_output_bins, tracks)
+        """
+        import tensorflow as tf
+        from kipoi_enformer.dataloader.dataloader import to_float_sequences
+
+        batch_size = sequences.shape[0]
+        seqs_per_record = sequences.shape[1]
+        assert sequences.shape[2:] == (self.INPUT_SEQUENCE_LENGTH, 4)
+        start_time = time.perf_counter()
+        sequences = to_float_sequences(sequences)
+        if self.compiled:
+            predict_fn = self._get_predict_fn(num_output_bins, tracks, seqs_per_record, batch_size)
+            if self.jit_compile and batch_size < self._jit_batch_size:
+                # pad the batch to the compiled size
+                padding = np.zeros((self._jit_batch_size - batch_size, *sequences.shape[1:]), dtype=sequences.dtype)
+                sequences = np.concatenate([sequences, padding])
+            predictions = predict_fn(tf.convert_to_tensor(sequences, dtype=tf.float32)).numpy()[:batch_size]
+            self.model_stats['host_bytes'] += predictions.nbytes
+        else:
+            sequences = np.reshape(sequences, (batch_size * seqs_per_record, self.INPUT_SEQUENCE_LENGTH, 4))
+            input_tensor = tf.convert_to_tensor(sequences)
+
+            # run model
+            predictions = self._model.predict_on_batch(input_tensor)['human'].numpy()
+            self.model_stats['host_bytes'] += predictions.nbytes
+            assert predictions.shape == (batch_size * seqs_per_record, self.NUM_PREDICTION_BINS,
+                                         self.NUM_HUMAN_TRACKS)
+            predictions = predictions.reshape(batch_size, seqs_per_record, self.NUM_PREDICTION_BINS,
+                                              self.NUM_HUMAN_TRACKS)
+            predictions = predictions[:, :, self._get_output_bins(num_output_bins)]
+            if tracks is not None:
+                predictions = predictions[..., tracks]
+        self.model_stats['num_calls'] += 1
+        self.model_stats['num_records'] += batch_size
+        self.model_stats['model_time'] += time.perf_counter() - start_time
+        return predictions
+
+    def _get_output_bins(self, num_output_bins: int) -> slice:
+        """
+        Get the central bins of the predictions around the TSS bin.
+        """
+        if num_output_bins == self.NUM_PREDICTION_BINS:
+            return slice(None)
+        # calculate TSS bin
+        tss_bin = (self.PRED_SEQUENCE_LENGTH // 2 + 1) // self.BIN_SIZE
+        return slice(tss_bin - math.floor(num_output_bins / 2), tss_bin + math.ceil(num_output_bins / 2))
+
+    def _get_predict_fn(self, num_output_bins: int, tracks: list[int] | None, seqs_per_record: int,
+                        batch_size: int):
+        """
+        Get the compiled prediction function for the given output bins and tracks.
+        The function is traced and warmed up on its first use, which is reported as compile time.
+        :return: tf.function mapping sequences of shape (records, shifts, seq_length, 4) to predictions of shape
+        (records, shifts, num_output_bins, tracks)
+        """
+        import tensorflow as tf
+
+        key = (num_output_bins, None if tracks is None else tuple(tracks), seqs_per_record)
+        if self.jit_compile and self._jit_batch_size is not None and batch_size > self._jit_batch_size:
+            # the batches are larger than the compiled ones, recompile
+            self._predict_fns.clear()
+        if key in self._predict_fns:
+            return self._predict_fns[key]
+        if self.jit_compile:
+            self._jit_batch_size = max(batch_size, self._jit_batch_size or 0)
+
+        bins = self._get_output_bins(num_output_bins)
+        model = self._model
+
+        def build(jit_compile: bool, records_dim: int | None):
+            @tf.function(input_signature=[
+                tf.TensorSpec([records_dim, seqs_per_record, self.INPUT_SEQUENCE_LENGTH, 4], tf.float32)],
+                jit_compile=jit_compile)
+            def predict_fn(sequences):
+                num_records = tf.shape(sequences)[0]
+                sequences = tf.reshape(sequences, [-1, self.INPUT_SEQUENCE_LENGTH, 4])
+                predictions = model.predict_on_batch(sequences)['human'][:, bins]
+                if tracks is not None:
+                    predictions = tf.gather(predictions, tracks, axis=-1)
+                return tf.reshape(predictions, [num_records, seqs_per_record, tf.shape(predictions)[1],
+                                                tf.shape(predictions)[2]])
+
+            return predict_fn
+
+        logger.info(f'Compiling the model for {num_output_bins} output bins and '
+                    f'{self.NUM_HUMAN_TRACKS if tracks is None else len(tracks)} tracks')
+        start_time = time.perf_counter()
+        # warm up with a batch of zeros
+        predict_fn = build(self.jit_compile, self._jit_batch_size)
+        try:
+            predict_fn(tf.zeros([self._jit_batch_size or 1, seqs_per_record, self.INPUT_SEQUENCE_LENGTH, 4]))
+        except tf.errors.InvalidArgumentError:
+            if not self.jit_compile:
+                raise
+            logger.warning('The model cannot be compiled with XLA, falling back to the graph without XLA')
+            self.jit_compile = False
+            self._jit_batch_size = None
+            predict_fn = build(False, None)
+            predict_fn(tf.zeros([1, seqs_per_record, self.INPUT_SEQUENCE_LENGTH, 4]))
+        compile_time = time.perf_counter() - start_time
+        self.model_stats['compile_time'] += compile_time
+        logger.info(f'Compiled the model in {compile_time:.2f}s')
+        self._predict_fns[key] = predict_fn
+        return predict_fn
+
+    def log_model_stats(self):
+        """
+        Log the compile time, the steady-state latency and the memory copied from the model to the host.
+        """
+        stats = self.model_stats
+        if stats['num_calls'] == 0:
+            return
+        logger.info(f'Model: compile time {stats["compile_time"]:.2f}s, '
+                    f'{stats["model_time"] / stats["num_calls"]:.3f}s per call, '
+                    f'{stats["model_time"] / stats["num_records"]:.3f}s per record, '
+                    f'{stats["host_bytes"] / stats["num_records"] / 2 ** 20:.2f} MiB per record copied to host')
+
     @staticmethod
-    def _to_pyarrow(results: dict):
+    def _to_pyarrow(results: dict, fixed_shape: bool = False, tracks_dtype: str = 'float32'):
         """
-        Convert the results dict from the _process_batch method to a pyarrow table and write it in a parquet file.
-        :param results: pyarrow.RecordBatch object
+        Convert the results dict from the _process_batch method to a pyarrow record batch.
+        The numpy buffers are wrapped as arrow arrays without going through python objects.
+        :param results: Results dict from the _process_batch method
+        :param fixed_shape: If True, the tracks are stored as fixed-size lists
+        :param tracks_dtype: The storage encoding of the tracks
+        :return: pyarrow.RecordBatch object
         """
         logger.debug('Converting results to pyarrow')
 
         # format predictions
-        metadata = {}
-        for k, v in results['metadata'].items():
-            v = pa.array(v.tolist())
-            if isinstance(v, np.ndarray):
-                v = v.tolist()
-            metadata[k] = v
-
         formatted_results = {
-            'tracks': pa.array(results['tracks'].tolist(), type=pa.list_(pa.list_(pa.list_(pa.float32())))),
-            **metadata
+            'tracks': numpy_to_nested_list_array(encode_tracks(results['tracks'], tracks_dtype),
+                                                 fixed_size=fixed_shape),
+            **{k: pa.array(v) for k, v in results['metadata'].items()}
         }
 
         logger.debug('Constructing pyarrow record batch')
@@ -145,50 +697,140 @@ class Enformer:
         return pa.RecordBatch.from_arrays(list(formatted_results.values()), names=list(formatted_results.keys()))
 
 
+def _predict_shard(init_args: dict, dataloader: 'TSSDataloader', filepath: pathlib.Path, num_threads: int,
+                   cores: list[int] | None, predict_kwargs: dict):
+    """
+    Predict a shard of a dataloader in a worker process of Enformer.predict_sharded.
+    """
+    import tensorflow as tf
+
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    # the threads can only be configured before tensorflow is initialized
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(num_threads)
+    Enformer(**init_args).predict(dataloader, filepath=filepath, **predict_kwargs)
+
+
+def _prefetch(iterator, depth: int, executor: ThreadPoolExecutor):
+    """
+    Fetch the next items of an iterator in the background.
+    :param iterator: The iterator to fetch the items from
+    :param depth: The maximum number of items to fetch ahead
+    :param executor: A single-threaded executor that calls next on the iterator
+    :return: Generator over the items of the iterator
+    """
+    end = object()
+    pending = deque(executor.submit(next, iterator, end) for _ in range(depth))
+    while True:
+        item = pending.popleft().result()
+        if item is end:
+            return
+        pending.append(executor.submit(next, iterator, end))
+        yield item
+
+
 class EnformerAggregator:
-    def aggregate(self, enformer_scores_path: str | pathlib.Path, output_path: str | pathlib.Path, num_bins: int = 3):
+    def aggregate(self, enformer_scores_path: str | pathlib.Path, output_path: str | pathlib.Path, num_bins: int = 3,
+                  tracks: str | pathlib.Path | list[int] | None = None, tracks_dtype: str | None = None):
         """
         Aggregate enformer predictions over the bins centered at the tss bin, and the shifts.
-        :param enformer_scores_path:
+        :param enformer_scores_path: A parquet file or a directory of part files (see Enformer.predict_sharded)
         :param output_path:
         :param num_bins:
+        :param tracks: A yaml file mapping track names to enformer track indices or a list of track indices.
+        If given, only these tracks are stored and their indices are recorded in the schema metadata.
+        :param tracks_dtype: The storage encoding of the aggregated tracks (see encode_tracks).
+        If None, the encoding of the raw predictions is used.
         :return:
         """
 
-        enformer_file = pq.ParquetFile(enformer_scores_path)
-        enformer_schema = enformer_file.schema.to_arrow_schema()
+        enformer_files = get_parquet_files(enformer_scores_path)
+        enformer_schema = pq.read_schema(enformer_files[0])
+        tracks = load_tracks(tracks)
+        output_schema = self.get_output_schema(enformer_schema, num_bins, tracks, tracks_dtype)
+        input_dtype = get_tracks_dtype(enformer_schema)
+        output_dtype = get_tracks_dtype(output_schema)
+        shifts = [int(x) for x in enformer_schema.metadata[b'shifts'].split(b';')]
+        tracks_shape = get_tracks_shape(enformer_schema)
+        track_positions = get_track_positions(get_track_indices(enformer_schema), tracks)
+
+        logger.info(f'Iterating over the parquet files in {enformer_scores_path}')
+        with pq.ParquetWriter(output_path, output_schema) as writer:
+            for enformer_file, i in tqdm([(f, i) for f in map(pq.ParquetFile, enformer_files)
+                                          for i in range(f.num_row_groups)]):
+                table = enformer_file.read_row_group(i)
+                # reinterpret the tracks of the row group as a numpy array without copying
+                pred = nested_list_array_to_numpy(table['tracks'], tracks_shape)
+                if track_positions is not None:
+                    pred = pred[..., track_positions]
+                pred = decode_tracks(pred, input_dtype)
+                agg_pred = self._aggregate_batch(pred, Enformer.BIN_SIZE, num_bins, shifts)
+                table = table.set_column(0, output_schema.field(0),
+                                         numpy_to_nested_list_array(encode_tracks(agg_pred, output_dtype),
+                                                                    fixed_size=True))
+                logger.debug('Writing to file')
+                writer.write_table(table.cast(output_schema))
+
+    @staticmethod
+    def get_output_schema(enformer_schema: pa.Schema, num_bins: int = 3, tracks: list[int] | None = None,
+                          tracks_dtype: str | None = None):
+        """
+        Get the pyarrow schema of the aggregated predictions.
+        :param enformer_schema: The pyarrow schema of the raw enformer predictions
+        :param num_bins: The number of bins around the TSS to aggregate over
+        :param tracks: The indices of the tracks to keep. If None, all stored tracks are kept.
+        :param tracks_dtype: The storage encoding of the aggregated tracks. If None, the encoding of the raw
+        predictions is used.
+        :return: PyArrow schema
+        """
+        if tracks is None:
+            tracks = get_track_indices(enformer_schema)
+        if tracks_dtype is None:
+            tracks_dtype = get_tracks_dtype(enformer_schema)
+        num_tracks = Enformer.NUM_HUMAN_TRACKS if tracks is None else len(tracks)
+
         metadata = enformer_schema.metadata
         metadata['nbins'] = str(num_bins)
+        metadata[b'tracks_shape'] = str(num_tracks)
+        metadata[b'tracks_dtype'] = tracks_dtype
+        if tracks is not None:
+            metadata[b'track_indices'] = ';'.join([str(x) for x in tracks])
         output_schema = enformer_schema.with_metadata(metadata)
         output_schema = output_schema.remove(0). \
-            insert(0, pa.field('tracks', pa.list_(pa.float32(), list_size=Enformer.NUM_HUMAN_TRACKS)))
+            insert(0, pa.field('tracks', pa.list_(get_tracks_value_type(tracks_dtype), list_size=num_tracks)))
         # fix polars string issue when transforming to pyarrow
         for idx, x in enumerate(output_schema):
             if x.type == pa.string():
                 output_schema = output_schema.remove(idx).insert(idx, pa.field(x.name, pa.large_string()))
+        return output_schema
 
-        shifts = [int(x) for x in metadata[b'shifts'].split(b';')]
-
-        logger.info(f'Iterating over the parquet files in {enformer_scores_path}')
-        with pq.ParquetWriter(output_path, output_schema) as writer:
-            for i in tqdm(range(enformer_file.num_row_groups)):
-                df = self._aggregate_batch(pl.from_arrow(enformer_file.read_row_group(i)),
-                                           Enformer.BIN_SIZE, num_bins, shifts)
-                logger.debug('Writing to file')
-                writer.write(df.to_arrow())
+    @staticmethod
+    def _to_pyarrow(results: dict, output_schema: pa.Schema, num_bins: int, shifts: list[int]):
+        """
+        Aggregate the results dict of Enformer._process_batch and convert it to a pyarrow table.
+        :param results: Results dict from Enformer._process_batch
+        :param output_schema: The schema of the aggregated predictions
+        :param num_bins: The number of bins around the TSS to aggregate over
+        :param shifts: The shifts of the input sequences
+        :return: pyarrow.Table object
+        """
+        agg_pred = EnformerAggregator._aggregate_batch(results['tracks'], Enformer.BIN_SIZE, num_bins, shifts)
+        batch = Enformer._to_pyarrow({'metadata': results['metadata'], 'tracks': agg_pred}, fixed_shape=True,
+                                     tracks_dtype=get_tracks_dtype(output_schema))
+        return pa.Table.from_batches([batch]).cast(output_schema)
 
     @staticmethod
-    def _aggregate_batch(frame, bin_size, num_bins, shifts):
+    def _aggregate_batch(pred, bin_size, num_bins, shifts):
         """
-        Aggregate the predictions for a record.
-        :param frame:
+        Aggregate the predictions for a batch of records.
+        :param pred: numpy array of shape (records, shifts, bins, tracks)
         :param bin_size:
         :param num_bins:
-        :return:
+        :return: numpy array of shape (records, tracks)
         """
         logger.debug('Aggregating the predictions for a batch')
 
-        pred = np.stack(frame['tracks'].to_list(), dtype=np.float32)
         pred_seq_length = bin_size * pred.shape[2]
         agg_pred = []
         for shift_i, shift in enumerate(shifts):
@@ -202,14 +844,12 @@ class EnformerAggregator:
 
         agg_pred = np.stack(agg_pred).swapaxes(0, 1)
 
-        assert agg_pred.shape == (len(frame), len(shifts), num_bins, Enformer.NUM_HUMAN_TRACKS)
+        assert agg_pred.shape == (len(pred), len(shifts), num_bins, pred.shape[-1])
         # average over shifts and bins
         agg_pred = agg_pred.mean(axis=(1, 2))
 
-        assert agg_pred.shape == (len(frame), Enformer.NUM_HUMAN_TRACKS)
-
-        return frame.with_columns(pl.Series(values=agg_pred.tolist(), name='tracks',
-                                            dtype=pl.Array(pl.Float32, width=Enformer.NUM_HUMAN_TRACKS)))
+        assert agg_pred.shape == (len(pred), pred.shape[-1])
+        return agg_pred
 
 
 class EnformerTissueMapper:
@@ -229,7 +869,7 @@ class EnformerTissueMapper:
             self.tracks_dict = yaml.safe_load(f)
 
     def train(self, agg_enformer_paths: list[str] | list[pathlib.Path], expression_path: str | pathlib.Path
-              , output_path: str | pathlib.Path, model=linear_model.ElasticNetCV(cv=5)):
+              , output_path: str | pathlib.Path, model=None):
         """
         Load the predictions from the parquet file lazily.
         For each record, calculate the average predictions over the bins centered at the tss bin.
@@ -239,9 +879,15 @@ class EnformerTissueMapper:
         :param agg_enformer_paths: The parquet files that contain the aggregated enformer predictions.
         :param expression_path: The zarr file that contains the expression scores. (ground truth)
         :param output_path: The pickle file that will contain the linear models.
-        :param model: The model to use for training the tissue mapper.
+        :param model: The model to use for training the tissue mapper. Defaults to ElasticNetCV(cv=5).
         :return:
         """
+        import sklearn as sk
+        import xarray as xr
+        from sklearn import linear_model, pipeline, preprocessing
+
+        if model is None:
+            model = linear_model.ElasticNetCV(cv=5)
 
         logger.info(f'Loading the expression scores from {expression_path}')
         expression_xr = xr.open_zarr(expression_path)['tpm']
@@ -253,12 +899,14 @@ class EnformerTissueMapper:
         transcripts = [x.split('.')[0] for x in expression_xr.transcript.values]
         expression_xr = expression_xr.assign_coords(dict(transcript=transcripts))
         tracks = list(self.tracks_dict.values())
+        track_positions = self._get_track_positions(agg_enformer_paths)
 
         logger.info(f'Loading the enformer scores from {agg_enformer_paths}')
         enformer_df = pl.concat([
             pl.scan_parquet(path).select(['transcript_id', 'tracks']) for path in agg_enformer_paths
         ]).collect()
-        scores = enformer_df['tracks'].to_numpy()[:, tracks]
+        scores = enformer_df['tracks'].to_numpy()[:, track_positions]
+        scores = decode_tracks(scores, self._get_tracks_dtype(agg_enformer_paths))
         transcripts = enformer_df['transcript_id'].to_list()
         enformer_xr = xr.DataArray(data=scores, dims=['transcript', 'tracks'],
                                    coords=dict(transcript=transcripts, tracks=tracks), name='enformer')
@@ -304,10 +952,11 @@ class EnformerTissueMapper:
         if self.tissue_mapper_lm_dict is None:
             raise ValueError('The tissue_mapper_lm_dict is not provided. Please train the linear models first.')
 
-        tracks = list(self.tracks_dict.values())
+        track_positions = self._get_track_positions([agg_enformer_path])
         logger.debug(f'Iterating over the parquet files in {agg_enformer_path}')
         enformer_df = pl.read_parquet(agg_enformer_path, hive_partitioning=False)
-        scores = enformer_df['tracks'].to_numpy()[:, tracks]
+        scores = enformer_df['tracks'].to_numpy()[:, track_positions]
+        scores = decode_tracks(scores, self._get_tracks_dtype([agg_enformer_path]))
         scores = np.log10(scores + 1)
         dfs = []
         for tissue, lm in self.tissue_mapper_lm_dict.items():
@@ -322,6 +971,30 @@ class EnformerTissueMapper:
         enformer_df = pl.concat(dfs)
         enformer_df.write_parquet(output_path)
 
+    def _get_track_positions(self, agg_enformer_paths: list[str] | list[pathlib.Path]):
+        """
+        Get the positions of the mapped tracks in the aggregated predictions.
+        The aggregated files may store a subset of the tracks, which is recorded in their schema metadata.
+        :param agg_enformer_paths: The parquet files that contain the aggregated enformer predictions.
+        :return: The positions of the tracks of tracks_dict in the tracks column
+        """
+        stored_tracks = [get_track_indices(pq.read_schema(get_parquet_files(path)[0])) for path in agg_enformer_paths]
+        if any(x != stored_tracks[0] for x in stored_tracks):
+            raise ValueError('The aggregated enformer predictions do not store the same tracks.')
+        return get_track_positions(stored_tracks[0], list(self.tracks_dict.values()))
+
+    @staticmethod
+    def _get_tracks_dtype(agg_enformer_paths: list[str] | list[pathlib.Path]):
+        """
+        Get the storage encoding of the aggregated predictions.
+        :param agg_enformer_paths: The parquet files that contain the aggregated enformer predictions.
+        :return: One of TRACKS_DTYPES
+        """
+        dtypes = {get_tracks_dtype(pq.read_schema(get_parquet_files(path)[0])) for path in agg_enformer_paths}
+        if len(dtypes) > 1:
+            raise ValueError(f'The aggregated enformer predictions are stored with different encodings: {dtypes}')
+        return dtypes.pop()
+
 
 class EnformerVeff:
 
@@ -330,7 +1003,8 @@ class EnformerVeff:
         """
 
         :param isoforms_path: The path to the file containing the isoform proportions.
-        :param gtf: The path to the GTF file or a pandas DataFrame containing the genome annotation.
+        :param gtf: The path to the GTF file, whose transcripts are loaded through the annotation cache
+        (see kipoi_enformer.annotation), or a pandas DataFrame containing the genome annotation.
         """
 
         self.isoform_proportion_ldf = None
@@ -344,14 +1018,14 @@ class EnformerVeff:
         # if GTF file is given, then extract the canonical transcripts for the canonical aggregation mode
         if gtf is not None:
             if isinstance(gtf, str) or isinstance(gtf, pathlib.Path):
-                gtf = gtf_to_pandas(gtf)
+                gtf = load_annotation(gtf)
             elif not isinstance(gtf, pd.DataFrame):
                 raise ValueError('gtf must be a path or a pandas DataFrame')
 
             # only keep protein_coding transcripts
             gtf = gtf.query("`gene_type` == 'protein_coding'")
             # check if Ensembl_canonical is in the set of tags
-            gtf = gtf[gtf['tag'].apply(lambda x: False if pd.isna(x) else ('Ensembl_canonical' in x.split(',')))]
+            gtf = gtf[has_tag(gtf['tag'], 'Ensembl_canonical')]
             self.canonical_transcripts = gtf['transcript_id'].str.extract(r'([^\.]+)\..+$')[0].unique()
 
     def run(self, ref_paths: list[str] | list[pathlib.Path], alt_path: str | pathlib.Path,
@@ -451,6 +1125,8 @@ class EnformerVeff:
         :return: A pandas dataframe containing the aggregated scores.
         """
 
+        from scipy.special import logsumexp
+
         def logsumexp_udf(score, weight):
             return logsumexp(score / math.log10(math.e), b=weight) / math.log(10)
 
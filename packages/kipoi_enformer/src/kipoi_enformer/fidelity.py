@@ -0,0 +1,137 @@
+import inspect
+import pathlib
+import numpy as np
+import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+from kipoi_enformer.enformer import EnformerTissueMapper, EnformerVeff
+from kipoi_enformer.logger import logger
+from kipoi_enformer.utils import get_tracks_dtype, get_tracks_value_type, encode_tracks, decode_tracks, \
+    numpy_to_nested_list_array, nested_list_array_to_numpy
+
+__all__ = ['recode_tracks', 'precision_report']
+
+# the argument of DataFrame.join that matches missing keys, join_nulls was renamed to nulls_equal in polars 1.24
+_NULLS_EQUAL_ARG = 'nulls_equal' if 'nulls_equal' in inspect.signature(pl.DataFrame.join).parameters else 'join_nulls'
+
+
+def recode_tracks(input_path: str | pathlib.Path, output_path: str | pathlib.Path, tracks_dtype: str):
+    """
+    Rewrite aggregated enformer predictions with a different storage encoding of the tracks.
+    :param input_path: The parquet file of the aggregated predictions
+    :param output_path: The parquet file to write
+    :param tracks_dtype: The storage encoding of the output, one of TRACKS_DTYPES
+    """
+    input_file = pq.ParquetFile(input_path)
+    input_schema = input_file.schema.to_arrow_schema()
+    input_dtype = get_tracks_dtype(input_schema)
+    tracks_index = input_schema.get_field_index('tracks')
+    num_tracks = input_schema.field(tracks_index).type.list_size
+    output_schema = input_schema.set(tracks_index, pa.field('tracks', pa.list_(get_tracks_value_type(tracks_dtype),
+                                                                               list_size=num_tracks)))
+    output_schema = output_schema.with_metadata({**input_schema.metadata, b'tracks_dtype': tracks_dtype})
+
+    with pq.ParquetWriter(output_path, output_schema) as writer:
+        for i in range(input_file.num_row_groups):
+            table = input_file.read_row_group(i)
+            tracks = decode_tracks(nested_list_array_to_numpy(table['tracks']), input_dtype)
+            tracks = numpy_to_nested_list_array(encode_tracks(tracks, tracks_dtype), fixed_size=True)
+            table = table.set_column(tracks_index, output_schema.field(tracks_index), tracks)
+            writer.write_table(table.cast(output_schema))
+
+
+def precision_report(ref_paths: list[str] | list[pathlib.Path], alt_path: str | pathlib.Path,
+                     output_dir: str | pathlib.Path, tissue_mapper: EnformerTissueMapper, veff: EnformerVeff,
+                     aggregation_mode: str = 'median',
+                     tracks_dtypes: tuple[str, ...] = ('float16', 'bfloat16', 'log_uint16'),
+                     upstream_tss: int | None = None, downstream_tss: int | None = None) -> pd.DataFrame:
+    """
+    Report the error of the variant effect scores caused by storing the predictions with reduced precision.
+    The aggregated predictions are stored with every encoding, mapped to the tissues and the variant effects are
+    calculated like with the original predictions. The scores are compared to those of the original predictions.
+
+    :param ref_paths: The parquet files of the aggregated reference predictions. Hive partitions in the paths
+    (e.g. ref.parquet/chrom=chr22/data.parquet) are kept for EnformerVeff.
+    :param alt_path: The parquet file of the aggregated alternative predictions
+    :param output_dir: The directory of the intermediate files
+    :param tissue_mapper: A trained tissue mapper
+    :param veff: The variant effect calculator
+    :param aggregation_mode: The aggregation mode of EnformerVeff.run
+    :param tracks_dtypes: The encodings to evaluate, see encode_tracks
+    :param upstream_tss: See EnformerVeff.run
+    :param downstream_tss: See EnformerVeff.run
+    :return: DataFrame with one row per encoding. Columns: tracks_dtype, size_ratio (size of the aggregated files
+    relative to the original ones), tissue_max_abs_error (of the tissue expression scores) and num_scores,
+    max_abs_error, mean_abs_error, rmse and pearson of the veff scores. Missing veff scores are ignored.
+    """
+    output_dir = pathlib.Path(output_dir)
+    ref_paths = [pathlib.Path(x) for x in ref_paths]
+    alt_path = pathlib.Path(alt_path)
+
+    def predict_scores(name: str, agg_ref_paths: list[pathlib.Path], agg_alt_path: pathlib.Path):
+        base_path = output_dir / name
+        tissue_ref_paths = []
+        for i, (path, agg_path) in enumerate(zip(ref_paths, agg_ref_paths)):
+            # keep the hive partitions of the original path
+            partitions = [x.name for x in path.parents if '=' in x.name][::-1]
+            tissue_path = base_path.joinpath('tissue', f'ref_{i}.parquet', *partitions, 'data.parquet')
+            tissue_path.parent.mkdir(parents=True, exist_ok=True)
+            tissue_mapper.predict(agg_path, tissue_path)
+            tissue_ref_paths.append(tissue_path)
+        tissue_alt_path = base_path / 'tissue' / 'alt.parquet'
+        tissue_mapper.predict(agg_alt_path, tissue_alt_path)
+        veff_path = base_path / 'veff.parquet'
+        veff.run(tissue_ref_paths, tissue_alt_path, veff_path, aggregation_mode=aggregation_mode,
+                 upstream_tss=upstream_tss, downstream_tss=downstream_tss)
+        tissue_scores = [pl.read_parquet(path, hive_partitioning=False)
+                         for path in [*tissue_ref_paths, tissue_alt_path]]
+        return tissue_scores, pl.read_parquet(veff_path)
+
+    logger.info('Calculating the variant effects of the original predictions')
+    original_tissue, original_veff = predict_scores('original', ref_paths, alt_path)
+    original_size = sum(x.stat().st_size for x in [*ref_paths, alt_path])
+
+    rows = []
+    for tracks_dtype in tracks_dtypes:
+        logger.info(f'Calculating the variant effects of the predictions stored as {tracks_dtype}')
+        agg_path = output_dir / tracks_dtype / 'aggregated'
+        agg_path.mkdir(parents=True, exist_ok=True)
+        agg_ref_paths = [agg_path / f'ref_{i}.parquet' for i in range(len(ref_paths))]
+        for path, recoded_path in zip(ref_paths, agg_ref_paths):
+            recode_tracks(path, recoded_path, tracks_dtype)
+        agg_alt_path = agg_path / 'alt.parquet'
+        recode_tracks(alt_path, agg_alt_path, tracks_dtype)
+        size = sum(x.stat().st_size for x in [*agg_ref_paths, agg_alt_path])
+
+        tissue, veff_scores = predict_scores(tracks_dtype, agg_ref_paths, agg_alt_path)
+        tissue_errors = [_compare(expected, observed, 'score') for expected, observed in zip(original_tissue, tissue)]
+        rows.append({
+            'tracks_dtype': tracks_dtype,
+            'size_ratio': size / original_size,
+            'tissue_max_abs_error': max(x['max_abs_error'] for x in tissue_errors),
+            **_compare(original_veff, veff_scores, 'veff_score'),
+        })
+
+    report = pd.DataFrame(rows)
+    logger.info(f'Precision report:\n{report.to_string(index=False)}')
+    return report
+
+
+def _compare(expected: pl.DataFrame, observed: pl.DataFrame, column: str) -> dict:
+    """
+    Compare the scores of two data frames with the same keys. Rows with missing scores are ignored.
+    """
+    keys = [x for x in expected.columns if x != column]
+    joined = expected.join(observed, on=keys, how='inner', suffix='_reduced', **{_NULLS_EQUAL_ARG: True}). \
+        drop_nulls([column, f'{column}_reduced'])
+    expected = joined[column].to_numpy().astype(np.float64)
+    observed = joined[f'{column}_reduced'].to_numpy().astype(np.float64)
+    error = np.abs(observed - expected)
+    return {
+        'num_scores': len(error),
+        'max_abs_error': error.max() if len(error) > 0 else np.nan,
+        'mean_abs_error': error.mean() if len(error) > 0 else np.nan,
+        'rmse': np.sqrt(np.mean(error ** 2)) if len(error) > 0 else np.nan,
+        'pearson': np.corrcoef(expected, observed)[0, 1] if len(error) > 1 else np.nan,
+    }
@@ -0,0 +1,163 @@
+import argparse
+import json
+import os
+import pathlib
+import shutil
+import numpy as np
+from kipoiseq import Interval
+from kipoi_enformer.logger import logger
+from kipoi_enformer.utils import file_content_hash
+
+__all__ = ['EncodedGenome', 'encode_genome', 'N_CODE']
+
+# codes of the encoded bases, every other character (e.g. soft-masked bases) is encoded as OTHER
+BASES = 'ACGTN'
+N_CODE = BASES.index('N')
+OTHER = len(BASES)
+# the code of the complement of each code
+COMPLEMENT = np.array([3, 2, 1, 0, N_CODE, OTHER], dtype=np.uint8)
+# the one-hot encoding of each code, matches kipoiseq's one_hot_dna
+ONE_HOT = np.concatenate([np.eye(4), np.full((1, 4), 0.25), np.zeros((1, 4))]).astype(np.float32)
+
+
+def _encoding_table() -> np.ndarray:
+    table = np.full(256, OTHER, dtype=np.uint8)
+    table[np.frombuffer(BASES.encode('ascii'), dtype=np.uint8)] = np.arange(len(BASES), dtype=np.uint8)
+    return table
+
+
+class EncodedGenome:
+    """
+    Reference genome that is encoded once into memory-mapped uint8 arrays, one per chromosome.
+    Extracting a window is a slice of the array, so the genome is shared by all processes through the page cache.
+    The extracted and one-hot encoded sequences match the ones of kipoiseq's FastaStringExtractor and one_hot_dna.
+    """
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, genome_dir: str | pathlib.Path, fasta_file: str | pathlib.Path | None = None,
+                 verify: bool = False):
+        """
+        :param genome_dir: The directory of the encoded genome, see encode_genome
+        :param fasta_file: If provided, check that the genome was encoded from this FASTA file. The file is only
+        hashed if its size or modification time differ from the ones recorded at encoding time.
+        :param verify: If True, always hash fasta_file and compare its content hash
+        """
+        self.genome_dir = pathlib.Path(genome_dir)
+        index_path = self.genome_dir / self.INDEX_FILE
+        if not index_path.exists():
+            raise FileNotFoundError(f'No encoded genome found in {self.genome_dir}. '
+                                    f'Encode it with: python -m kipoi_enformer.genome <fasta_file> {self.genome_dir}')
+        with open(index_path) as f:
+            self.index = json.load(f)
+        if fasta_file is not None and not self._matches(fasta_file, verify):
+            raise ValueError(f'The encoded genome in {self.genome_dir} was not encoded from {fasta_file}. '
+                             f'Encode it with: python -m kipoi_enformer.genome {fasta_file} {self.genome_dir}')
+        self._arrays = {}
+
+    def _matches(self, fasta_file: str | pathlib.Path, verify: bool) -> bool:
+        """
+        Check that the genome was encoded from a FASTA file.
+        """
+        # genomes encoded before the full content hash only have a partial 'fingerprint' and are encoded again
+        if 'content_hash' not in self.index:
+            return False
+        stat = os.stat(fasta_file)
+        if not verify and (stat.st_size, stat.st_mtime_ns) == (self.index['size'], self.index['mtime_ns']):
+            return True
+        return file_content_hash(fasta_file, verify=verify) == self.index['content_hash']
+
+    def chrom_len(self, chromosome: str) -> int:
+        return self.index['chromosomes'][chromosome]
+
+    def extract(self, interval: Interval) -> np.ndarray:
+        """
+        Extract the encoded sequence of an interval. The sequence is reverse complemented on the negative strand.
+        :param interval: The interval, which must lie within the chromosome
+        :return: uint8 numpy array of shape (width,)
+        """
+        assert 0 <= interval.start <= interval.end <= self.chrom_len(interval.chrom), \
+            f'interval {interval} is outside of the chromosome'
+        codes = self._array(interval.chrom)[interval.start:interval.end]
+        if interval.neg_strand:
+            return COMPLEMENT[codes[::-1]]
+        return np.array(codes)
+
+    @staticmethod
+    def one_hot(codes: np.ndarray) -> np.ndarray:
+        """
+        One-hot encode an encoded sequence.
+        :param codes: uint8 numpy array of shape (width,)
+        :return: float32 numpy array of shape (width, 4)
+        """
+        return ONE_HOT[codes]
+
+    def _array(self, chromosome: str) -> np.ndarray:
+        if chromosome not in self._arrays:
+            self._arrays[chromosome] = np.load(self.genome_dir / f'{chromosome}.npy', mmap_mode='r')
+        return self._arrays[chromosome]
+
+    def __getstate__(self):
+        # the memory maps are reopened after unpickling instead of copying the genome
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+
+def encode_genome(fasta_file: str | pathlib.Path, genome_dir: str | pathlib.Path, overwrite: bool = False,
+                  chunk_size: int = 2 ** 24) -> pathlib.Path:
+    """
+    Encode a reference FASTA file into a directory with one uint8 numpy file per chromosome and an index file.
+    :param fasta_file: The reference FASTA file
+    :param genome_dir: The directory to write the encoded genome to
+    :param overwrite: If True, replace an existing encoded genome
+    :param chunk_size: The number of bases encoded at once
+    :return: The directory of the encoded genome
+    """
+    from pyfaidx import Fasta
+
+    genome_dir = pathlib.Path(genome_dir)
+    if (genome_dir / EncodedGenome.INDEX_FILE).exists() and not overwrite:
+        logger.info(f'The genome is already encoded in {genome_dir}')
+        return genome_dir
+    # encode to a temporary directory first to never leave a partial genome behind
+    tmp_dir = genome_dir.with_name(f'.{genome_dir.name}.tmp')
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+    table = _encoding_table()
+    chromosomes = {}
+    fasta = Fasta(str(fasta_file), as_raw=True)
+    for chromosome, record in fasta.records.items():
+        logger.debug(f'Encoding {chromosome}')
+        chrom_len = len(record)
+        array = np.lib.format.open_memmap(tmp_dir / f'{chromosome}.npy', mode='w+', dtype=np.uint8,
+                                          shape=(chrom_len,))
+        for start in range(0, chrom_len, chunk_size):
+            end = min(start + chunk_size, chrom_len)
+            array[start:end] = table[np.frombuffer(record[start:end].encode('ascii'), dtype=np.uint8)]
+        array.flush()
+        del array
+        chromosomes[chromosome] = chrom_len
+    fasta.close()
+    with open(tmp_dir / EncodedGenome.INDEX_FILE, 'w') as f:
+        stat = os.stat(fasta_file)
+        json.dump({'fasta_file': str(fasta_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                   'content_hash': file_content_hash(fasta_file), 'chromosomes': chromosomes}, f, indent=2)
+    if genome_dir.exists():
+        shutil.rmtree(genome_dir)
+    os.replace(tmp_dir, genome_dir)
+    logger.info(f'Encoded {len(chromosomes)} chromosomes of {fasta_file} to {genome_dir}')
+    return genome_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Encode a reference genome for fast sequence extraction.')
+    parser.add_argument('fasta_file', help='The reference FASTA file')
+    parser.add_argument('genome_dir', help='The directory to write the encoded genome to')
+    parser.add_argument('--overwrite', action='store_true', help='Replace an existing encoded genome')
+    args = parser.parse_args()
+    encode_genome(args.fasta_file, args.genome_dir, overwrite=args.overwrite)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import os
+import pathlib
+import shutil
+import threading
+from kipoi_enformer.logger import logger
+
+__all__ = ['MODEL_PATH', 'MODEL_DIR_ENV', 'get_model_dir', 'export_model', 'load_model']
+
+# Enformer model URI
+MODEL_PATH = 'https://tfhub.dev/deepmind/enformer/1'
+# environment variable of the default local model store
+MODEL_DIR_ENV = 'KIPOI_ENFORMER_MODEL_DIR'
+
+# the models loaded in this process by their source
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_model_dir(model_dir: str | pathlib.Path | None = None) -> pathlib.Path | None:
+    """
+    Get the directory of the local model store.
+    :param model_dir: The directory of the exported model. If None, the directory in the environment variable
+    KIPOI_ENFORMER_MODEL_DIR is used.
+    :return: The directory or None if no local model store is configured
+    """
+    if model_dir is None:
+        model_dir = os.environ.get(MODEL_DIR_ENV) or None
+    return None if model_dir is None else pathlib.Path(model_dir)
+
+
+def export_model(model_dir: str | pathlib.Path, overwrite: bool = False) -> pathlib.Path:
+    """
+    Download the model from TF-Hub and export it to a local model store, which can be copied to nodes without
+    internet access.
+    :param model_dir: The directory to export the model to
+    :param overwrite: If True, replace an existing export
+    :return: The directory of the exported model
+    """
+    import tensorflow_hub as hub
+
+    model_dir = pathlib.Path(model_dir)
+    if (model_dir / 'saved_model.pb').exists() and not overwrite:
+        logger.info(f'The model is already exported to {model_dir}')
+        return model_dir
+    logger.info(f'Downloading model from {MODEL_PATH}')
+    source_dir = hub.resolve(MODEL_PATH)
+    # copy to a temporary directory first to never leave a partial export behind
+    tmp_dir = model_dir.with_name(f'.{model_dir.name}.tmp')
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    shutil.copytree(source_dir, tmp_dir)
+    if model_dir.exists():
+        shutil.rmtree(model_dir)
+    tmp_dir.rename(model_dir)
+    logger.info(f'Exported model to {model_dir}')
+    return model_dir
+
+
+def load_model(model_dir: str | pathlib.Path | None = None):
+    """
+    Load the enformer model. The model is loaded once per process and shared by all callers.
+    :param model_dir: The directory of the exported model, see get_model_dir. If no local model store is
+    configured, the model is loaded from TF-Hub.
+    :return: The keras model
+    """
+    import tensorflow_hub as hub
+
+    model_dir = get_model_dir(model_dir)
+    if model_dir is None:
+        source = MODEL_PATH
+    else:
+        if not (model_dir / 'saved_model.pb').exists():
+            raise FileNotFoundError(f'No exported model found in {model_dir}. '
+                                    f'Export it with: python -m kipoi_enformer.model_store {model_dir}')
+        source = str(model_dir.resolve())
+    with _models_lock:
+        if source not in _models:
+            logger.debug(f'Loading model from {source}')
+            _models[source] = hub.load(source).model
+        return _models[source]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the enformer model to a local model store.')
+    parser.add_argument('model_dir', nargs='?', default=os.environ.get(MODEL_DIR_ENV),
+                        help=f'The directory to export the model to (default: ${MODEL_DIR_ENV})')
+    parser.add_argument('--overwrite', action='store_true', help='Replace an existing export')
+    args = parser.parse_args()
+    if args.model_dir is None:
+        parser.error(f'model_dir is required if {MODEL_DIR_ENV} is not set')
+    export_model(args.model_dir, overwrite=args.overwrite)
+
+
+if __name__ == '__main__':
+    main()
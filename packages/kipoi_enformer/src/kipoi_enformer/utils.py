@@ -1,6 +1,21 @@
-import pyranges as pr
-import tensorflow as tf
+import numpy as np
+import pandas as pd
+import pyarrow as pa
 import pathlib
+import math
+import yaml
+import hashlib
+import json
+import os
+import re
+from kipoi_enformer.logger import logger
+
+# storage encodings of the tracks column, see encode_tracks
+TRACKS_DTYPES = ['float32', 'float16', 'bfloat16', 'log_uint16']
+# quantization step of log(1 + x) in the log_uint16 encoding, covers predictions up to ~8.9e6
+LOG_UINT16_STEP = 2 ** -12
+# the largest finite bfloat16 (~3.39e38), larger float32 values round to infinity
+BFLOAT16_MAX = np.array(0x7F7F0000, dtype=np.uint32).view(np.float32).item()
 
 
 def gtf_to_pandas(gtf: str | pathlib.Path):
@@ -9,21 +24,340 @@ def gtf_to_pandas(gtf: str | pathlib.Path):
     :param gtf: Path to GTF file
     :return:
     """
+    import pyranges as pr
+
     return pr.read_gtf(gtf, as_df=True, duplicate_attr=True)
 
 
-class RandomModel(tf.keras.Model):
+def has_tag(tags: pd.Series, tag: str) -> pd.Series:
+    """
+    Check which rows of a GTF tag column contain a tag.
+    :param tags: The comma-separated tags of each row, missing values have no tags
+    :param tag: The tag to look for, e.g. Ensembl_canonical
+    :return: boolean Series
+    """
+    return tags.str.contains(f'(?:^|,){re.escape(tag)}(?:,|$)', na=False).astype(bool)
+
+
+# environment variable of the directory of the memoized content hashes, see file_content_hash
+HASH_CACHE_ENV = 'KIPOI_ENFORMER_HASH_CACHE_DIR'
+# memoized content hashes, keyed by the path, size and modification time of the file
+_CONTENT_HASHES = {}
+
+
+def get_hash_cache_dir(cache_dir: str | pathlib.Path | None = None) -> pathlib.Path:
+    """
+    Get the directory of the memoized content hashes.
+    :param cache_dir: The cache directory. If None, the directory in the environment variable
+    KIPOI_ENFORMER_HASH_CACHE_DIR or ~/.cache/kipoi_enformer/hashes is used.
+    :return: The directory
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get(HASH_CACHE_ENV) or (pathlib.Path.home() / '.cache/kipoi_enformer/hashes')
+    return pathlib.Path(cache_dir)
+
+
+def file_content_hash(path: str | pathlib.Path, chunk_size: int = 2 ** 24, verify: bool = False,
+                      cache_dir: str | pathlib.Path | None = None) -> str:
+    """
+    Compute the SHA-256 hash of the full content of a file.
+    The hash is memoized by the absolute path, size and modification time of the file, per process and across
+    processes in the hash cache directory if it is writable. The directory of the file is never written to.
+    :param path: Path to the file
+    :param chunk_size: The number of bytes hashed at once
+    :param verify: If True, hash the content even if the hash is memoized, e.g. for edits that kept the
+    modification time
+    :param cache_dir: The hash cache directory, see get_hash_cache_dir
+    :return: hex digest
+    """
+    path = pathlib.Path(path).resolve()
+    stat = path.stat()
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if key in _CONTENT_HASHES and not verify:
+        return _CONTENT_HASHES[key]
+
+    memo_path = get_hash_cache_dir(cache_dir) / f'{hashlib.sha256(json.dumps(key).encode()).hexdigest()}.json'
+    memo = {'path': str(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if not verify:
+        try:
+            with open(memo_path) as f:
+                stored = json.load(f)
+            if {k: stored.get(k) for k in memo} == memo and 'sha256' in stored:
+                _CONTENT_HASHES[key] = stored['sha256']
+                return _CONTENT_HASHES[key]
+        except (OSError, ValueError):
+            pass
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    _CONTENT_HASHES[key] = digest.hexdigest()
+    # write to a temporary file first so that concurrent readers never see partial files
+    tmp_path = memo_path.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        memo_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump({**memo, 'sha256': _CONTENT_HASHES[key]}, f)
+        os.replace(tmp_path, memo_path)
+    except OSError as e:
+        logger.debug(f'Could not store the content hash of {path} in {memo_path.parent}: {e}')
+    return _CONTENT_HASHES[key]
+
+
+def numpy_to_nested_list_array(values: np.ndarray, fixed_size: bool = False) -> pa.Array:
+    """
+    Wrap a numpy array into a nested pyarrow list array without copying the values.
+    The first dimension becomes the rows of the array, every further dimension adds one level of nesting.
+    :param values: numpy array with at least two dimensions
+    :param fixed_size: If True, build fixed-size lists that carry the shape in the arrow type
+    :return: pyarrow array of type list<list<...<dtype>>>
+    """
+    assert values.ndim >= 2, 'values must have at least two dimensions'
+    # pa.array does not copy contiguous numeric buffers
+    values = np.ascontiguousarray(values)
+    array = pa.array(values.reshape(-1))
+    for size in reversed(values.shape[1:]):
+        if fixed_size:
+            array = pa.FixedSizeListArray.from_arrays(array, size)
+            continue
+        num_lists = len(array) // size
+        assert num_lists * size < 2 ** 31, 'too many values for 32-bit list offsets, reduce the batch size'
+        offsets = pa.array(np.arange(0, (num_lists + 1) * size, size, dtype=np.int32))
+        array = pa.ListArray.from_arrays(offsets, array)
+    return array
+
+
+def nested_list_array_to_numpy(array: pa.Array | pa.ChunkedArray, shape: tuple[int, ...] | None = None) -> np.ndarray:
+    """
+    Reinterpret a nested pyarrow list array as a numpy array of shape (len(array), *shape).
+    The values are not copied if the array consists of a single chunk without nulls.
+    :param array: (fixed-size) nested list array, e.g. the tracks column of a row group
+    :param shape: The shape of a single row. If None, it is inferred from the list lengths.
+    :return: numpy array
+    """
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    num_rows = len(array)
+    values = array
+    inferred_shape = []
+    while pa.types.is_list(values.type) or pa.types.is_fixed_size_list(values.type):
+        num_lists = len(values)
+        values = values.flatten()
+        inferred_shape.append(len(values) // num_lists if num_lists > 0 else 0)
+    if shape is None:
+        shape = tuple(inferred_shape)
+    values = values.to_numpy(zero_copy_only=False)
+    assert values.size == num_rows * math.prod(shape), \
+        f'the nested lists do not have the expected shape {tuple(shape)}'
+    return values.reshape(num_rows, *shape)
+
+
+def get_tracks_shape(schema: pa.Schema) -> tuple[int, ...] | None:
+    """
+    Get the shape of a single record of the tracks column from the schema metadata.
+    :param schema: pyarrow schema of an enformer parquet file
+    :return: The shape or None if the schema does not record it
+    """
+    if schema.metadata is None or b'tracks_shape' not in schema.metadata:
+        return None
+    return tuple(int(x) for x in schema.metadata[b'tracks_shape'].split(b';'))
+
+
+def get_track_indices(schema: pa.Schema) -> list[int] | None:
+    """
+    Get the original enformer indices of the stored tracks from the schema metadata.
+    :param schema: pyarrow schema of an enformer parquet file
+    :return: The track indices or None if all tracks are stored
+    """
+    if schema.metadata is None or b'track_indices' not in schema.metadata:
+        return None
+    return [int(x) for x in schema.metadata[b'track_indices'].split(b';')]
+
+
+def get_tracks_dtype(schema: pa.Schema) -> str:
+    """
+    Get the storage encoding of the tracks column from the schema metadata.
+    :param schema: pyarrow schema of an enformer parquet file
+    :return: One of TRACKS_DTYPES. Files without the metadata store float32.
+    """
+    if schema.metadata is None or b'tracks_dtype' not in schema.metadata:
+        return 'float32'
+    return schema.metadata[b'tracks_dtype'].decode()
+
+
+def get_tracks_value_type(tracks_dtype: str) -> pa.DataType:
+    """
+    Get the pyarrow type of the values of the tracks column.
+    The reduced precision encodings are stored as uint16 since polars cannot read float16 parquet columns.
+    :param tracks_dtype: One of TRACKS_DTYPES
+    :return: pyarrow data type
+    """
+    if tracks_dtype not in TRACKS_DTYPES:
+        raise ValueError(f'Unknown tracks dtype: {tracks_dtype}. Must be one of {TRACKS_DTYPES}')
+    return pa.float32() if tracks_dtype == 'float32' else pa.uint16()
+
+
+def encode_tracks(values: np.ndarray, tracks_dtype: str = 'float32') -> np.ndarray:
+    """
+    Encode predictions for storage.
+    - float16 and bfloat16 store the bits of the rounded values as uint16. The values are clipped to the largest
+      finite value, +-np.finfo(np.float16).max (65504) or +-BFLOAT16_MAX (~3.39e38), instead of overflowing to
+      infinity.
+    - log_uint16 stores log(1 + x) quantized in steps of LOG_UINT16_STEP, which bounds the error after the
+      log-transformation of the tissue mapper. Negative values are clipped to 0 and values saturate at
+      expm1(65535 * LOG_UINT16_STEP) (~8.9e6). Non-finite values cannot be stored and raise a ValueError.
+    Clipped values are logged as a warning.
+    :param values: float32 predictions
+    :param tracks_dtype: One of TRACKS_DTYPES
+    :return: numpy array of the stored values
+    """
+    get_tracks_value_type(tracks_dtype)
+    values = np.asarray(values, dtype=np.float32)
+    if tracks_dtype == 'float32':
+        return values
+    if tracks_dtype in ['float16', 'bfloat16']:
+        max_value = np.finfo(np.float16).max if tracks_dtype == 'float16' else BFLOAT16_MAX
+        _warn_clipped(np.abs(values) > max_value, tracks_dtype, f'+-{max_value:.6g}')
+        values = np.clip(values, -max_value, max_value)
+        if tracks_dtype == 'float16':
+            return values.astype(np.float16).view(np.uint16)
+        bits = np.ascontiguousarray(values).view(np.uint32)
+        # round to the nearest bfloat16, ties to even
+        bits = bits + (0x7FFF + ((bits >> 16) & 1)).astype(np.uint32)
+        return (bits >> 16).astype(np.uint16)
+    # log_uint16
+    if not np.isfinite(values).all():
+        raise ValueError(f'{np.count_nonzero(~np.isfinite(values))} non-finite predictions cannot be encoded '
+                         f'as {tracks_dtype}')
+    max_quantized = np.iinfo(np.uint16).max
+    quantized = np.rint(np.log1p(np.maximum(values, 0)) / LOG_UINT16_STEP)
+    _warn_clipped(quantized > max_quantized, tracks_dtype, f'{np.expm1(max_quantized * LOG_UINT16_STEP):.4g}')
+    return np.minimum(quantized, max_quantized).astype(np.uint16)
+
+
+def _warn_clipped(clipped: np.ndarray, tracks_dtype: str, limit: str):
+    num_clipped = np.count_nonzero(clipped)
+    if num_clipped > 0:
+        logger.warning(f'{num_clipped} predictions exceed the range of {tracks_dtype} and are clipped to {limit}')
+
+
+def decode_tracks(values: np.ndarray, tracks_dtype: str = 'float32') -> np.ndarray:
+    """
+    Decode stored predictions, see encode_tracks.
+    :param values: numpy array of the stored values
+    :param tracks_dtype: One of TRACKS_DTYPES
+    :return: float32 predictions
+    """
+    get_tracks_value_type(tracks_dtype)
+    if tracks_dtype == 'float32':
+        return values.astype(np.float32, copy=False)
+    values = np.ascontiguousarray(values, dtype=np.uint16)
+    if tracks_dtype == 'float16':
+        return values.view(np.float16).astype(np.float32)
+    if tracks_dtype == 'bfloat16':
+        return (values.astype(np.uint32) << 16).view(np.float32)
+    # log_uint16
+    return np.expm1(values * np.float32(LOG_UINT16_STEP)).astype(np.float32)
+
+
+def get_track_positions(stored_tracks: list[int] | None, selected_tracks: list[int] | None) -> list[int] | None:
+    """
+    Get the positions of the selected tracks in an array that stores the given tracks.
+    :param stored_tracks: The original indices of the stored tracks. None if all tracks are stored.
+    :param selected_tracks: The original indices of the selected tracks. None if all stored tracks are selected.
+    :return: The positions of the selected tracks or None if all stored tracks are selected
+    """
+    if selected_tracks is None or stored_tracks is None:
+        return selected_tracks
+    positions = {track: i for i, track in enumerate(stored_tracks)}
+    missing = [track for track in selected_tracks if track not in positions]
+    if len(missing) > 0:
+        raise ValueError(f'The tracks {missing} are not stored in the predictions.')
+    return [positions[track] for track in selected_tracks]
+
+
+def get_parquet_files(path: str | pathlib.Path) -> list[pathlib.Path]:
+    """
+    Get the parquet files of a dataset.
+    :param path: A parquet file or a directory of parquet files, e.g. the shard partitions of Enformer.predict_sharded
+    :return: The parquet files in the order of the dataset
+    """
+    path = pathlib.Path(path)
+    if path.is_dir():
+        return sorted(p for p in path.rglob('*.parquet') if p.is_file())
+    return [path]
+
+
+def partition_by_chromosome(path: str | pathlib.Path, output_path: str | pathlib.Path, column: str = 'chrom',
+                            filename: str = 'data.parquet') -> list[pathlib.Path]:
+    """
+    Split a parquet dataset with a chromosome column into hive partitions output_path/chrom=<chromosome>/filename,
+    the per-chromosome layout of the reference predictions, e.g. ref.parquet/chrom=chr22/data.parquet.
+    The chromosome column is dropped from the files because it is restored from the partitions.
+    :param path: A parquet file or a directory of part files, e.g. the predictions of a multi-chromosome
+    RefTSSDataloader or their aggregated or tissue scores
+    :param output_path: The directory of the partitioned dataset
+    :param column: The chromosome column
+    :param filename: The name of the file in each partition
+    :return: The written files
+    """
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    output_path = pathlib.Path(output_path)
+    writers = {}
+    try:
+        for file in get_parquet_files(path):
+            parquet_file = pq.ParquetFile(file)
+            schema = parquet_file.schema_arrow
+            schema = schema.remove(schema.get_field_index(column))
+            for i in range(parquet_file.num_row_groups):
+                table = parquet_file.read_row_group(i)
+                chromosomes = table[column]
+                for chromosome in pc.unique(chromosomes).to_pylist():
+                    if chromosome not in writers:
+                        partition_path = output_path / f'{column}={chromosome}' / filename
+                        partition_path.parent.mkdir(parents=True, exist_ok=True)
+                        writers[chromosome] = pq.ParquetWriter(partition_path, schema)
+                    writers[chromosome].write_table(
+                        table.filter(pc.equal(chromosomes, chromosome)).drop_columns([column]))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return [output_path / f'{column}={chromosome}' / filename for chromosome in sorted(writers)]
+
+
+def load_tracks(tracks: str | pathlib.Path | list[int] | None) -> list[int] | None:
+    """
+    Load a track selection.
+    :param tracks: A yaml file mapping the name of the tracks to the index in the predictions,
+    a list of track indices or None.
+    :return: The list of track indices or None if all tracks are selected
+    """
+    if tracks is None:
+        return None
+    if isinstance(tracks, str) or isinstance(tracks, pathlib.Path):
+        with open(tracks, 'rb') as f:
+            tracks = list(yaml.safe_load(f).values())
+    tracks = [int(x) for x in tracks]
+    assert len(tracks) > 0, 'the track selection must not be empty'
+    return tracks
+
+
+class RandomModel:
     """
     A random model for testing purposes.
     """
 
     def __init__(self, lamda=10):
-        super().__init__()
         self.lamda = lamda
 
     def predict_on_batch(self, input_tensor):
+        import tensorflow as tf
+
         # tf.random.set_seed(42)
         return {
-            'human': tf.abs(tf.random.poisson((input_tensor.shape[0], 896, 5313,), lam=self.lamda)),
-            'mouse': tf.abs(tf.random.poisson((input_tensor.shape[0], 896, 1643), lam=self.lamda)),
+            'human': tf.abs(tf.random.poisson((tf.shape(input_tensor)[0], 896, 5313,), lam=self.lamda)),
+            'mouse': tf.abs(tf.random.poisson((tf.shape(input_tensor)[0], 896, 1643), lam=self.lamda)),
         }
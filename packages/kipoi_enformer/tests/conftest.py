@@ -1,6 +1,10 @@
 import pytest
 import logging
+import numpy as np
 from kipoi_enformer.logger import logger
+from kipoi_enformer.annotation import ANNOTATION_CACHE_ENV
+from kipoi_enformer.utils import HASH_CACHE_ENV
+from kipoi_enformer.constants import AlleleType
 from pathlib import Path
 
 
@@ -15,6 +19,23 @@ def setup_logger():
 def change_test_dir(request, monkeypatch):
     monkeypatch.chdir(Path(request.fspath.dirname).parent.parent.parent)
 
+@pytest.fixture(scope='session')
+def annotation_cache_dir(tmp_path_factory):
+    return tmp_path_factory.mktemp('annotation_cache')
+
+
+@pytest.fixture(scope='session')
+def hash_cache_dir(tmp_path_factory):
+    return tmp_path_factory.mktemp('hash_cache')
+
+
+@pytest.fixture(autouse=True)
+def isolate_annotation_cache(annotation_cache_dir, hash_cache_dir, monkeypatch):
+    # keep the annotation cache and the content hashes of the tests out of the home directory
+    monkeypatch.setenv(ANNOTATION_CACHE_ENV, str(annotation_cache_dir))
+    monkeypatch.setenv(HASH_CACHE_ENV, str(hash_cache_dir))
+
+
 @pytest.fixture
 def output_dir():
     output_dir = Path('output/test/')
@@ -45,3 +66,59 @@ def chr22_example_files():
         'gtex_annotation': base / 'gtex_samples/benchmark_with_annotation.parquet',
         'gtex_folds': base / 'gtex_samples/folds.parquet',
     }
+
+
+@pytest.fixture
+def example_fasta(chr22_example_files):
+    # the example FASTA is not part of the repository
+    fasta = chr22_example_files['fasta']
+    if not fasta.exists():
+        pytest.skip(f'The example FASTA {fasta} is missing')
+    return fasta
+
+
+@pytest.fixture(scope='session')
+def synthetic_fasta(tmp_path_factory):
+    """
+    A random genome with the chromosome lengths of the example FASTA, for the tests that do not depend on
+    the reference bases.
+    """
+    with open(Path(__file__).parents[3] / 'example_files/seq.fa.fai') as f:
+        chrom_lengths = {line.split('\t')[0]: int(line.split('\t')[1]) for line in f.read().splitlines()}
+    rng = np.random.default_rng(0)
+    nucleotides = np.frombuffer(b'ACGT', dtype=np.uint8)
+    fasta = tmp_path_factory.mktemp('synthetic_genome') / 'seq.fa'
+    with open(fasta, 'wb') as f:
+        for chromosome, length in chrom_lengths.items():
+            f.write(f'>{chromosome}\n'.encode())
+            f.write(nucleotides[rng.integers(0, len(nucleotides), size=length)].tobytes())
+            f.write(b'\n')
+    return fasta
+
+
+@pytest.fixture
+def enformer_dataloader(chr22_example_files, synthetic_fasta):
+    """
+    Create the dataloaders of the enformer tests with the shifts and the sequence length of the enformer input:
+    the protein coding transcripts of chr22 or, for AlleleType.ALT, the variants within 500 bases of their TSS.
+    The sequences are extracted from the synthetic genome.
+    The keyword arguments override the default arguments, e.g. size.
+    """
+    from kipoi_enformer.dataloader import TSSDataloader
+
+    def create(allele_type: AlleleType, **kwargs) -> TSSDataloader:
+        args = {
+            'fasta_file': synthetic_fasta,
+            'gtf': chr22_example_files['gtf'],
+            'shifts': [-43, 0, 43],
+            'seq_length': 393_216,
+            'canonical_only': False,
+            'protein_coding_only': True,
+        }
+        if allele_type == AlleleType.REF:
+            args['chromosome'] = 'chr22'
+        else:
+            args.update(vcf_file=chr22_example_files['vcf'], variant_downstream_tss=500, variant_upstream_tss=500)
+        return TSSDataloader.from_allele_type(allele_type, **{**args, **kwargs})
+
+    return create
@@ -1,31 +1,46 @@
 import pytest
+from collections import Counter
 
 from kipoi_enformer.dataloader import TSSDataloader, RefTSSDataloader, VCFTSSDataloader
 from kipoi_enformer.enformer import Enformer, EnformerAggregator, EnformerTissueMapper, EnformerVeff
+from kipoi_enformer.cache import PredictionCache, InputDeduplicator
+from kipoi_enformer.model_store import MODEL_DIR_ENV, export_model, load_model
 from pathlib import Path
+import pyarrow as pa
 import pyarrow.parquet as pq
 from kipoi_enformer.logger import logger
+from kipoi_enformer.utils import nested_list_array_to_numpy, get_tracks_shape, get_track_indices, load_tracks, \
+    get_tracks_dtype, encode_tracks, decode_tracks, partition_by_chromosome, get_parquet_files, LOG_UINT16_STEP, \
+    BFLOAT16_MAX
+from kipoi_enformer.annotation import load_annotation
+from kipoi_enformer.fidelity import precision_report
 import numpy as np
 import pickle
+import subprocess
+import sys
 import polars as pl
 from kipoi_enformer.constants import AlleleType
-from shutil import rmtree
+from shutil import rmtree, copyfile
 from sklearn import linear_model
 import lightgbm as lgb
 
+tf = pytest.importorskip('tensorflow')
 
-def run_enformer(dl: TSSDataloader, output_path, size, batch_size, num_output_bins):
+
+def run_enformer(dl: TSSDataloader, output_path, size, batch_size, num_output_bins, fixed_shape=False):
     enformer = Enformer(is_random=True)
 
-    enformer.predict(dl, batch_size=batch_size, filepath=output_path, num_output_bins=num_output_bins)
+    enformer.predict(dl, batch_size=batch_size, filepath=output_path, num_output_bins=num_output_bins,
+                     fixed_shape=fixed_shape)
     table = pq.read_table(output_path, partitioning=None)
     logger.info(table.schema)
 
     assert table.shape == (size, 1 + len(dl.pyarrow_metadata_schema.names))
+    assert get_tracks_shape(table.schema) == (3, num_output_bins, 5313)
 
-    x = table['tracks'].to_pylist()
-    x = np.array(x)
+    x = nested_list_array_to_numpy(table['tracks'], get_tracks_shape(table.schema))
     assert x.shape == (size, 3, num_output_bins, 5313)
+    assert np.array_equal(x[0], np.array(table['tracks'][0].as_py()))
 
 
 def get_enformer_path(output_dir: Path, size: int, allele_type: AlleleType, rm=False):
@@ -77,6 +92,8 @@ def get_veff_path(output_dir: Path, size: int, rm=False):
     (3, 1, 21), (5, 3, 21), (10, 5, 21), (100, 5, 21),
 ])
 def test_enformer_ref(chr22_example_files, output_dir: Path, size, batch_size, num_output_bins):
+    if not chr22_example_files['fasta'].exists():
+        pytest.skip(f"The example FASTA {chr22_example_files['fasta']} is missing")
     args = {
         'fasta_file': chr22_example_files['fasta'],
         'gtf': chr22_example_files['gtf'],
@@ -93,11 +110,562 @@ def test_enformer_ref(chr22_example_files, output_dir: Path, size, batch_size, n
     run_enformer(dl, enformer_filepath, size, batch_size=batch_size, num_output_bins=num_output_bins)
 
 
+@pytest.mark.parametrize("size, batch_size, num_output_bins", [
+    (5, 3, 21), (10, 5, 11),
+])
+def test_enformer_fixed_shape(enformer_dataloader, output_dir: Path, size, batch_size, num_output_bins):
+    enformer_filepath = output_dir / f'enformer_{size}/raw/fixed_shape_ref.parquet'
+    enformer_filepath.parent.mkdir(parents=True, exist_ok=True)
+    dl = enformer_dataloader(AlleleType.REF, size=size)
+    run_enformer(dl, enformer_filepath, size, batch_size=batch_size, num_output_bins=num_output_bins,
+                 fixed_shape=True)
+
+    table = pq.read_table(enformer_filepath)
+    raw_tracks = nested_list_array_to_numpy(table['tracks'])
+    assert raw_tracks.shape == (size, 3, num_output_bins, 5313)
+
+    agg_path = output_dir / f'enformer_{size}/fixed_shape_aggregated.parquet'
+    EnformerAggregator().aggregate(enformer_filepath, agg_path, num_bins=3)
+    agg_table = pq.read_table(agg_path)
+    assert agg_table.schema.field('tracks').type == pa.list_(pa.float32(), 5313)
+    agg_tracks = nested_list_array_to_numpy(agg_table['tracks'])
+    assert agg_tracks.shape == (size, 5313)
+    assert np.allclose(agg_tracks, EnformerAggregator._aggregate_batch(raw_tracks, Enformer.BIN_SIZE, 3,
+                                                                       [-43, 0, 43]))
+
+
+@pytest.mark.parametrize("size, batch_size, num_output_bins", [
+    (5, 3, 21), (10, 5, 11),
+])
+def test_enformer_aggregate(enformer_dataloader, output_dir: Path, size, batch_size, num_output_bins):
+    base_path = output_dir / f'enformer_{size}/fused'
+    base_path.mkdir(parents=True, exist_ok=True)
+    dl = enformer_dataloader(AlleleType.ALT, size=size)
+    enformer = Enformer(is_random=True)
+    enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'aggregated.parquet',
+                     num_output_bins=num_output_bins, aggregate=True, num_bins=3,
+                     raw_filepath=base_path / 'raw.parquet')
+    EnformerAggregator().aggregate(base_path / 'raw.parquet', base_path / 'aggregated_from_raw.parquet',
+                                   num_bins=3)
+
+    fused = pq.read_table(base_path / 'aggregated.parquet')
+    from_raw = pq.read_table(base_path / 'aggregated_from_raw.parquet')
+    assert fused.schema.equals(from_raw.schema, check_metadata=True)
+    assert fused.schema.metadata[b'nbins'] == b'3'
+    assert fused.shape == (size, 1 + len(dl.pyarrow_metadata_schema.names))
+    assert fused.equals(from_raw)
+
+
+@pytest.mark.parametrize("size, batch_size, queue_depth, num_workers", [
+    (7, 2, 1, 1), (10, 3, 2, 2),
+])
+def test_enformer_pipelined(enformer_dataloader, output_dir: Path, size, batch_size, queue_depth, num_workers,
+                            num_output_bins=11):
+    base_path = output_dir / f'enformer_{size}/pipelined'
+    base_path.mkdir(parents=True, exist_ok=True)
+    dl = enformer_dataloader(AlleleType.ALT, size=size)
+    enformer = Enformer(is_random=True)
+    enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'serial.parquet', num_output_bins=num_output_bins)
+    enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'pipelined.parquet',
+                     num_output_bins=num_output_bins, queue_depth=queue_depth, num_workers=num_workers)
+
+    serial = pq.read_table(base_path / 'serial.parquet')
+    pipelined = pq.read_table(base_path / 'pipelined.parquet')
+    assert pipelined.schema.equals(serial.schema, check_metadata=True)
+    assert pipelined.drop_columns(['tracks']).equals(serial.drop_columns(['tracks']))
+    assert nested_list_array_to_numpy(pipelined['tracks']).shape == (size, 3, num_output_bins, 5313)
+
+
+@pytest.mark.parametrize("queue_depth", [0, 2])
+def test_enformer_checkpoint(enformer_dataloader, synthetic_fasta, output_dir: Path, queue_depth, size=9,
+                             batch_size=2, num_output_bins=11):
+    base_path = output_dir / f'enformer_{size}/checkpoint_{queue_depth}'
+    if base_path.exists():
+        rmtree(base_path)
+    base_path.mkdir(parents=True)
+    checkpoint_dir = base_path / 'checkpoint'
+    # a copy of the genome that is regenerated below
+    fasta = base_path / 'seq.fa'
+    copyfile(synthetic_fasta, fasta)
+    dl = enformer_dataloader(AlleleType.REF, size=size, fasta_file=fasta)
+    enformer = Enformer(is_random=True)
+
+    # interrupt the run after two batches
+    process_batch = enformer._process_batch
+    num_calls = 0
+
+    def interrupted_process_batch(*args, **kwargs):
+        nonlocal num_calls
+        num_calls += 1
+        if num_calls > 2:
+            raise KeyboardInterrupt()
+        return process_batch(*args, **kwargs)
+
+    enformer._process_batch = interrupted_process_batch
+    with pytest.raises(KeyboardInterrupt):
+        enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'raw.parquet',
+                         num_output_bins=num_output_bins, queue_depth=queue_depth, checkpoint_dir=checkpoint_dir)
+    assert not (base_path / 'raw.parquet').exists()
+    committed = pq.read_table(checkpoint_dir / 'raw' / 'part-000000000000.parquet')
+
+    # resuming with a different configuration fails
+    with pytest.raises(ValueError):
+        enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'raw.parquet',
+                         num_output_bins=num_output_bins + 2, checkpoint_dir=checkpoint_dir)
+
+    # resuming with another model fails
+    with pytest.raises(ValueError, match='model_id'):
+        Enformer(is_random=True, lamda=5).predict(dl, batch_size=batch_size, filepath=base_path / 'raw.parquet',
+                                                  num_output_bins=num_output_bins, checkpoint_dir=checkpoint_dir)
+
+    # resuming with a regenerated genome of the same path fails
+    content = fasta.read_bytes()
+    index = content.index(b'\n') + 1
+    fasta.write_bytes(content[:index] + (b'C' if content[index:index + 1] == b'A' else b'A') + content[index + 1:])
+    with pytest.raises(ValueError, match='file_hashes'):
+        enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'raw.parquet',
+                         num_output_bins=num_output_bins, checkpoint_dir=checkpoint_dir)
+    fasta.write_bytes(content)
+
+    # resume the run
+    enformer._process_batch = process_batch
+    enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'raw.parquet', num_output_bins=num_output_bins,
+                     queue_depth=queue_depth, checkpoint_dir=checkpoint_dir)
+    assert not checkpoint_dir.exists()
+
+    enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'reference.parquet',
+                     num_output_bins=num_output_bins)
+    table = pq.read_table(base_path / 'raw.parquet')
+    reference = pq.read_table(base_path / 'reference.parquet')
+    assert table.schema.equals(reference.schema, check_metadata=True)
+    assert table.drop_columns(['tracks']).equals(reference.drop_columns(['tracks']))
+    # the committed batch was not predicted again
+    assert table.slice(0, batch_size).equals(committed)
+
+
+@pytest.mark.parametrize("queue_depth", [0, 2])
+def test_enformer_cache(enformer_dataloader, output_dir: Path, queue_depth, size=7, batch_size=2, num_output_bins=11):
+    base_path = output_dir / f'enformer_{size}/cache_{queue_depth}'
+    if base_path.exists():
+        rmtree(base_path)
+    base_path.mkdir(parents=True)
+    cache = PredictionCache(base_path / 'cache')
+    enformer = Enformer(is_random=True)
+
+    # count the records run through the model
+    predict_sequences = enformer._predict_sequences
+    num_predicted = 0
+
+    def counting_predict_sequences(sequences, *args, **kwargs):
+        nonlocal num_predicted
+        num_predicted += len(sequences)
+        return predict_sequences(sequences, *args, **kwargs)
+
+    enformer._predict_sequences = counting_predict_sequences
+
+    enformer.predict(enformer_dataloader(AlleleType.REF, size=size - 3), batch_size=batch_size,
+                     filepath=base_path / 'first.parquet', num_output_bins=num_output_bins, queue_depth=queue_depth,
+                     cache=cache)
+    assert num_predicted == size - 3 and cache.misses == size - 3
+
+    # only the new records are predicted by the second run
+    num_predicted = 0
+    enformer.predict(enformer_dataloader(AlleleType.REF, size=size), batch_size=batch_size,
+                     filepath=base_path / 'second.parquet', num_output_bins=num_output_bins, queue_depth=queue_depth,
+                     cache=base_path / 'cache')
+    assert num_predicted == 3
+
+    first = pq.read_table(base_path / 'first.parquet')
+    second = pq.read_table(base_path / 'second.parquet')
+    assert first.schema.equals(second.schema, check_metadata=True)
+    assert second.slice(0, size - 3).equals(first)
+    assert nested_list_array_to_numpy(second['tracks']).shape == (size, 3, num_output_bins, 5313)
+
+    # a different model configuration does not use the cached predictions
+    num_predicted = 0
+    enformer.predict(enformer_dataloader(AlleleType.REF, size=size), batch_size=batch_size,
+                     filepath=base_path / 'bins.parquet', num_output_bins=num_output_bins + 2, cache=cache)
+    assert num_predicted == size
+
+
+@pytest.mark.parametrize("queue_depth, max_pending_inputs", [(0, None), (2, None), (0, 1), (2, 1)])
+def test_enformer_deduplicate(enformer_dataloader, output_dir: Path, queue_depth, max_pending_inputs, size=12,
+                              batch_size=3, num_output_bins=11):
+    base_path = output_dir / f'enformer_{size}/deduplicate_{queue_depth}_{max_pending_inputs}'
+    if base_path.exists():
+        rmtree(base_path)
+    base_path.mkdir(parents=True)
+    dl = enformer_dataloader(AlleleType.REF, size=size)
+    input_keys = [input_key for _, input_key in dl.iter_records()]
+    # transcripts sharing a TSS within and across batches
+    assert len(set(input_keys)) < size
+
+    enformer = Enformer(is_random=True)
+    predict_sequences = enformer._predict_sequences
+    num_predicted = 0
+
+    def counting_predict_sequences(sequences, *args, **kwargs):
+        nonlocal num_predicted
+        num_predicted += len(sequences)
+        return predict_sequences(sequences, *args, **kwargs)
+
+    enformer._predict_sequences = counting_predict_sequences
+    enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'dedup.parquet', num_output_bins=num_output_bins,
+                     queue_depth=queue_depth, deduplicate=True, max_pending_inputs=max_pending_inputs)
+    if max_pending_inputs is None:
+        assert num_predicted == len(set(input_keys))
+    else:
+        # the inputs beyond the kept ones are predicted again
+        assert len(set(input_keys)) <= num_predicted < size
+
+    num_predicted = 0
+    enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'all.parquet', num_output_bins=num_output_bins,
+                     queue_depth=queue_depth, deduplicate=False)
+    assert num_predicted == size
+
+    dedup = pq.read_table(base_path / 'dedup.parquet')
+    reference = pq.read_table(base_path / 'all.parquet')
+    assert dedup.schema.equals(reference.schema, check_metadata=True)
+    assert dedup.drop_columns(['tracks']).equals(reference.drop_columns(['tracks']))
+    # the predictions are fanned out to all records of an input
+    tracks = nested_list_array_to_numpy(dedup['tracks'])
+    assert tracks.shape == (size, 3, num_output_bins, 5313)
+    for i, input_key in enumerate(input_keys):
+        first = input_keys.index(input_key)
+        assert np.array_equal(tracks[i], tracks[first])
+
+
+@pytest.mark.parametrize("max_pending", [None, 0, 1, 2])
+def test_input_deduplicator(max_pending):
+    input_keys = ['a', 'b', 'a', 'c', 'b', 'c', 'a', 'd', 'c']
+    deduplicator = InputDeduplicator(Counter(input_keys), max_pending=max_pending)
+    assert deduplicator.duplicates == {'a', 'b', 'c'}
+    # the planned records replay the decisions of put
+    planned = [deduplicator.plan(input_key) for input_key in input_keys]
+    for input_key, is_kept in zip(input_keys, planned):
+        predictions = deduplicator.get(input_key)
+        assert (predictions is not None) == is_kept
+        if predictions is None:
+            predictions = np.array([ord(input_key)])
+        assert predictions[0] == ord(input_key)
+        deduplicator.put(input_key, predictions)
+        assert max_pending is None or len(deduplicator._predictions) <= max_pending
+    assert deduplicator._predictions == {}
+    num_kept = {None: 5, 0: 0, 1: 2, 2: 4}[max_pending]
+    assert sum(planned) == num_kept
+
+
+def test_enformer_memory_budget(enformer_dataloader, output_dir: Path, size=5, num_output_bins=11):
+    base_path = output_dir / f'enformer_{size}/memory_budget'
+    base_path.mkdir(parents=True, exist_ok=True)
+    dl = enformer_dataloader(AlleleType.REF, size=size)
+    # run the model eagerly to fail on the concrete batch sizes
+    enformer = Enformer(is_random=True, compiled=False)
+    record_memory = Enformer.estimate_record_memory(num_shifts=3, num_output_bins=num_output_bins)
+    assert record_memory > 3 * Enformer.NUM_PREDICTION_BINS * Enformer.NUM_HUMAN_TRACKS * 4
+
+    # the model fails to allocate memory for more than one record
+    predict_on_batch = enformer._model.predict_on_batch
+    model_batch_sizes = []
+
+    def limited_predict_on_batch(input_tensor):
+        if input_tensor.shape[0] > 3:
+            raise tf.errors.ResourceExhaustedError(None, None, 'OOM')
+        model_batch_sizes.append(input_tensor.shape[0] // 3)
+        return predict_on_batch(input_tensor)
+
+    enformer._model.predict_on_batch = limited_predict_on_batch
+    process_batch = enformer._process_batch
+    batch_sizes = []
+
+    def recording_process_batch(batch, *args, **kwargs):
+        batch_sizes.append(len(batch['metadata']['tss']))
+        return process_batch(batch, *args, **kwargs)
+
+    enformer._process_batch = recording_process_batch
+    enformer.predict(dl, batch_size=None, filepath=base_path / 'raw.parquet', num_output_bins=num_output_bins,
+                     memory_budget=int(2.5 * record_memory))
+    assert batch_sizes == [2, 2, 1]
+    assert enformer.max_model_batch_size == 1
+    assert model_batch_sizes == [1] * size
+
+    table = pq.read_table(base_path / 'raw.parquet')
+    assert nested_list_array_to_numpy(table['tracks']).shape == (size, 3, num_output_bins, 5313)
+
+    # batch_size is an upper bound
+    batch_sizes.clear()
+    enformer.predict(dl, batch_size=1, filepath=base_path / 'raw.parquet', num_output_bins=num_output_bins,
+                     memory_budget=int(2.5 * record_memory))
+    assert batch_sizes == [1] * size
+
+    # the predictions kept by the deduplicator are deducted from the budget
+    deduplicator_memory = Enformer.estimate_deduplicator_memory(num_shifts=3, num_output_bins=num_output_bins,
+                                                                max_pending_inputs=4)
+    assert deduplicator_memory == 4 * 3 * num_output_bins * Enformer.NUM_HUMAN_TRACKS * 4
+    assert enformer._budget_batch_size(2 * record_memory + deduplicator_memory, None, 3, num_output_bins,
+                                       Enformer.NUM_HUMAN_TRACKS, 0, max_pending_inputs=4) == 2
+    assert enformer._budget_batch_size(2 * record_memory, None, 3, num_output_bins,
+                                       Enformer.NUM_HUMAN_TRACKS, 0, max_pending_inputs=4) == 1
+
+
+def test_enformer_sharded(enformer_dataloader, output_dir: Path, size=5, batch_size=2, num_output_bins=11):
+    base_path = output_dir / f'enformer_{size}/sharded'
+    if base_path.exists():
+        rmtree(base_path)
+    base_path.mkdir(parents=True)
+    dl = enformer_dataloader(AlleleType.REF, size=size)
+    enformer = Enformer(is_random=True)
+    enformer.predict_sharded(dl, base_path / 'raw', num_workers=2, threads_per_worker=1, batch_size=batch_size,
+                             num_output_bins=num_output_bins)
+    enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'reference.parquet',
+                     num_output_bins=num_output_bins)
+
+    shard_files = get_parquet_files(base_path / 'raw')
+    assert [x.relative_to(base_path / 'raw').as_posix() for x in shard_files] == ['shard=00000/data.parquet',
+                                                                                  'shard=00001/data.parquet']
+    assert [pq.read_metadata(x).num_rows for x in shard_files] == [2, 3]
+    sharded = pa.concat_tables([pq.read_table(x, partitioning=None) for x in shard_files])
+    reference = pq.read_table(base_path / 'reference.parquet')
+    assert sharded.schema.equals(reference.schema, check_metadata=True)
+    assert sharded.drop_columns(['tracks']).equals(reference.drop_columns(['tracks']))
+
+    # the directory is consumed like a single file
+    EnformerAggregator().aggregate(base_path / 'raw', base_path / 'aggregated.parquet', num_bins=3)
+    aggregated = pq.read_table(base_path / 'aggregated.parquet')
+    assert aggregated['transcript_id'].to_pylist() == reference['transcript_id'].to_pylist()
+
+
+@pytest.mark.parametrize("sequences_dtype, queue_depth", [('float32', 0), ('uint8', 0), ('uint8', 2)])
+def test_enformer_sequences_dtype(enformer_dataloader, output_dir: Path, sequences_dtype, queue_depth, size=5,
+                                  batch_size=2, num_output_bins=11):
+    base_path = output_dir / f'enformer_{size}/sequences_dtype'
+    base_path.mkdir(parents=True, exist_ok=True)
+    dl = enformer_dataloader(AlleleType.REF, size=size)
+    enformer = Enformer(is_random=True, compiled=False)
+
+    # record the sequences the model is run on
+    predict_on_batch = enformer._model.predict_on_batch
+    model_inputs = []
+
+    def recording_predict_on_batch(input_tensor):
+        model_inputs.append(input_tensor.numpy().reshape(-1, 3, *input_tensor.shape[1:]))
+        return predict_on_batch(input_tensor)
+
+    enformer._model.predict_on_batch = recording_predict_on_batch
+    enformer.predict(dl, batch_size=batch_size, filepath=base_path / f'{sequences_dtype}.parquet',
+                     num_output_bins=num_output_bins, queue_depth=queue_depth, deduplicate=False,
+                     sequences_dtype=sequences_dtype)
+
+    # the model runs on the float32 sequences of the records, also if the batches are assembled ahead
+    assert all(x.dtype == np.float32 for x in model_inputs)
+    expected = [dl.extract_sequences(input_key) for _, input_key in dl.iter_records()]
+    assert np.array_equal(np.concatenate(model_inputs), np.stack(expected))
+
+
+def test_enformer_multi_chromosome(chr22_example_files, enformer_dataloader, output_dir: Path, batch_size=3,
+                                   num_output_bins=11):
+    # two transcripts of each chromosome
+    gtf = load_annotation(chr22_example_files['gtf']).query("`Feature` == 'transcript'").groupby('Chromosome').head(2)
+    base_path = output_dir / 'enformer_multi_chromosome'
+    if base_path.exists():
+        rmtree(base_path)
+    base_path.mkdir(parents=True)
+    dl = enformer_dataloader(AlleleType.REF, gtf=gtf, chromosome=None, protein_coding_only=False)
+    enformer = Enformer(is_random=True)
+    enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'raw.parquet', num_output_bins=num_output_bins)
+    table = pq.read_table(base_path / 'raw.parquet')
+    assert table['chrom'].to_pylist() == ['chr21', 'chr21', 'chr22', 'chr22']
+
+    # the partitions have the layout and the schema of the per-chromosome predictions
+    paths = partition_by_chromosome(base_path / 'raw.parquet', base_path / 'ref.parquet')
+    assert paths == [base_path / f'ref.parquet/chrom={x}/data.parquet' for x in ['chr21', 'chr22']]
+    enformer.predict(enformer_dataloader(AlleleType.REF, gtf=gtf, protein_coding_only=False),
+                     batch_size=batch_size, filepath=base_path / 'chr22.parquet', num_output_bins=num_output_bins)
+    chr22_table = pq.read_table(base_path / 'chr22.parquet')
+    partition_table = pq.read_table(paths[1], partitioning=None)
+    assert partition_table.schema.equals(chr22_table.schema, check_metadata=True)
+    assert partition_table.drop_columns(['tracks']).sort_by('transcript_id').equals(
+        chr22_table.drop_columns(['tracks']).sort_by('transcript_id'))
+    partitioned = pl.read_parquet(base_path / 'ref.parquet', hive_partitioning=True)
+    assert partitioned['chrom'].to_list() == table['chrom'].to_pylist()
+
+
+@pytest.mark.parametrize("jit_compile", [False, True])
+def test_enformer_compiled(enformer_dataloader, output_dir: Path, jit_compile, size=3, batch_size=2,
+                           num_output_bins=11):
+    base_path = output_dir / f'enformer_{size}/compiled_{jit_compile}'
+    base_path.mkdir(parents=True, exist_ok=True)
+    tracks = [0, 10, 100]
+
+    results = {}
+    for compiled in [False, True]:
+        enformer = Enformer(is_random=True, compiled=compiled, jit_compile=compiled and jit_compile)
+        enformer.predict(enformer_dataloader(AlleleType.REF, size=size), batch_size=batch_size,
+                         filepath=base_path / f'{compiled}.parquet', num_output_bins=num_output_bins, tracks=tracks)
+        results[compiled] = pq.read_table(base_path / f'{compiled}.parquet')
+        stats = enformer.model_stats
+        assert stats['num_calls'] == (size + batch_size - 1) // batch_size
+        assert stats['num_records'] == size
+        if compiled:
+            # the function is compiled once, only the output bins and tracks are copied to the host
+            assert stats['compile_time'] > 0
+            assert len(enformer._predict_fns) == 1
+            assert stats['host_bytes'] == size * 3 * num_output_bins * len(tracks) * 4
+        else:
+            assert stats['compile_time'] == 0
+            assert stats['host_bytes'] == size * 3 * Enformer.NUM_PREDICTION_BINS * Enformer.NUM_HUMAN_TRACKS * 4
+
+    assert results[True].schema.equals(results[False].schema, check_metadata=True)
+    assert results[True].drop(['tracks']).equals(results[False].drop(['tracks']))
+    tracks_array = np.array(results[True]['tracks'].to_pylist())
+    assert tracks_array.shape == (size, 3, num_output_bins, len(tracks))
+
+
+def test_post_processing_imports():
+    # the post-processing stages do not load tensorflow or the other heavy dependencies
+    heavy_modules = ['tensorflow', 'tensorflow_hub', 'sklearn', 'xarray', 'scipy', 'pyranges', 'kipoi']
+    script = ('import sys; from kipoi_enformer.enformer import EnformerAggregator, EnformerTissueMapper, EnformerVeff; '
+              f'print([x for x in {heavy_modules!r} if x in sys.modules])')
+    output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout
+    assert output.strip() == '[]'
+
+
+def test_model_store(output_dir: Path, monkeypatch):
+    # a small saved model with the structure of the TF-Hub model
+    hub_dir = output_dir / 'model_store/hub'
+    hub_module = tf.Module()
+    hub_module.model = tf.Module()
+    hub_module.model.predict_on_batch = tf.function(
+        lambda x: {'human': tf.zeros([tf.shape(x)[0], Enformer.NUM_PREDICTION_BINS, Enformer.NUM_HUMAN_TRACKS])},
+        input_signature=[tf.TensorSpec([None, Enformer.INPUT_SEQUENCE_LENGTH, 4], tf.float32)])
+    tf.saved_model.save(hub_module, str(hub_dir))
+
+    model_dir = output_dir / 'model_store/enformer'
+    if model_dir.exists():
+        rmtree(model_dir)
+    with pytest.raises(FileNotFoundError):
+        load_model(model_dir)
+
+    monkeypatch.setattr('tensorflow_hub.resolve', lambda handle: str(hub_dir))
+    export_model(model_dir)
+    assert (model_dir / 'saved_model.pb').exists()
+
+    # the model is loaded lazily and shared by all instances
+    monkeypatch.setenv(MODEL_DIR_ENV, str(model_dir))
+    enformer = Enformer()
+    assert enformer.model_dir == model_dir
+    assert enformer._loaded_model is None
+    assert enformer._model is Enformer()._model
+    predictions = enformer._run_model(np.zeros((1, 2, Enformer.INPUT_SEQUENCE_LENGTH, 4), dtype=np.float32),
+                                      num_output_bins=3, tracks=[0, 1])
+    assert predictions.shape == (1, 2, 3, 2)
+
+
+@pytest.mark.parametrize("tracks_dtype", ['float16', 'bfloat16', 'log_uint16'])
+def test_enformer_tracks_dtype(enformer_dataloader, output_dir: Path, tracks_dtype, size=3, batch_size=2,
+                               num_output_bins=11):
+    base_path = output_dir / f'enformer_{size}/tracks_dtype_{tracks_dtype}'
+    base_path.mkdir(parents=True, exist_ok=True)
+    enformer = Enformer(is_random=True)
+    enformer.predict(enformer_dataloader(AlleleType.REF, size=size), batch_size=batch_size,
+                     filepath=base_path / 'raw.parquet', num_output_bins=num_output_bins)
+    raw = pq.read_table(base_path / 'raw.parquet')
+    assert get_tracks_dtype(raw.schema) == 'float32'
+
+    # the reduced precision is recorded in the schema and decoded by the aggregator
+    aggregator = EnformerAggregator()
+    aggregator.aggregate(base_path / 'raw.parquet', base_path / 'aggregated.parquet')
+    aggregator.aggregate(base_path / 'raw.parquet', base_path / 'reduced.parquet', tracks_dtype=tracks_dtype)
+    reduced = pq.read_table(base_path / 'reduced.parquet')
+    assert get_tracks_dtype(reduced.schema) == tracks_dtype
+    assert reduced.schema.field('tracks').type == pa.list_(pa.uint16(), 5313)
+    expected = nested_list_array_to_numpy(pq.read_table(base_path / 'aggregated.parquet')['tracks'])
+    observed = decode_tracks(nested_list_array_to_numpy(reduced['tracks']), tracks_dtype)
+    assert np.allclose(np.log10(observed + 1), np.log10(expected + 1), atol=2e-3)
+
+    # raw predictions stored with reduced precision are aggregated with the same encoding
+    enformer.predict(enformer_dataloader(AlleleType.REF, size=size), batch_size=batch_size,
+                     filepath=base_path / 'raw_reduced.parquet', num_output_bins=num_output_bins,
+                     tracks_dtype=tracks_dtype)
+    raw_reduced = pq.read_table(base_path / 'raw_reduced.parquet')
+    assert get_tracks_dtype(raw_reduced.schema) == tracks_dtype
+    assert raw_reduced.drop_columns(['tracks']).equals(raw.drop_columns(['tracks']))
+    aggregator.aggregate(base_path / 'raw_reduced.parquet', base_path / 'aggregated_reduced.parquet')
+    assert get_tracks_dtype(pq.read_schema(base_path / 'aggregated_reduced.parquet')) == tracks_dtype
+
+
+def test_encode_tracks_out_of_range():
+    values = np.array([1., 7e4, -7e4, 1e7, np.inf], dtype=np.float32)
+    # float16 clips instead of overflowing to infinity
+    decoded = decode_tracks(encode_tracks(values, 'float16'), 'float16')
+    max_float16 = np.finfo(np.float16).max
+    assert np.isfinite(decoded).all()
+    assert decoded.tolist() == [1., max_float16, -max_float16, max_float16, max_float16]
+
+    # bfloat16 clips the values that round to infinity
+    large_values = np.array([1., 3.3e38, 3.4e38, -3.4e38, np.finfo(np.float32).max, np.inf], dtype=np.float32)
+    decoded = decode_tracks(encode_tracks(large_values, 'bfloat16'), 'bfloat16')
+    assert np.isfinite(decoded).all()
+    assert decoded[0] == 1.
+    assert decoded[1] == pytest.approx(3.3e38, rel=2 ** -8)
+    assert decoded[2:].tolist() == [BFLOAT16_MAX, -BFLOAT16_MAX, BFLOAT16_MAX, BFLOAT16_MAX]
+
+    # log_uint16 saturates at the largest quantized value
+    decoded = decode_tracks(encode_tracks(values[:4], 'log_uint16'), 'log_uint16')
+    saturation = np.expm1(np.float32(np.iinfo(np.uint16).max * LOG_UINT16_STEP))
+    assert decoded[0] == pytest.approx(1., rel=1e-3)
+    assert decoded[1] == pytest.approx(7e4, rel=1e-3)
+    assert decoded[2] == 0
+    assert decoded[3] == pytest.approx(saturation, rel=1e-6)
+    # non-finite values cannot be stored
+    for value in [np.nan, np.inf]:
+        with pytest.raises(ValueError):
+            encode_tracks(np.array([1., value], dtype=np.float32), 'log_uint16')
+
+
+def test_enformer_tracks(enformer_dataloader, output_dir: Path, enformer_tracks_path: Path,
+                         gtex_tissue_mapper_path: Path, size=5, batch_size=3, num_output_bins=11):
+    tracks = load_tracks(enformer_tracks_path)
+    base_path = output_dir / f'enformer_{size}/tracks'
+    base_path.mkdir(parents=True, exist_ok=True)
+    dl = enformer_dataloader(AlleleType.REF, size=size)
+    enformer = Enformer(is_random=True)
+
+    # select the tracks at inference time
+    enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'subset_aggregated.parquet',
+                     num_output_bins=num_output_bins, aggregate=True, raw_filepath=base_path / 'subset_raw.parquet',
+                     tracks=enformer_tracks_path)
+    raw_schema = pq.read_schema(base_path / 'subset_raw.parquet')
+    assert get_tracks_shape(raw_schema) == (3, num_output_bins, len(tracks))
+    assert get_track_indices(raw_schema) == tracks
+    agg_table = pq.read_table(base_path / 'subset_aggregated.parquet')
+    assert get_track_indices(agg_table.schema) == tracks
+    assert nested_list_array_to_numpy(agg_table['tracks']).shape == (size, len(tracks))
+
+    # select the tracks during aggregation
+    enformer.predict(dl, batch_size=batch_size, filepath=base_path / 'raw.parquet', num_output_bins=num_output_bins)
+    aggregator = EnformerAggregator()
+    aggregator.aggregate(base_path / 'raw.parquet', base_path / 'aggregated.parquet')
+    aggregator.aggregate(base_path / 'raw.parquet', base_path / 'aggregated_subset.parquet',
+                         tracks=enformer_tracks_path)
+    full = nested_list_array_to_numpy(pq.read_table(base_path / 'aggregated.parquet')['tracks'])
+    subset = nested_list_array_to_numpy(pq.read_table(base_path / 'aggregated_subset.parquet')['tracks'])
+    assert np.array_equal(full[:, tracks], subset)
+
+    # the tissue mapper resolves the stored tracks
+    tissue_mapper = EnformerTissueMapper(tracks_path=enformer_tracks_path, tissue_mapper_path=gtex_tissue_mapper_path)
+    tissue_mapper.predict(base_path / 'aggregated.parquet', base_path / 'tissue.parquet')
+    tissue_mapper.predict(base_path / 'aggregated_subset.parquet', base_path / 'tissue_subset.parquet')
+    assert pl.read_parquet(base_path / 'tissue.parquet').equals(pl.read_parquet(base_path / 'tissue_subset.parquet'))
+
+
 @pytest.mark.parametrize("size, batch_size, num_output_bins", [
     (3, 1, 896), (5, 3, 896), (10, 5, 896),
     (3, 1, 21), (5, 3, 21), (10, 5, 21),
 ])
 def test_enformer_alt(chr22_example_files, output_dir: Path, size, batch_size, num_output_bins):
+    if not chr22_example_files['fasta'].exists():
+        pytest.skip(f"The example FASTA {chr22_example_files['fasta']} is missing")
     args = {
         'fasta_file': chr22_example_files['fasta'],
         'gtf': chr22_example_files['gtf'],
@@ -159,6 +727,8 @@ def test_predict_tissue_mapper(allele_type: str, chr22_example_files, output_dir
 def test_calculate_veff(chr22_example_files, output_dir: Path,
                         enformer_tracks_path: Path, gtex_tissue_mapper_path: Path, aggregation_mode, downstream_tss,
                         upstream_tss, size=10):
+    if aggregation_mode in ['logsumexp', 'weighted_sum'] and not chr22_example_files['isoform_proportions'].exists():
+        pytest.skip(f"The isoform proportions {chr22_example_files['isoform_proportions']} are missing")
     ref_filepath = get_tissue_path(output_dir, size, AlleleType.REF)
     if ref_filepath.exists():
         logger.debug(f'Using existing file: {ref_filepath}')
@@ -186,6 +756,36 @@ def test_calculate_veff(chr22_example_files, output_dir: Path,
     return output_path
 
 
+def test_precision_report(chr22_example_files, output_dir: Path, enformer_tracks_path: Path,
+                          gtex_tissue_mapper_path: Path, size=10, batch_size=5, num_output_bins=21):
+    enformer_filepath = get_enformer_path(output_dir, size, AlleleType.ALT)
+    if not enformer_filepath.exists():
+        test_enformer_alt(chr22_example_files, output_dir, size, batch_size, num_output_bins)
+    alt_path = output_dir / f'enformer_{size}/precision/alt_aggregated.parquet'
+    alt_path.parent.mkdir(parents=True, exist_ok=True)
+    EnformerAggregator().aggregate(enformer_filepath, alt_path)
+
+    # the reference scores of the transcripts of the variants, so that every variant gets a veff score
+    alt_table = pq.read_table(alt_path)
+    first_rows = np.unique(alt_table['transcript_id'].to_numpy(), return_index=True)[1]
+    ref_table = alt_table.take(np.sort(first_rows)).drop_columns(['chrom', 'variant_start', 'variant_end', 'ref',
+                                                                  'alt'])
+    ref_path = output_dir / f'enformer_{size}/precision/ref_aggregated.parquet/chrom=chr22/data.parquet'
+    ref_path.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(ref_table, ref_path)
+
+    tissue_mapper = EnformerTissueMapper(tracks_path=enformer_tracks_path, tissue_mapper_path=gtex_tissue_mapper_path)
+    veff = EnformerVeff(gtf=chr22_example_files['gtf'])
+    report = precision_report([ref_path], alt_path, output_dir / f'enformer_{size}/precision/report', tissue_mapper,
+                              veff, aggregation_mode='median')
+    logger.info(report)
+    assert report['tracks_dtype'].tolist() == ['float16', 'bfloat16', 'log_uint16']
+    assert (report['size_ratio'] <= 1).all()
+    assert (report['tissue_max_abs_error'] < 0.05).all()
+    assert (report['num_scores'] > 0).all()
+    assert (report['max_abs_error'] < 0.05).all()
+
+
 @pytest.mark.parametrize("model", [
     linear_model.ElasticNetCV(cv=2),
     lgb.LGBMRegressor()
@@ -1,8 +1,26 @@
+import hashlib
+import inspect
+import json
+import os
+import itertools
+import pickle
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
 import pytest
+from shutil import rmtree, copyfile
 
 from kipoi_enformer.dataloader import VCFTSSDataloader, RefTSSDataloader
-from kipoi_enformer.dataloader.dataloader import get_tss_from_genome_annotation
-from kipoiseq.transforms.functional import one_hot2string
+from kipoi_enformer.dataloader.dataloader import Dataloader, get_tss_from_genome_annotation, \
+    extract_sequences_around_anchor, extract_shifted_sequence, to_float_sequences
+from kipoi_enformer import genome as genome_module
+from kipoi_enformer.genome import EncodedGenome, encode_genome
+from kipoi_enformer.annotation import ANNOTATION_CACHE_ENV, ANNOTATION_COLUMNS, load_annotation
+from kipoi_enformer import utils
+from kipoi_enformer.utils import gtf_to_pandas, file_content_hash
+from kipoiseq.transforms.functional import one_hot2string, one_hot_dna
+from kipoiseq.extractors import VariantSeqExtractor
+from kipoiseq import Interval, Variant
 
 UPSTREAM_TSS = 10
 DOWNSTREAM_TSS = 10
@@ -256,9 +274,9 @@ def test_genome_annotation_protein_canonical(chr22_example_files):
     assert len(roi) == 1212
 
 
-def test_vcf_dataloader(chr22_example_files, variants):
+def test_vcf_dataloader(chr22_example_files, example_fasta, variants):
     dl = VCFTSSDataloader(
-        fasta_file=chr22_example_files['fasta'],
+        fasta_file=example_fasta,
         gtf=chr22_example_files['gtf'],
         vcf_file=chr22_example_files['vcf'],
         variant_downstream_tss=10,
@@ -286,9 +304,9 @@ def test_vcf_dataloader(chr22_example_files, variants):
     print(total)
 
 
-def test_ref_dataloader(chr22_example_files, references):
+def test_ref_dataloader(chr22_example_files, example_fasta, references):
     dl = RefTSSDataloader(
-        fasta_file=chr22_example_files['fasta'],
+        fasta_file=example_fasta,
         gtf=chr22_example_files['gtf'],
         seq_length=21,
         shifts=[0],
@@ -309,3 +327,388 @@ def test_ref_dataloader(chr22_example_files, references):
     # check that all variants in my list were found and checked
     assert set(checked_refs.keys()) == set(references.keys())
     print(total)
+
+
+@pytest.mark.parametrize('allele_type', ['ref', 'alt'])
+def test_extract_sequences_around_anchor(chr22_example_files, synthetic_fasta, allele_type):
+    # the shifts are views into the union window, they match the sequences extracted for each shift
+    shifts = [-43, 0, 43]
+    if allele_type == 'ref':
+        dl = RefTSSDataloader(fasta_file=synthetic_fasta, gtf=chr22_example_files['gtf'],
+                              seq_length=1001, shifts=shifts, chromosome='chr22', size=100)
+    else:
+        dl = VCFTSSDataloader(fasta_file=synthetic_fasta, gtf=chr22_example_files['gtf'],
+                              vcf_file=chr22_example_files['vcf'], seq_length=1001, shifts=shifts,
+                              variant_upstream_tss=50, variant_downstream_tss=50)
+    variant_extractor = getattr(dl, '_variant_seq_extractor', None)
+    chrom_len = len(dl._reference_sequence.fasta.records['chr22'])
+    strands = set()
+    for _, (chromosome, strand, tss, *variant) in dl.iter_records():
+        variant = Variant(*variant) if len(variant) > 0 else None
+        sequences, interval = extract_sequences_around_anchor(shifts, chromosome, strand, tss, 1001,
+                                                              ref_seq_extractor=dl._reference_sequence,
+                                                              variant_extractor=variant_extractor, variant=variant)
+        for shift, seq in zip(shifts, sequences):
+            expected = extract_shifted_sequence(interval.shift(shift, use_strand=True), tss, chrom_len,
+                                                dl._reference_sequence, variant_extractor=variant_extractor,
+                                                variant=variant)
+            assert one_hot2string(seq[None])[0] == expected
+        strands.add(strand)
+    assert strands == {'+', '-'}
+
+
+def test_encoded_genome(chr22_example_files, synthetic_fasta, output_dir):
+    genome_dir = encode_genome(synthetic_fasta, output_dir / 'encoded_genome', overwrite=True)
+    shifts = [-43, 0, 43]
+    dl = RefTSSDataloader(fasta_file=synthetic_fasta, gtf=chr22_example_files['gtf'],
+                          seq_length=1001, shifts=shifts, chromosome='chr22', size=100)
+    encoded_dl = RefTSSDataloader(fasta_file=synthetic_fasta, gtf=chr22_example_files['gtf'],
+                                  seq_length=1001, shifts=shifts, chromosome='chr22', size=100,
+                                  genome_dir=genome_dir)
+    for (_, input_key), (_, encoded_input_key) in zip(dl.iter_records(), encoded_dl.iter_records()):
+        assert np.array_equal(dl.extract_sequences(input_key), encoded_dl.extract_sequences(encoded_input_key))
+
+    # windows that are padded at the chromosome ends
+    genome = EncodedGenome(genome_dir)
+    chrom_len = genome.chrom_len('chr22')
+    for strand, anchor in itertools.product(['+', '-'], [10, chrom_len - 10]):
+        sequences, _ = extract_sequences_around_anchor(shifts, 'chr22', strand, anchor, 1001,
+                                                       ref_seq_extractor=dl._reference_sequence)
+        encoded_sequences, _ = extract_sequences_around_anchor(shifts, 'chr22', strand, anchor, 1001,
+                                                               ref_seq_extractor=dl._reference_sequence,
+                                                               encoded_genome=genome)
+        assert np.array_equal(np.stack(sequences), np.stack(encoded_sequences))
+
+    # the memory maps are reopened after unpickling
+    unpickled_dl = pickle.loads(pickle.dumps(encoded_dl))
+    assert unpickled_dl._encoded_genome._arrays == {}
+    assert np.array_equal(unpickled_dl.extract_sequences(input_key), dl.extract_sequences(input_key))
+
+    # genome_dir is keyword-only, so positional arguments keep their meaning
+    for dataloader_cls in [Dataloader, RefTSSDataloader]:
+        parameter = inspect.signature(dataloader_cls.__init__).parameters['genome_dir']
+        assert parameter.kind == inspect.Parameter.KEYWORD_ONLY
+
+
+
+def test_encoded_genome_check(tmp_path, monkeypatch):
+    fasta_file = tmp_path / 'seq.fa'
+    fasta_file.write_text('>chr1\n' + 'ACGT' * 100 + '\n')
+    genome_dir = encode_genome(fasta_file, tmp_path / 'encoded_genome')
+    with monkeypatch.context() as m:
+        # the FASTA file is not hashed if its size and modification time are unchanged
+        m.setattr(genome_module, 'file_content_hash', None)
+        EncodedGenome(genome_dir, fasta_file=fasta_file)
+    # a touched file is hashed again
+    stat = fasta_file.stat()
+    os.utime(fasta_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    EncodedGenome(genome_dir, fasta_file=fasta_file)
+    # an edited file of the same size does not match
+    fasta_file.write_text('>chr1\n' + 'ACGT' * 99 + 'ACGA' + '\n')
+    os.utime(fasta_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    EncodedGenome(genome_dir, fasta_file=fasta_file)
+    with pytest.raises(ValueError):
+        EncodedGenome(genome_dir, fasta_file=fasta_file, verify=True)
+    os.utime(fasta_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2))
+    with pytest.raises(ValueError):
+        EncodedGenome(genome_dir, fasta_file=fasta_file)
+
+def test_annotation_cache(chr22_example_files, output_dir, monkeypatch):
+    cache_dir = output_dir / 'annotation_cache'
+    if cache_dir.exists():
+        rmtree(cache_dir)
+    monkeypatch.setenv(ANNOTATION_CACHE_ENV, str(cache_dir))
+    annotation = load_annotation(chr22_example_files['gtf'])
+    assert len(list(cache_dir.glob('*.arrow'))) == 1
+    # the second call loads the cached transcripts
+    cached_annotation = load_annotation(chr22_example_files['gtf'])
+    pd.testing.assert_frame_equal(annotation, cached_annotation)
+
+    gtf = gtf_to_pandas(chr22_example_files['gtf'])
+    transcripts = gtf.query("`Feature` == 'transcript'")[ANNOTATION_COLUMNS].reset_index(drop=True)
+    pd.testing.assert_frame_equal(cached_annotation, transcripts)
+
+    # the dataloaders get the same transcripts from the cache as from the parsed GTF file
+    roi = get_tss_from_genome_annotation(chr22_example_files['gtf'], chromosome='chr22', canonical_only=True)
+    expected_roi = get_tss_from_genome_annotation(gtf, chromosome='chr22', canonical_only=True)
+    pd.testing.assert_frame_equal(roi.reset_index(drop=True), expected_roi[roi.columns].reset_index(drop=True))
+
+
+def test_vcf_dataloader_matches(chr22_example_files, synthetic_fasta, output_dir, monkeypatch):
+    # the matches are persisted next to a copy of the VCF file
+    vcf_file = output_dir / 'matches/chr22_var.vcf.gz'
+    if vcf_file.parent.exists():
+        rmtree(vcf_file.parent)
+    vcf_file.parent.mkdir(parents=True)
+    copyfile(chr22_example_files['vcf'], vcf_file)
+
+    def dataloader(**kwargs):
+        return VCFTSSDataloader(fasta_file=synthetic_fasta, gtf=chr22_example_files['gtf'],
+                                vcf_file=vcf_file, variant_upstream_tss=50, variant_downstream_tss=50, **kwargs)
+
+    dl = dataloader()
+    records = list(dl.iter_records())
+    assert len(dl) == len(records)
+    # the selected records share the matches
+    assert list(dl.select_records(10, 20).iter_records()) == records[10:20]
+    assert len(list(vcf_file.parent.glob('*.parquet'))) == 0
+
+    persisted_dl = dataloader(persist_matches=True)
+    assert list(persisted_dl.iter_records()) == records
+    assert len(list(vcf_file.parent.glob('*.parquet'))) == 1
+
+    # a new dataloader loads the persisted matches instead of matching the variants again
+    monkeypatch.setattr(VCFTSSDataloader, '_get_single_variant_matcher', None)
+    persisted_dl = dataloader(persist_matches=True)
+    assert len(persisted_dl) == len(records)
+    assert list(persisted_dl.iter_records()) == records
+
+    # the matches are not persisted if the directory is not writable
+    unwritable_path = vcf_file.parent / 'file' / 'matches.parquet'
+    (vcf_file.parent / 'file').touch()
+    unwritable_dl = dataloader(persist_matches=True, matcher='sweep')
+    monkeypatch.setattr(unwritable_dl, '_matches_path', lambda: unwritable_path)
+    assert len(unwritable_dl) == len(records)
+    assert not unwritable_path.exists()
+
+
+def test_vcf_dataloader_sweep_matcher(chr22_example_files, synthetic_fasta):
+    def dataloader(matcher):
+        return VCFTSSDataloader(fasta_file=synthetic_fasta, gtf=chr22_example_files['gtf'],
+                                vcf_file=chr22_example_files['vcf'], variant_upstream_tss=50,
+                                variant_downstream_tss=200, matcher=matcher)
+
+    # both matchers find the same matches in a different order
+    records = list(dataloader('kipoiseq').iter_records())
+    sweep_records = list(dataloader('sweep').iter_records())
+
+    def key(record):
+        return record[1], record[0]['transcript_id']
+
+    assert len(sweep_records) == len(records)
+    assert sorted(sweep_records, key=key) == sorted(records, key=key)
+    # the sweep matches are ordered by the position of the variants
+    variant_starts = [metadata['variant_start'] for metadata, _ in sweep_records]
+    assert variant_starts == sorted(variant_starts)
+
+    with pytest.raises(ValueError):
+        dataloader('unknown')
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'uint8'])
+def test_iter_batches(chr22_example_files, synthetic_fasta, dtype, batch_size=3):
+    dl = VCFTSSDataloader(fasta_file=synthetic_fasta, gtf=chr22_example_files['gtf'],
+                          vcf_file=chr22_example_files['vcf'], seq_length=1001, variant_upstream_tss=50,
+                          variant_downstream_tss=200, size=10)
+    records = list(dl.iter_records())
+    batches = []
+    for i, batch in enumerate(dl.iter_batches(batch_size, dtype=dtype, num_buffers=2)):
+        batch_records = records[i * batch_size:(i + 1) * batch_size]
+        expected = np.stack([dl.extract_sequences(input_key) for _, input_key in batch_records])
+        assert batch['sequences'].dtype == dtype
+        assert np.array_equal(to_float_sequences(batch['sequences']), expected)
+        assert list(batch['metadata']['transcript_id']) == [metadata['transcript_id'] for metadata, _ in batch_records]
+        batches.append(batch)
+    assert sum(len(batch['sequences']) for batch in batches) == len(records)
+    # the buffers are reused round-robin
+    assert np.shares_memory(batches[0]['sequences'], batches[2]['sequences'])
+    assert not np.shares_memory(batches[0]['sequences'], batches[1]['sequences'])
+
+
+def test_patch_substitution(chr22_example_files, synthetic_fasta, output_dir):
+    # substitutions patched into the cached reference window match the sequences of VariantSeqExtractor
+    genome_dir = encode_genome(synthetic_fasta, output_dir / 'encoded_genome', overwrite=True)
+    shifts = [-43, 0, 43]
+    dl = RefTSSDataloader(fasta_file=synthetic_fasta, gtf=chr22_example_files['gtf'],
+                          seq_length=1001, shifts=shifts, chromosome='chr22', size=20)
+    variant_extractor = VariantSeqExtractor(reference_sequence=dl._reference_sequence)
+    chrom_len = len(dl._reference_sequence.fasta.records['chr22'])
+    rng = np.random.default_rng(0)
+    reference_cache = {}
+    strands = set()
+    for _, (chromosome, strand, tss) in dl.iter_records():
+        for offset, ref_length, alt in [(-400, 1, 'A'), (0, 1, 'c'), (1, 2, 'GT'), (300, 3, 'NTA'), (-2, 3, 'ACG')]:
+            start = tss + offset + int(rng.integers(0, 5))
+            ref = dl._reference_sequence.extract(Interval(chromosome, start, start + ref_length))
+            variant = Variant(chromosome, start + 1, ref, alt)
+            for encoded_genome in [None, EncodedGenome(genome_dir)]:
+                sequences, interval = extract_sequences_around_anchor(shifts, chromosome, strand, tss, 1001,
+                                                                      ref_seq_extractor=dl._reference_sequence,
+                                                                      variant_extractor=variant_extractor,
+                                                                      variant=variant,
+                                                                      encoded_genome=encoded_genome,
+                                                                      reference_cache=reference_cache)
+                for shift, seq in zip(shifts, sequences):
+                    expected = extract_shifted_sequence(interval.shift(shift, use_strand=True), tss, chrom_len,
+                                                        dl._reference_sequence, variant_extractor=variant_extractor,
+                                                        variant=variant)
+                    assert np.array_equal(seq, one_hot_dna(expected))
+        strands.add(strand)
+    assert strands == {'+', '-'}
+    # the reference is not modified by the patches
+    (key, reference), = reference_cache.items()
+    chromosome, strand, start, end = key
+    assert np.array_equal(reference, one_hot_dna(dl._reference_sequence.extract(Interval(chromosome, start, end,
+                                                                                         strand=strand))))
+
+
+@pytest.mark.parametrize('matcher', ['kipoiseq', 'sweep'])
+def test_vcf_dataloader_group_by_tss(chr22_example_files, synthetic_fasta, matcher):
+    def dataloader(group_by_tss, **kwargs):
+        return VCFTSSDataloader(fasta_file=synthetic_fasta, gtf=chr22_example_files['gtf'],
+                                vcf_file=chr22_example_files['vcf'], variant_upstream_tss=500,
+                                variant_downstream_tss=500, matcher=matcher, group_by_tss=group_by_tss, **kwargs)
+
+    records = list(dataloader(False).iter_records())
+    grouped_records = list(dataloader(True).iter_records())
+
+    def key(record):
+        return record[1], record[0]['transcript_id']
+
+    # the same records ordered by the TSS window and then by the variant
+    assert sorted(grouped_records, key=key) == sorted(records, key=key)
+    window_keys = [(metadata['chrom'], metadata['tss'], metadata['strand']) for metadata, _ in grouped_records]
+    assert window_keys == sorted(window_keys)
+
+    # the records of a TSS window are consecutive and ordered by the variant
+    assert len(set(window_keys)) < len(grouped_records)
+    for _, group in itertools.groupby(zip(window_keys, grouped_records), key=lambda x: x[0]):
+        variant_starts = [metadata['variant_start'] for _, (metadata, _) in group]
+        assert variant_starts == sorted(variant_starts)
+
+    # the batches of the grouped records extract the reference of every TSS window once
+    stored_windows = {}
+    for group_by_tss in [False, True]:
+        stored_windows[group_by_tss] = []
+
+        class ReferenceCache(dict):
+            def __setitem__(self, window, reference):
+                stored_windows[group_by_tss].append(window)
+                super().__setitem__(window, reference)
+
+        dl = dataloader(group_by_tss, seq_length=1001, size=5000)
+        dl._reference_cache = ReferenceCache()
+        for _ in dl.iter_batches(batch_size=4):
+            pass
+    assert len(stored_windows[True]) == len(set(stored_windows[True]))
+    assert len(stored_windows[False]) > len(stored_windows[True])
+    # every copy has its own reference cache
+    assert dl.select_records(0, 10)._reference_cache is not dl._reference_cache
+
+
+def test_ref_dataloader_multi_chromosome(chr22_example_files, synthetic_fasta):
+    def dataloader(chromosome):
+        return RefTSSDataloader(fasta_file=synthetic_fasta, gtf=chr22_example_files['gtf'],
+                                seq_length=1001, chromosome=chromosome, canonical_only=True)
+
+    # the records of every chromosome sorted by the TSS
+    expected = []
+    for chromosome in ['chr21', 'chr22']:
+        records = [({**metadata, 'chrom': chromosome}, input_key)
+                   for metadata, input_key in dataloader(chromosome).iter_records()]
+        expected += sorted(records, key=lambda x: x[0]['tss'])
+    dl = dataloader(None)
+    records = list(dl.iter_records())
+    assert records == expected
+    assert dl.pyarrow_metadata_schema.names == [*dataloader('chr22').pyarrow_metadata_schema.names, 'chrom']
+    assert list(dataloader(['chr22']).iter_records()) == [x for x in expected if x[0]['chrom'] == 'chr22']
+
+    # the sequences are extracted from the chromosome of the record
+    for _, input_key in [records[0], records[-1]]:
+        assert dl.extract_sequences(input_key).shape == (3, 1001, 4)
+    assert {metadata['chrom'] for metadata, _ in dl.select_records(len(dl) - 2, len(dl)).iter_records()} == {'chr22'}
+
+
+@pytest.mark.parametrize('allele_type', ['ref', 'alt'])
+def test_dataloader_shards(chr22_example_files, synthetic_fasta, tmp_path, monkeypatch, allele_type, num_shards=3):
+    # the matches are persisted next to a copy of the VCF file
+    vcf_file = tmp_path / 'chr22_var.vcf.gz'
+    copyfile(chr22_example_files['vcf'], vcf_file)
+
+    def dataloader(**kwargs):
+        if allele_type == 'ref':
+            return RefTSSDataloader(fasta_file=synthetic_fasta, gtf=chr22_example_files['gtf'],
+                                    chromosome='chr22', canonical_only=True, **kwargs)
+        return VCFTSSDataloader(fasta_file=synthetic_fasta, gtf=chr22_example_files['gtf'], vcf_file=vcf_file,
+                                variant_upstream_tss=50, variant_downstream_tss=50, persist_matches=True, **kwargs)
+
+    dl = dataloader()
+    if allele_type == 'alt':
+        # sharding requires the persisted matches
+        with pytest.raises(ValueError):
+            VCFTSSDataloader(fasta_file=synthetic_fasta, gtf=chr22_example_files['gtf'], vcf_file=vcf_file,
+                             num_shards=num_shards)
+        # the shards count the persisted matches without matching the variants again
+        len(dl)
+        with monkeypatch.context() as m:
+            m.setattr(VCFTSSDataloader, '_sweep_matches', None)
+            m.setattr(VCFTSSDataloader, '_get_single_variant_matcher', None)
+            m.setattr(pq, 'read_table', None)
+            assert len(dataloader(num_shards=num_shards, shard_index=0)) == dl.shard_sizes(num_shards)[0]
+    records = list(dl.iter_records())
+    # the shards are balanced and their concatenation equals the records
+    shard_sizes = dl.shard_sizes(num_shards)
+    assert sum(shard_sizes) == len(records)
+    assert max(shard_sizes) - min(shard_sizes) <= 1
+    shard_records = []
+    for shard_index in range(num_shards):
+        shard_dl = dataloader(num_shards=num_shards, shard_index=shard_index)
+        assert len(shard_dl) == shard_sizes[shard_index]
+        assert list(shard_dl.iter_records()) == list(dl.select_shard(shard_index, num_shards).iter_records())
+        shard_records += list(shard_dl.iter_records())
+    assert shard_records == records
+    # a single shard covers all records
+    assert dataloader(num_shards=1).config == dl.config
+
+    # the shards of the first records
+    dl = dataloader(size=10)
+    assert dl.shard_sizes(num_shards) == [3, 3, 4]
+    assert list(dl.select_shard(2, num_shards).iter_records()) == records[6:10]
+    with pytest.raises(AssertionError):
+        dataloader(num_shards=num_shards, shard_index=num_shards)
+    # the shard arguments are keyword-only, so positional arguments keep their meaning
+    parameters = inspect.signature(type(dl).__init__).parameters
+    assert parameters['num_shards'].kind == parameters['shard_index'].kind == inspect.Parameter.KEYWORD_ONLY
+
+
+def test_file_content_hash(tmp_path, monkeypatch, size=3 * 2 ** 20):
+    path = tmp_path / 'data' / 'seq.fa'
+    path.parent.mkdir()
+    content = bytearray(b'ACGT' * (size // 4))
+    path.write_bytes(content)
+    cache_dir = tmp_path / 'hash_cache'
+    monkeypatch.setenv(utils.HASH_CACHE_ENV, str(cache_dir))
+    content_hash = file_content_hash(path)
+    assert file_content_hash(path) == content_hash
+
+    # other processes reuse the hash stored in the cache directory without reading the file
+    assert list(path.parent.iterdir()) == [path]
+    memo, = [json.loads(x.read_text()) for x in cache_dir.iterdir()]
+    assert memo == {'path': str(path.resolve()), 'size': size, 'mtime_ns': path.stat().st_mtime_ns,
+                    'sha256': content_hash}
+    with monkeypatch.context() as m:
+        m.setattr(utils, '_CONTENT_HASHES', {})
+        # the key of the memoized hash is hashed, the content of the file is not
+        sha256 = hashlib.sha256
+        m.setattr(hashlib, 'sha256', lambda *args: sha256(*args) if len(args) > 0 else None)
+        assert file_content_hash(path) == content_hash
+
+    # an edit in the middle of the file, which keeps its size
+    stat = path.stat()
+    content[size // 2] = ord('N')
+    path.write_bytes(content)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert path.stat().st_size == size
+    assert file_content_hash(path) != content_hash
+
+
+def test_annotation_cache_unwritable(chr22_example_files, tmp_path, monkeypatch):
+    # the cache directory cannot be created below a file
+    (tmp_path / 'file').touch()
+    cache_dir = tmp_path / 'file' / 'annotation_cache'
+    monkeypatch.setenv(ANNOTATION_CACHE_ENV, str(cache_dir))
+    annotation = load_annotation(chr22_example_files['gtf'])
+    assert not cache_dir.exists()
+    assert list(tmp_path.iterdir()) == [tmp_path / 'file']
+    pd.testing.assert_frame_equal(annotation, load_annotation(chr22_example_files['gtf'], use_cache=False))
+    assert len(annotation) > 0